@@ -1,22 +1,64 @@
 import os
+import json
 import uuid
+import multiprocessing
 from dotenv import load_dotenv
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_cors import CORS
-from embeddings import add_pdf_to_collection, get_documents
-from llm import query_llm
-from cache import get_cached_response, save_to_cache
+from embeddings import get_documents, embed_query, resolve_cache_date, get_embedding_backend, get_embedding_model
+from llm import query_llm, stream_llm, model_router
+from cache import (
+    get_cached_response, save_to_cache, find_semantic_match, get_semantic_cache_stats, get_cache_stats
+)
+from chat_helpers import (
+    SIMPLE_GREETINGS, build_contextual_query, build_sources, quota_error_payload, chatbot_status, flight_key
+)
+from embedding_cache import get_embedding_cache_stats
+from rate_limiter import rate_limiter
+from context_packer import get_context_packer_stats
+from ingestion_jobs import ingestion_queue
+from lexical_index import LEXICAL_INDEX_ENABLED, get_lexical_index, get_lexical_index_stats
+from vector_mirror import VECTOR_MIRROR_ENABLED, get_vector_mirror, get_vector_mirror_stats
+from metrics import render_metrics, PROMETHEUS_CONTENT_TYPE
+from hedging import get_hedging_stats
+from single_flight import chat_flight, ask_flight, get_single_flight_stats
+from structured_logging import (
+    get_logger, start_request, current_request_id, get_logging_stats, REQUEST_ID_HEADER
+)
 
 load_dotenv()
 
 app = Flask(__name__)
 CORS(app)
+log = get_logger('app')
+
+
+
+@app.before_request
+def assign_request_id():
+    # Correlación de logs: el X-Request-ID del cliente/proxy o uno nuevo
+    start_request(request.headers.get(REQUEST_ID_HEADER))
+
+
+@app.after_request
+def add_request_id_header(response):
+    response.headers[REQUEST_ID_HEADER] = current_request_id()
+    return response
 
-chatbot_status = {}
 
 # Crear carpeta pdf_files si no existe
 os.makedirs('pdf_files', exist_ok=True)
 
+# Índice BM25 y espejo vectorial local de la colección: se preparan en
+# segundo plano al arrancar (mientras tanto se consulta Qdrant). Con
+# 'python app.py', los procesos de extracción de PDFs (spawn) reimportan este
+# módulo como __mp_main__: ahí no se precalienta nada
+if multiprocessing.parent_process() is None:
+    if LEXICAL_INDEX_ENABLED:
+        get_lexical_index(os.getenv('QDRANT_COLLECTION', 'ESCUELA-SABATICA'))
+    if VECTOR_MIRROR_ENABLED:
+        get_vector_mirror(os.getenv('QDRANT_COLLECTION', 'ESCUELA-SABATICA'))
+
 @app.route('/build_chatbot', methods=['POST'])
 def build_chatbot():
     """
@@ -37,26 +79,25 @@ def build_chatbot():
         # Guardar archivo temporalmente
         file_path = os.path.join('pdf_files', file.filename)
         file.save(file_path)
-        print(f"💾 Archivo guardado: {file_path}")
+        log.info("💾 Archivo guardado: %s", file_path)
         
         # Usar la colección predeterminada
         collection_name = os.getenv('QDRANT_COLLECTION', 'ESCUELA-SABATICA')
         
-        # Agregar el PDF a la colección
-        result = add_pdf_to_collection(collection_name, file_path, file.filename)
+        # Encolar la ingesta; el progreso se consulta en /jobs/<job_id>
+        job = ingestion_queue.submit(collection_name, file_path, file.filename)
         
         return jsonify({
             'success': True,
-            'message': f'PDF "{file.filename}" agregado exitosamente a {collection_name}',
+            'message': f'PDF "{file.filename}" en cola para agregarse a {collection_name}',
             'collection': collection_name,
-            'pages_added': result['pages_added'],
-            'total_points': result['total_points']
-        }), 200
+            'job_id': job.id,
+            'status': 'queued',
+            'status_url': f'/jobs/{job.id}'
+        }), 202
         
     except Exception as e:
-        print(f"❌ Error al procesar PDF: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.exception("❌ Error al procesar PDF: %s", e)
         
         return jsonify({
             'error': 'Error al procesar el archivo PDF',
@@ -84,13 +125,13 @@ def ask_chatbot(chatbot_id):
             return jsonify({'error': 'Chatbot not found'}), 404
         collection_name = chatbot_id
 
-    # Acceder a la base de datos de vectores y obtener documentos relevantes
-    relevant_documents = get_documents(collection_name, question)
+    # Documentos relevantes + Gemini; las preguntas idénticas en curso se comparten
+    result, _ = ask_flight.do(
+        flight_key('ask', collection_name, question, resolve_cache_date(question)[0]),
+        lambda: answer_question(question, collection_name)
+    )
 
-    # Preguntar a Gemini con los documentos relevantes
-    answer = query_llm(question, relevant_documents)
-
-    return jsonify({'answer': answer}), 200
+    return jsonify({'answer': result['answer']}), 200
 
 
 @app.route('/ask', methods=['POST'])
@@ -106,21 +147,65 @@ def ask():
     collection_name = os.getenv('QDRANT_COLLECTION', 'ESCUELA-SABATICA')
 
     try:
-        # Obtener documentos relevantes
-        relevant_documents = get_documents(collection_name, question)
-        
-        # Generar respuesta con Gemini
-        answer = query_llm(question, relevant_documents)
+        # Documentos relevantes + Gemini; las preguntas idénticas en curso se comparten
+        result, _ = ask_flight.do(
+            flight_key('ask', collection_name, question, resolve_cache_date(question)[0]),
+            lambda: answer_question(question, collection_name)
+        )
         
         return jsonify({
-            'answer': answer,
+            'answer': result['answer'],
             'collection': collection_name,
-            'documents_found': len(relevant_documents)
+            'documents_found': result['documents_found']
         }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def answer_chat(message, contextual_query, collection_name, date_key, relative_date):
+    """
+    Camino de /chat tras fallar el cache exacto: embedding, cache semántico,
+    búsqueda, generación y guardado en cache. Devuelve
+    {'response', 'sources', 'from_cache'}.
+    """
+    # Embedding de la query contextual: sirve para el cache semántico y para la búsqueda
+    embedded_query = embed_query(contextual_query, collection_name)
+    _, _, question_vector = embedded_query
+    embedding_model = get_embedding_model(collection_name)
+    
+    semantic_result = find_semantic_match(question_vector, date_key, embedded_text=contextual_query,
+                                          embedding_model=embedding_model)
+    if semantic_result:
+        return {
+            'response': semantic_result['response'],
+            'sources': semantic_result.get('sources', []),
+            'from_cache': True
+        }
+    
+    # Obtener documentos relevantes usando query contextual
+    relevant_documents = get_documents(collection_name, contextual_query, embedded_query=embedded_query)
+    log.info("📚 Documentos encontrados: %s", len(relevant_documents))
+    
+    # Generar respuesta con Gemini
+    answer = query_llm(message, relevant_documents)
+    log.info("✅ Respuesta generada: %.100s...", answer)
+    
+    sources = build_sources(relevant_documents)
+    
+    # Guardar en cache para futuras consultas
+    save_to_cache(message, answer, sources, embedding=question_vector,
+                  date_key=date_key, relative_date=relative_date, embedded_text=contextual_query,
+                  embedding_model=embedding_model)
+    return {'response': answer, 'sources': sources, 'from_cache': False}
+
+
+def answer_question(question, collection_name):
+    """Documentos relevantes + respuesta de Gemini para /ask y /ask_chatbot"""
+    relevant_documents = get_documents(collection_name, question)
+    answer = query_llm(question, relevant_documents)
+    return {'answer': answer, 'documents_found': len(relevant_documents)}
+
+
 @app.route('/chat', methods=['POST'])
 def chat():
     """
@@ -137,95 +222,26 @@ def chat():
     collection_name = os.getenv('QDRANT_COLLECTION', 'ESCUELA-SABATICA')
 
     try:
-        print(f"💬 Nueva pregunta: {message}")
-        
-        # Respuestas directas para saludos y mensajes simples (sin llamadas API)
-        simple_greetings = {
-            'hola': '¡Hola! Soy tu asistente de la Escuela Sabática. ¿En qué puedo ayudarte hoy?',
-            'hello': 'Hello! I am your Sabbath School assistant. How can I help you today?',
-            'hi': 'Hi! How can I assist you with Sabbath School today?',
-            'buenos días': '¡Buenos días! ¿En qué puedo ayudarte con la Escuela Sabática?',
-            'buenas tardes': '¡Buenas tardes! ¿En qué te puedo ayudar?',
-            'buenas noches': '¡Buenas noches! ¿Tienes alguna pregunta sobre la Escuela Sabática?',
-            'gracias': '¡De nada! Estoy aquí para ayudarte.',
-            'thank you': 'You\'re welcome! I\'m here to help.',
-            'thanks': 'You\'re welcome!',
-            'adiós': '¡Hasta luego! Que tengas un buen día.',
-            'bye': 'Goodbye! Have a great day!',
-            'chao': '¡Chao! Vuelve pronto si tienes más preguntas.'
-        }
+        log.info("💬 Nueva pregunta: %s", message)
         
         message_lower = message.lower().strip()
-        if message_lower in simple_greetings:
-            print(f"💡 Respuesta directa (sin API): {message_lower}")
+        if message_lower in SIMPLE_GREETINGS:
+            log.info("💡 Respuesta directa (sin API): %s", message_lower)
             return jsonify({
-                'content': simple_greetings[message_lower],
-                'response': simple_greetings[message_lower],
+                'content': SIMPLE_GREETINGS[message_lower],
+                'response': SIMPLE_GREETINGS[message_lower],
                 'sources': [],
                 'from_cache': False,
                 'direct_response': True
             }), 200
         
-        # Construir query contextual con historial reciente
-        # Priorizar la pregunta actual pero incluir contexto si es una pregunta de seguimiento
-        contextual_query = message
-        
-        # Palabras temporales que indican que la pregunta ya tiene contexto temporal completo
-        temporal_keywords = ['hoy', 'mañana', 'ayer', 'pasado', 'antes', 'lunes', 'martes', 
-                            'miércoles', 'jueves', 'viernes', 'sábado', 'domingo',
-                            'enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio',
-                            'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre']
+        contextual_query = build_contextual_query(message, conversation_history)
         
-        message_lower = message.lower()
-        has_temporal_keyword = any(keyword in message_lower for keyword in temporal_keywords)
-        
-        if conversation_history and len(conversation_history) > 0:
-            # Tomar los últimos 10 mensajes para contexto
-            recent_messages = conversation_history[-10:] if len(conversation_history) >= 10 else conversation_history
-            context_parts = []
-            for msg in recent_messages:
-                if msg.get('role') == 'user':
-                    context_parts.append(msg.get('content', ''))
-            
-            # Si hay contexto previo y la pregunta actual es corta (probablemente de seguimiento)
-            # PERO NO tiene palabras temporales (para evitar conflictos como "hoy" vs "mañana")
-            if context_parts and len(message.split()) < 8 and not has_temporal_keyword:
-                # Combinar los últimos 2 mensajes del usuario con más peso en la pregunta actual
-                recent_context = ' '.join(context_parts[-2:])
-                contextual_query = f"{message} {recent_context}"
-                print(f"🔗 Query contextual (pregunta corta sin palabras temporales): {contextual_query}")
-                
-                # IMPORTANTE: Si la pregunta corta menciona un día/número sin mes (ej: "y la del 31")
-                # Intentar extraer el mes del contexto previo
-                import re
-                meses = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 
-                         'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre']
-                
-                # Buscar número de día en la pregunta actual (ej: "31", "del 31", "el 31")
-                dia_match = re.search(r'\b(\d{1,2})\b', message.lower())
-                
-                # Buscar mes en el contexto previo
-                mes_match = None
-                for mes in meses:
-                    if mes in recent_context.lower():
-                        mes_match = mes
-                        break
-                
-                # Si encontramos día en pregunta actual y mes en contexto previo
-                if dia_match and mes_match:
-                    dia_numero = dia_match.group(1)
-                    # Enriquecer el query contextual con fecha completa
-                    contextual_query = f"{message} {dia_numero} de {mes_match}"
-                    print(f"📅 Fecha detectada del contexto: {dia_numero} de {mes_match}")
-                    print(f"🔗 Query enriquecido con fecha: {contextual_query}")
-            elif has_temporal_keyword:
-                # Si tiene palabra temporal, usar SOLO el mensaje actual sin contexto
-                print(f"🔗 Query con palabra temporal detectada: '{message}' (sin contexto adicional)")
-            else:
-                print(f"🔗 Query simple: {message}")
+        # Fecha resuelta ("mañana" → ISO): forma parte de la clave del cache
+        date_key, relative_date = resolve_cache_date(contextual_query)
         
-        # Intentar obtener del cache primero (usando solo el mensaje actual)
-        cached_result = get_cached_response(message)
+        # Intentar obtener del cache primero (mensaje actual + fecha resuelta)
+        cached_result = get_cached_response(message, date_key=date_key)
         if cached_result:
             return jsonify({
                 'content': cached_result['response'],
@@ -234,60 +250,125 @@ def chat():
                 'from_cache': True
             }), 200
         
-        # Obtener documentos relevantes usando query contextual
-        relevant_documents = get_documents(collection_name, contextual_query)
-        print(f"📚 Documentos encontrados: {len(relevant_documents)}")
-        
-        # Generar respuesta con Gemini
-        answer = query_llm(message, relevant_documents)
-        print(f"✅ Respuesta generada: {answer[:100]}...")
-        
-        # Extraer contenido de los documentos (pueden ser objetos Document de LangChain)
-        sources = []
-        if relevant_documents:
-            for i, doc in enumerate(relevant_documents[:3]):
-                # Si es un objeto Document, extraer page_content
-                if hasattr(doc, 'page_content'):
-                    content = doc.page_content
-                # Si es string, usar directamente
-                elif isinstance(doc, str):
-                    content = doc
-                else:
-                    content = str(doc)
-                
-                sources.append({
-                    'title': f'Documento {i+1}',
-                    'snippet': content[:200] + '...' if len(content) > 200 else content,
-                    'url': ''
-                })
-        
-        # Guardar en cache para futuras consultas
-        save_to_cache(message, answer, sources)
+        # Las solicitudes idénticas en curso esperan el resultado de la primera
+        result, coalesced = chat_flight.do(
+            flight_key('chat', collection_name, message, date_key),
+            lambda: answer_chat(message, contextual_query, collection_name, date_key, relative_date)
+        )
         
         # Formato compatible con el endpoint de Next.js
         return jsonify({
-            'content': answer,
-            'response': answer,
-            'sources': sources,
-            'from_cache': False
+            'content': result['response'],
+            'response': result['response'],
+            'sources': result['sources'],
+            'from_cache': result['from_cache'] or coalesced
         }), 200
     except Exception as e:
         error_message = str(e)
-        print(f"❌ Error en /chat: {error_message}")
-        import traceback
-        traceback.print_exc()
+        log.exception("❌ Error en /chat: %s", error_message)
         
         # Mensaje amigable para límite de cuota
-        if "429" in error_message or "Resource exhausted" in error_message or "cuota" in error_message.lower():
-            return jsonify({
-                'error': 'Límite de cuota de Gemini alcanzado',
-                'message': 'Has alcanzado el límite de solicitudes por minuto. Por favor, espera un momento e intenta nuevamente, o cambia al modelo n8n.',
-                'details': error_message
-            }), 429
+        quota_error = quota_error_payload(error_message)
+        if quota_error:
+            return jsonify(quota_error), 429
         
         return jsonify({'error': error_message}), 500
 
 
+def sse_event(event, data):
+    """Formatea un evento Server-Sent Events con datos JSON"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Variante en streaming (SSE) de /chat. Mismo cuerpo de entrada.
+    Eventos emitidos, en orden:
+      - sources: { "sources": [...] }
+      - chunk:   { "content": "fragmento" } (uno o más)
+      - done:    { "from_cache": bool, "direct_response"?: bool }
+      - error:   { "error": "...", ... } si algo falla
+    Al terminar, la respuesta completa se guarda en el cache como en /chat.
+    """
+    data = request.get_json()
+    if 'message' not in data:
+        return jsonify({'error': 'Missing "message" in the request body'}), 400
+
+    message = data['message']
+    conversation_history = data.get('history', [])
+    collection_name = os.getenv('QDRANT_COLLECTION', 'ESCUELA-SABATICA')
+
+    def generate():
+        try:
+            log.info("💬 Nueva pregunta (stream): %s", message)
+
+            message_lower = message.lower().strip()
+            if message_lower in SIMPLE_GREETINGS:
+                yield sse_event('sources', {'sources': []})
+                yield sse_event('chunk', {'content': SIMPLE_GREETINGS[message_lower]})
+                yield sse_event('done', {'from_cache': False, 'direct_response': True})
+                return
+
+            contextual_query = build_contextual_query(message, conversation_history)
+            
+            # Fecha resuelta ("mañana" → ISO): forma parte de la clave del cache
+            date_key, relative_date = resolve_cache_date(contextual_query)
+
+            cached_result = get_cached_response(message, date_key=date_key)
+            if cached_result:
+                yield sse_event('sources', {'sources': cached_result.get('sources', [])})
+                yield sse_event('chunk', {'content': cached_result['response']})
+                yield sse_event('done', {'from_cache': True})
+                return
+
+            embedded_query = embed_query(contextual_query, collection_name)
+            _, _, question_vector = embedded_query
+            embedding_model = get_embedding_model(collection_name)
+
+            semantic_result = find_semantic_match(question_vector, date_key, embedded_text=contextual_query,
+                                                  embedding_model=embedding_model)
+            if semantic_result:
+                yield sse_event('sources', {'sources': semantic_result.get('sources', [])})
+                yield sse_event('chunk', {'content': semantic_result['response']})
+                yield sse_event('done', {'from_cache': True})
+                return
+
+            relevant_documents = get_documents(collection_name, contextual_query, embedded_query=embedded_query)
+            log.info("📚 Documentos encontrados: %s", len(relevant_documents))
+
+            # Las fuentes se envían antes de empezar la generación
+            sources = build_sources(relevant_documents)
+            yield sse_event('sources', {'sources': sources})
+
+            answer_parts = []
+            for text in stream_llm(message, relevant_documents):
+                answer_parts.append(text)
+                yield sse_event('chunk', {'content': text})
+
+            answer = ''.join(answer_parts)
+            log.info("✅ Respuesta generada (stream): %.100s...", answer)
+            save_to_cache(message, answer, sources, embedding=question_vector,
+                          date_key=date_key, relative_date=relative_date, embedded_text=contextual_query,
+                          embedding_model=embedding_model)
+
+            yield sse_event('done', {'from_cache': False})
+        except Exception as e:
+            error_message = str(e)
+            log.exception("❌ Error en /chat/stream: %s", error_message)
+            yield sse_event('error', quota_error_payload(error_message) or {'error': error_message})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            # Evita que un proxy (nginx/traefik) acumule el stream
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
 @app.route('/health', methods=['GET'])
 def health():
     collection_name = os.getenv('QDRANT_COLLECTION', 'ESCUELA-SABATICA')
@@ -295,9 +376,26 @@ def health():
         'status': 'ok',
         'port': os.environ.get('PORT', '5000'),
         'qdrant_url': os.getenv('QDRANT_URL'),
-        'default_collection': collection_name
+        'default_collection': collection_name,
+        'embedding_backend': get_embedding_backend(collection_name),
+        'embedding_cache': get_embedding_cache_stats(),
+        'response_cache': get_cache_stats(),
+        'semantic_cache': get_semantic_cache_stats(),
+        'context_packer': get_context_packer_stats(),
+        'lexical_index': get_lexical_index_stats(),
+        'vector_mirror': get_vector_mirror_stats(),
+        'model_router': model_router.get_stats(),
+        'hedging': get_hedging_stats(),
+        'single_flight': get_single_flight_stats(),
+        'logging': get_logging_stats(),
+        'rate_limiter': rate_limiter.get_stats()
     }), 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Latencias por etapa y contadores en formato Prometheus"""
+    return Response(render_metrics(), content_type=PROMETHEUS_CONTENT_TYPE)
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     """
@@ -319,31 +417,45 @@ def upload_file():
         # Guardar archivo temporalmente
         file_path = os.path.join('pdf_files', file.filename)
         file.save(file_path)
-        print(f"💾 Archivo guardado: {file_path}")
+        log.info("💾 Archivo guardado: %s", file_path)
         
         # Usar la colección de Escuela Sabática
         collection_name = os.getenv('QDRANT_COLLECTION', 'ESCUELA-SABATICA')
-        print(f"📚 Procesando archivo para colección: {collection_name}")
+        log.info("📚 Encolando archivo para colección: %s", collection_name)
         
-        # Agregar el PDF a Qdrant
-        result = add_pdf_to_collection(collection_name, file_path, file.filename)
-        
-        print(f"✅ PDF procesado exitosamente: {result['pages_added']} páginas agregadas")
+        # La ingesta corre en segundo plano; el progreso se consulta en /jobs/<job_id>
+        job = ingestion_queue.submit(collection_name, file_path, file.filename)
         
         return jsonify({
             'success': True,
-            'message': f'Archivo "{file.filename}" procesado y agregado a Qdrant',
+            'message': f'Archivo "{file.filename}" en cola para procesarse y agregarse a Qdrant',
             'collection': collection_name,
-            'pages_added': result['pages_added'],
-            'filename': file.filename
-        }), 200
+            'filename': file.filename,
+            'job_id': job.id,
+            'status': 'queued',
+            'status_url': f'/jobs/{job.id}'
+        }), 202
         
     except Exception as e:
-        print(f"❌ Error procesando archivo: {str(e)}")
+        log.exception("❌ Error procesando archivo: %s", e)
         return jsonify({
             'error': 'Error al procesar el archivo',
             'details': str(e)
         }), 500
 
+@app.route('/jobs/<string:job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Progreso de un trabajo de ingesta: páginas extraídas, con embedding y subidas
+    """
+    job = ingestion_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict()), 200
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify({'jobs': ingestion_queue.list()}), 200
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,310 @@
+"""
+Modo de servicio asíncrono (ASGI) del backend de chat.
+
+Expone los mismos endpoints y contratos JSON que app.py (/chat, /ask,
+/ask_chatbot/<id>, /upload, /health), pero sobre un event loop: el embedding,
+las llamadas a Qdrant y la generación de Gemini ceden el loop mientras esperan
+la red, así un proceso atiende cientos de conversaciones sin un hilo por
+solicitud. La ingesta de PDFs va a la misma cola acotada (ingestion_jobs).
+
+Uso:
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+    # o bien
+    python asgi.py
+"""
+import os
+import asyncio
+from dotenv import load_dotenv
+from quart import Quart, Response, jsonify, request
+from quart_cors import cors
+from chat_helpers import (
+    SIMPLE_GREETINGS, build_contextual_query, build_sources, quota_error_payload, chatbot_status, flight_key
+)
+from embeddings import get_documents_async, embed_query_async, resolve_cache_date, get_embedding_backend, get_embedding_model
+from llm import query_llm_async, model_router
+from cache import (
+    get_cached_response, save_to_cache, find_semantic_match, get_semantic_cache_stats, get_cache_stats
+)
+from embedding_cache import get_embedding_cache_stats
+from rate_limiter import rate_limiter
+from context_packer import get_context_packer_stats
+from qdrant_transport import close_async_client
+from ingestion_jobs import ingestion_queue
+from lexical_index import LEXICAL_INDEX_ENABLED, get_lexical_index, get_lexical_index_stats
+from vector_mirror import VECTOR_MIRROR_ENABLED, get_vector_mirror, get_vector_mirror_stats
+from metrics import render_metrics, PROMETHEUS_CONTENT_TYPE
+from hedging import get_hedging_stats
+from single_flight import chat_flight, ask_flight, get_single_flight_stats
+from structured_logging import (
+    get_logger, start_request, current_request_id, get_logging_stats, REQUEST_ID_HEADER
+)
+
+load_dotenv()
+
+app = cors(Quart(__name__))
+log = get_logger('asgi')
+
+os.makedirs('pdf_files', exist_ok=True)
+
+
+@app.before_request
+async def assign_request_id():
+    start_request(request.headers.get(REQUEST_ID_HEADER))
+
+
+@app.after_request
+async def add_request_id_header(response):
+    response.headers[REQUEST_ID_HEADER] = current_request_id()
+    return response
+
+
+@app.before_serving
+async def warm_up():
+    # Igual que app.py: índice BM25 y espejo vectorial en segundo plano
+    collection_name = os.getenv('QDRANT_COLLECTION', 'ESCUELA-SABATICA')
+    if LEXICAL_INDEX_ENABLED:
+        get_lexical_index(collection_name)
+    if VECTOR_MIRROR_ENABLED:
+        get_vector_mirror(collection_name)
+
+
+@app.after_serving
+async def shutdown():
+    await close_async_client()
+
+
+@app.route('/ask_chatbot/<string:chatbot_id>', methods=['POST'])
+async def ask_chatbot(chatbot_id):
+    data = await request.get_json()
+    if 'question' not in data:
+        return jsonify({'error': 'Missing "question" in the request body'}), 400
+
+    question = data['question']
+    
+    if chatbot_id == 'default':
+        collection_name = os.getenv('QDRANT_COLLECTION', 'ESCUELA-SABATICA')
+    else:
+        if chatbot_id not in chatbot_status:
+            return jsonify({'error': 'Chatbot not found'}), 404
+        collection_name = chatbot_id
+
+    result, _ = await ask_flight.do_async(
+        flight_key('ask', collection_name, question, resolve_cache_date(question)[0]),
+        lambda: answer_question_async(question, collection_name)
+    )
+
+    return jsonify({'answer': result['answer']}), 200
+
+
+@app.route('/ask', methods=['POST'])
+async def ask():
+    data = await request.get_json()
+    if 'question' not in data:
+        return jsonify({'error': 'Missing "question" in the request body'}), 400
+
+    question = data['question']
+    collection_name = os.getenv('QDRANT_COLLECTION', 'ESCUELA-SABATICA')
+
+    try:
+        result, _ = await ask_flight.do_async(
+            flight_key('ask', collection_name, question, resolve_cache_date(question)[0]),
+            lambda: answer_question_async(question, collection_name)
+        )
+        
+        return jsonify({
+            'answer': result['answer'],
+            'collection': collection_name,
+            'documents_found': result['documents_found']
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+async def answer_chat_async(message, contextual_query, collection_name, date_key, relative_date):
+    """Versión asíncrona de answer_chat (app.py)"""
+    embedded_query = await embed_query_async(contextual_query, collection_name)
+    _, _, question_vector = embedded_query
+    embedding_model = get_embedding_model(collection_name)
+    
+    # El cache (SQLite y el índice semántico) corre en hilos para no bloquear el loop
+    semantic_result = await asyncio.to_thread(
+        find_semantic_match, question_vector, date_key, embedded_text=contextual_query,
+        embedding_model=embedding_model
+    )
+    if semantic_result:
+        return {
+            'response': semantic_result['response'],
+            'sources': semantic_result.get('sources', []),
+            'from_cache': True
+        }
+    
+    relevant_documents = await get_documents_async(
+        collection_name, contextual_query, embedded_query=embedded_query
+    )
+    log.info("📚 Documentos encontrados: %s", len(relevant_documents))
+    
+    answer = await query_llm_async(message, relevant_documents)
+    sources = build_sources(relevant_documents)
+    await asyncio.to_thread(
+        save_to_cache, message, answer, sources, embedding=question_vector,
+        date_key=date_key, relative_date=relative_date, embedded_text=contextual_query,
+        embedding_model=embedding_model
+    )
+    return {'response': answer, 'sources': sources, 'from_cache': False}
+
+
+async def answer_question_async(question, collection_name):
+    """Versión asíncrona de answer_question (app.py)"""
+    relevant_documents = await get_documents_async(collection_name, question)
+    answer = await query_llm_async(question, relevant_documents)
+    return {'answer': answer, 'documents_found': len(relevant_documents)}
+
+
+@app.route('/chat', methods=['POST'])
+async def chat():
+    """Mismo contrato que /chat en app.py"""
+    data = await request.get_json()
+    if 'message' not in data:
+        return jsonify({'error': 'Missing "message" in the request body'}), 400
+
+    message = data['message']
+    conversation_history = data.get('history', [])
+    collection_name = os.getenv('QDRANT_COLLECTION', 'ESCUELA-SABATICA')
+
+    try:
+        log.info("💬 Nueva pregunta (async): %s", message)
+        
+        message_lower = message.lower().strip()
+        if message_lower in SIMPLE_GREETINGS:
+            return jsonify({
+                'content': SIMPLE_GREETINGS[message_lower],
+                'response': SIMPLE_GREETINGS[message_lower],
+                'sources': [],
+                'from_cache': False,
+                'direct_response': True
+            }), 200
+        
+        contextual_query = build_contextual_query(message, conversation_history)
+        
+        # Fecha resuelta ("mañana" → ISO): forma parte de la clave del cache
+        date_key, relative_date = resolve_cache_date(contextual_query)
+        
+        cached_result = await asyncio.to_thread(get_cached_response, message, date_key=date_key)
+        if cached_result:
+            return jsonify({
+                'content': cached_result['response'],
+                'response': cached_result['response'],
+                'sources': cached_result.get('sources', []),
+                'from_cache': True
+            }), 200
+        
+        result, coalesced = await chat_flight.do_async(
+            flight_key('chat', collection_name, message, date_key),
+            lambda: answer_chat_async(message, contextual_query, collection_name, date_key, relative_date)
+        )
+        
+        return jsonify({
+            'content': result['response'],
+            'response': result['response'],
+            'sources': result['sources'],
+            'from_cache': result['from_cache'] or coalesced
+        }), 200
+    except Exception as e:
+        error_message = str(e)
+        log.exception("❌ Error en /chat (async): %s", error_message)
+        
+        quota_error = quota_error_payload(error_message)
+        if quota_error:
+            return jsonify(quota_error), 429
+        
+        return jsonify({'error': error_message}), 500
+
+
+@app.route('/health', methods=['GET'])
+async def health():
+    collection_name = os.getenv('QDRANT_COLLECTION', 'ESCUELA-SABATICA')
+    return jsonify({
+        'status': 'ok',
+        'port': os.environ.get('PORT', '5000'),
+        'qdrant_url': os.getenv('QDRANT_URL'),
+        'default_collection': collection_name,
+        'embedding_backend': get_embedding_backend(collection_name),
+        'embedding_cache': get_embedding_cache_stats(),
+        'response_cache': get_cache_stats(),
+        'semantic_cache': get_semantic_cache_stats(),
+        'context_packer': get_context_packer_stats(),
+        'lexical_index': get_lexical_index_stats(),
+        'vector_mirror': get_vector_mirror_stats(),
+        'model_router': model_router.get_stats(),
+        'hedging': get_hedging_stats(),
+        'single_flight': get_single_flight_stats(),
+        'logging': get_logging_stats(),
+        'rate_limiter': rate_limiter.get_stats(),
+        'server': 'asgi'
+    }), 200
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    """Latencias por etapa y contadores en formato Prometheus"""
+    return Response(render_metrics(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+@app.route('/upload', methods=['POST'])
+async def upload_file():
+    files = await request.files
+    if 'file' not in files:
+        return jsonify({'error': 'No se encontró archivo en la solicitud'}), 400
+
+    file = files['file']
+    if not file or file.filename == '':
+        return jsonify({'error': 'No se seleccionó ningún archivo'}), 400
+    
+    if not file.filename.endswith('.pdf'):
+        return jsonify({'error': 'Solo se permiten archivos PDF'}), 400
+    
+    try:
+        file_path = os.path.join('pdf_files', file.filename)
+        await file.save(file_path)
+        log.info("💾 Archivo guardado: %s", file_path)
+        
+        collection_name = os.getenv('QDRANT_COLLECTION', 'ESCUELA-SABATICA')
+        
+        # Misma cola acotada que app.py: la ingesta no compite con el event loop
+        job = ingestion_queue.submit(collection_name, file_path, file.filename)
+        
+        return jsonify({
+            'success': True,
+            'message': f'Archivo "{file.filename}" en cola para procesarse y agregarse a Qdrant',
+            'collection': collection_name,
+            'filename': file.filename,
+            'job_id': job.id,
+            'status': 'queued',
+            'status_url': f'/jobs/{job.id}'
+        }), 202
+        
+    except Exception as e:
+        log.exception("❌ Error procesando archivo: %s", e)
+        return jsonify({
+            'error': 'Error al procesar el archivo',
+            'details': str(e)
+        }), 500
+
+
+@app.route('/jobs/<string:job_id>', methods=['GET'])
+async def job_status(job_id):
+    job = ingestion_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict()), 200
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(
+        'asgi:app',
+        host='0.0.0.0',
+        port=int(os.environ.get('PORT', '5000')),
+        workers=int(os.getenv('ASGI_WORKERS', '1'))
+    )
@@ -0,0 +1,409 @@
+"""
+Benchmark de extremo a extremo del backend contra sustitutos locales.
+
+Ejecuta /chat, /ask y /upload (cliente de pruebas de Flask, varios hilos)
+con Gemini y Qdrant falsos (fake_services.py): sin red, sin cuota y con
+latencias controladas. Mide latencia p50/p95/p99 y throughput por endpoint y
+por etapa (cache, embedding, búsqueda, scroll, LLM, ingesta) y guarda el
+resultado en JSON para comparar corridas:
+
+    python benchmark.py --requests 200 --concurrency 8 --output antes.json
+    python benchmark.py --requests 200 --concurrency 8 --output despues.json
+    python benchmark.py --compare antes.json despues.json
+
+Corre en un directorio temporal para no tocar cache/ ni pdf_files/.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import functools
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BACKEND_DIR)
+
+from fake_services import FakeGemini, FakeQdrant, synthetic_lesson_pages, build_pdf
+
+COLLECTION = 'BENCHMARK'
+
+# Preguntas repetidas a propósito: ejercitan el cache exacto y el semántico
+QUESTION_POOL = [
+    '¿De qué trata la lección de hoy?',
+    '¿Qué dice la lección de mañana?',
+    '¿Qué estudiamos ayer?',
+    '¿De qué trata la lección 2?',
+    '¿Qué enseña la lección 4 sobre Acán?',
+    '¿Qué pasó en Jericó con Rahab?',
+    '¿Qué significa meditar en la ley según Josué?',
+    '¿Por qué las plagas cayeron sobre Egipto?',
+    '¿Qué representan las piedras del Jordán?',
+    '¿Cómo se relaciona la confesión con el pacto?',
+]
+
+
+class StageTimer:
+    """Envuelve funciones de los módulos del backend y registra su duración por etapa"""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+        self._patched = []
+
+    def record(self, stage, seconds, error=False):
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+            if error:
+                self.errors[stage] = self.errors.get(stage, 0) + 1
+
+    def wrap(self, module, name, stage):
+        original = getattr(module, name)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = original(*args, **kwargs)
+            except Exception:
+                self.record(stage, time.perf_counter() - start, error=True)
+                raise
+            self.record(stage, time.perf_counter() - start)
+            return result
+
+        setattr(module, name, timed)
+        self._patched.append((module, name, original))
+
+    def restore(self):
+        for module, name, original in reversed(self._patched):
+            setattr(module, name, original)
+        self._patched = []
+
+    def reset(self):
+        with self._lock:
+            self.samples = {}
+            self.errors = {}
+
+
+def summarize(samples, wall_seconds, errors=0) -> dict:
+    """Percentiles en milisegundos y throughput (llamadas por segundo de reloj)"""
+    values = np.asarray(samples, dtype=np.float64) * 1000
+    if not len(values):
+        return {'count': 0, 'errors': errors}
+    return {
+        'count': int(len(values)),
+        'errors': errors,
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p95_ms': round(float(np.percentile(values, 95)), 3),
+        'p99_ms': round(float(np.percentile(values, 99)), 3),
+        'mean_ms': round(float(values.mean()), 3),
+        'max_ms': round(float(values.max()), 3),
+        'throughput_per_s': round(len(values) / wall_seconds, 3) if wall_seconds else None
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR,
+            capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def setup_environment(args, qdrant):
+    """Variables de entorno antes de importar el backend (se leen al importar)"""
+    os.environ['QDRANT_URL'] = qdrant.url
+    os.environ['QDRANT_API_KEY'] = 'benchmark'
+    os.environ['QDRANT_COLLECTION'] = COLLECTION
+    os.environ['GEMINI_API_KEY'] = 'benchmark'
+    os.environ['VECTOR_MIRROR_ENABLED'] = 'false' if args.no_mirror else 'true'
+    os.environ['LEXICAL_INDEX_ENABLED'] = 'false' if args.no_lexical else 'true'
+    os.environ['LLM_CONTEXT_CACHE'] = 'false'
+    os.environ['LLM_HEDGE_ENABLED'] = 'true' if args.hedge else 'false'
+
+
+def wait_until_ready(collection, timeout=30):
+    """Espera a que el índice BM25 y el espejo vectorial terminen de construirse"""
+    from lexical_index import LEXICAL_INDEX_ENABLED, get_lexical_index
+    from vector_mirror import VECTOR_MIRROR_ENABLED, get_vector_mirror_stats
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        lexical_ready = not LEXICAL_INDEX_ENABLED or get_lexical_index(collection).ready
+        mirror_ready = not VECTOR_MIRROR_ENABLED or get_vector_mirror_stats().get(collection, {}).get('vectors')
+        if lexical_ready and mirror_ready:
+            return
+        time.sleep(0.05)
+    print("⚠️ El índice BM25 o el espejo vectorial no estuvieron listos a tiempo")
+
+
+def install_stage_timers(timer):
+    import app
+    import embeddings
+    import ingestion_jobs
+
+    timer.wrap(app, 'get_cached_response', 'cache')
+    timer.wrap(app, 'find_semantic_match', 'cache')
+    timer.wrap(app, 'save_to_cache', 'cache_write')
+    timer.wrap(app, 'embed_query', 'embedding')
+    timer.wrap(app, 'get_documents', 'search')
+    timer.wrap(app, 'query_llm', 'llm')
+    # get_documents calcula el embedding por su cuenta cuando no se lo pasan (/ask)
+    timer.wrap(embeddings, 'embed_query', 'embedding')
+    timer.wrap(embeddings, 'qdrant_request', 'qdrant_http')
+    timer.wrap(embeddings, 'find_page_by_date', 'scroll')
+    timer.wrap(embeddings, 'generate_embeddings_batch', 'embedding_batch')
+    timer.wrap(embeddings, 'upsert_points', 'upsert')
+    timer.wrap(ingestion_jobs, 'add_pdf_to_collection', 'ingestion')
+
+
+def run_chat(client, rng):
+    question = rng.choice(QUESTION_POOL)
+    history = []
+    if rng.random() < 0.3:
+        history = [{'role': 'user', 'content': rng.choice(QUESTION_POOL)},
+                   {'role': 'assistant', 'content': 'Respuesta anterior'}]
+    return client.post('/chat', json={'message': question, 'history': history})
+
+
+def run_ask(client, rng):
+    return client.post('/ask', json={'question': rng.choice(QUESTION_POOL)})
+
+
+def run_scenario(flask_app, name, func, total, concurrency, seed):
+    """Lanza total solicitudes con concurrency hilos; devuelve (latencias, códigos, segundos)"""
+    latencies = []
+    status_codes = {}
+    lock = threading.Lock()
+
+    def one(index):
+        rng = random.Random(seed * 100_003 + index)
+        client = flask_app.test_client()
+        start = time.perf_counter()
+        response = func(client, rng)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            status_codes[response.status_code] = status_codes.get(response.status_code, 0) + 1
+
+    print(f"🏁 {name}: {total} solicitudes, concurrencia {concurrency}")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total)))
+    return latencies, status_codes, time.perf_counter() - start
+
+
+def run_upload(flask_app, uploads, pages_per_pdf, seed):
+    """Sube PDFs sintéticos y espera a que cada trabajo de ingesta termine"""
+    from ingestion_jobs import ingestion_queue
+
+    latencies = []
+    status_codes = {}
+    job_ids = []
+    client = flask_app.test_client()
+    start = time.perf_counter()
+    for index in range(uploads):
+        pages = synthetic_lesson_pages(weeks=max(1, pages_per_pdf // 7 + 1), seed=seed + index)
+        pdf = build_pdf([page['content'] for page in pages[:pages_per_pdf]])
+        from io import BytesIO
+        request_start = time.perf_counter()
+        response = client.post('/upload', data={'file': (BytesIO(pdf), f'benchmark-{index}.pdf')},
+                               content_type='multipart/form-data')
+        latencies.append(time.perf_counter() - request_start)
+        status_codes[response.status_code] = status_codes.get(response.status_code, 0) + 1
+        if response.status_code == 202:
+            job_ids.append(response.get_json()['job_id'])
+
+    pending = set(job_ids)
+    failed = 0
+    while pending:
+        for job_id in list(pending):
+            job = ingestion_queue.get(job_id)
+            if job is None or job.status in ('done', 'failed'):
+                pending.discard(job_id)
+                failed += bool(job is None or job.status == 'failed')
+        time.sleep(0.02)
+    return latencies, status_codes, time.perf_counter() - start, failed
+
+
+def run_benchmark(args) -> dict:
+    qdrant = FakeQdrant(latency=args.qdrant_latency).start()
+    qdrant.seed_lessons(COLLECTION, weeks=args.weeks)
+    gemini = FakeGemini(embed_latency=args.embed_latency, llm_latency=args.llm_latency,
+                        error_rate=args.error_rate, seed=args.seed,
+                        slow_rate=args.llm_slow_rate, slow_factor=args.llm_slow_factor)
+
+    workdir = tempfile.mkdtemp(prefix='chatbot-benchmark-')
+    os.chdir(workdir)
+    setup_environment(args, qdrant)
+    gemini.install()
+
+    import app as backend_app
+    import llm
+    import embeddings
+    from rate_limiter import rate_limiter
+    from hedging import get_hedging_stats
+
+    if not args.real_rate_limits:
+        # Con límites reales el benchmark mide sobre todo las esperas de cuota
+        for model in list(llm.GEMINI_MODEL_LIMITS) + list(embeddings.EMBEDDING_MODELS):
+            rate_limiter.register_model(model, rpm=10**6)
+
+    wait_until_ready(COLLECTION)
+    timer = StageTimer()
+    install_stage_timers(timer)
+
+    results = {'endpoints': {}, 'stages': {}}
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    runners = {'chat': run_chat, 'ask': run_ask}
+    total_start = time.perf_counter()
+    try:
+        for scenario in scenarios:
+            timer.reset()
+            if scenario == 'upload':
+                latencies, status_codes, wall, failed = run_upload(
+                    backend_app.app, args.uploads, args.upload_pages, args.seed
+                )
+                summary = summarize(latencies, wall)
+                summary['jobs_failed'] = failed
+            elif scenario in runners:
+                latencies, status_codes, wall = run_scenario(
+                    backend_app.app, scenario, runners[scenario], args.requests, args.concurrency, args.seed
+                )
+                summary = summarize(latencies, wall)
+            else:
+                print(f"⚠️ Escenario desconocido: {scenario}")
+                continue
+
+            summary['status_codes'] = {str(code): count for code, count in sorted(status_codes.items())}
+            summary['wall_seconds'] = round(wall, 3)
+            results['endpoints'][scenario] = summary
+            results['stages'][scenario] = {
+                stage: summarize(samples, wall, timer.errors.get(stage, 0))
+                for stage, samples in sorted(timer.samples.items())
+            }
+    finally:
+        timer.restore()
+        gemini.uninstall()
+        qdrant.stop()
+
+    return {
+        'metadata': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'git_commit': git_commit(),
+            'python': sys.version.split()[0],
+            'total_seconds': round(time.perf_counter() - total_start, 3),
+            'config': {
+                'requests': args.requests,
+                'concurrency': args.concurrency,
+                'scenarios': scenarios,
+                'llm_latency': args.llm_latency,
+                'embed_latency': args.embed_latency,
+                'qdrant_latency': args.qdrant_latency,
+                'error_rate': args.error_rate,
+                'llm_slow_rate': args.llm_slow_rate,
+                'llm_slow_factor': args.llm_slow_factor,
+                'hedge': args.hedge,
+                'uploads': args.uploads,
+                'upload_pages': args.upload_pages,
+                'weeks': args.weeks,
+                'vector_mirror': not args.no_mirror,
+                'lexical_index': not args.no_lexical,
+                'real_rate_limits': args.real_rate_limits,
+                'seed': args.seed
+            }
+        },
+        'fakes': {'gemini': dict(gemini.stats), 'qdrant': dict(qdrant.stats)},
+        'hedging': get_hedging_stats(),
+        **results
+    }
+
+
+def print_report(report):
+    print(f"\n📊 Benchmark ({report['metadata']['git_commit'] or 'sin commit'})")
+    for scenario, summary in report['endpoints'].items():
+        if not summary.get('count'):
+            continue
+        print(f"\n/{scenario}: p50 {summary['p50_ms']} ms · p95 {summary['p95_ms']} ms · "
+              f"p99 {summary['p99_ms']} ms · {summary['throughput_per_s']} req/s · "
+              f"códigos {summary['status_codes']}")
+        for stage, stats in report['stages'].get(scenario, {}).items():
+            if stats.get('count'):
+                print(f"   {stage:<16} n={stats['count']:<5} p50 {stats['p50_ms']:>9} ms  "
+                      f"p95 {stats['p95_ms']:>9} ms  p99 {stats['p99_ms']:>9} ms  errores {stats['errors']}")
+
+
+def compare_reports(before_path, after_path):
+    """Diferencia de p50/p95/p99 y throughput entre dos corridas (negativo = más rápido)"""
+    with open(before_path, encoding='utf-8') as f:
+        before = json.load(f)
+    with open(after_path, encoding='utf-8') as f:
+        after = json.load(f)
+
+    def rows(section):
+        for scenario, summary in after.get(section, {}).items():
+            if section == 'endpoints':
+                yield f"/{scenario}", before.get(section, {}).get(scenario, {}), summary
+            else:
+                for stage, stats in summary.items():
+                    yield f"/{scenario} {stage}", before.get(section, {}).get(scenario, {}).get(stage, {}), stats
+
+    print(f"📊 {before['metadata'].get('git_commit')} → {after['metadata'].get('git_commit')}")
+    for section in ('endpoints', 'stages'):
+        for label, old, new in rows(section):
+            deltas = []
+            for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_per_s'):
+                if old.get(key) and new.get(key) is not None:
+                    change = (new[key] - old[key]) / old[key] * 100
+                    deltas.append(f"{key} {old[key]}→{new[key]} ({change:+.1f}%)")
+            if deltas:
+                print(f"   {label:<24} " + ' · '.join(deltas))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark del backend con Gemini y Qdrant falsos')
+    parser.add_argument('--requests', type=int, default=100, help='Solicitudes por escenario (chat, ask)')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--scenarios', default='chat,ask,upload')
+    parser.add_argument('--llm-latency', type=float, default=0.8, help='Segundos por respuesta del LLM')
+    parser.add_argument('--embed-latency', type=float, default=0.05, help='Segundos por llamada a embed_content')
+    parser.add_argument('--qdrant-latency', type=float, default=0.0, help='Segundos por solicitud a Qdrant')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probabilidad de 429 en Gemini')
+    parser.add_argument('--llm-slow-rate', type=float, default=0.0, help='Fracción de respuestas del LLM en la cola lenta')
+    parser.add_argument('--llm-slow-factor', type=float, default=5.0, help='Multiplicador de latencia de la cola lenta')
+    parser.add_argument('--uploads', type=int, default=2)
+    parser.add_argument('--upload-pages', type=int, default=40)
+    parser.add_argument('--weeks', type=int, default=6, help='Semanas de lecciones sembradas en Qdrant')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-mirror', action='store_true', help='Desactiva el espejo vectorial local')
+    parser.add_argument('--no-lexical', action='store_true', help='Desactiva el índice BM25')
+    parser.add_argument('--real-rate-limits', action='store_true', help='Mantiene los límites RPM/TPM de Gemini')
+    parser.add_argument('--hedge', action='store_true', help='Activa las coberturas del LLM (LLM_HEDGE_ENABLED)')
+    parser.add_argument('--output', help='Archivo JSON de resultados')
+    parser.add_argument('--compare', nargs=2, metavar=('ANTES', 'DESPUES'), help='Compara dos resultados')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_reports(*args.compare)
+        return
+
+    output = os.path.abspath(args.output) if args.output else None
+    report = run_benchmark(args)
+    print_report(report)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\n💾 Resultados guardados en {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,80 +1,407 @@
 """
-Simple cache para respuestas del LLM
+Cache para respuestas del LLM
 Evita llamadas repetidas a Gemini para las mismas preguntas
+
+El almacenamiento lo hace cache_engine.CacheEngine (LRU en memoria + SQLite
+con límites de entradas/bytes y barrido de expirados en segundo plano);
+este módulo expone las mismas funciones de siempre como envoltorios.
+
+Además del cache exacto (md5 de la pregunta) mantiene un nivel semántico:
+cada respuesta guarda el embedding de la pregunta y una búsqueda por vecino
+más cercano reutiliza respuestas de preguntas equivalentes escritas distinto
+("¿De qué trata la lección de hoy?" / "de que trata la leccion de hoy").
 """
 import json
 import os
+import re
 import hashlib
+import threading
 from datetime import datetime, timedelta
+import numpy as np
+from cache_engine import CacheEngine
+from metrics import span, count, CACHE_LOOKUPS
+from structured_logging import get_logger
+
+log = get_logger('cache')
 
 CACHE_DIR = 'cache'
-CACHE_EXPIRY_HOURS = 24
+# Vigencia de respuestas sin fecha relativa. Las preguntas con fecha relativa
+# (hoy, mañana...) llevan la fecha resuelta en la clave y expiran a medianoche,
+# así que las demás pueden vivir mucho más sin riesgo de respuestas de otro día
+CACHE_EXPIRY_HOURS = int(os.getenv('CACHE_EXPIRY_HOURS', '168'))
+
+# Similitud coseno mínima para considerar dos preguntas equivalentes
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.92'))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES', '5000'))
+SEMANTIC_CACHE_ENABLED = os.getenv('SEMANTIC_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
 
 # Crear directorio de cache si no existe
 os.makedirs(CACHE_DIR, exist_ok=True)
 
-def get_cache_key(question: str, num_docs: int = 5) -> str:
-    """Genera una clave de cache basada en la pregunta"""
+_engine = CacheEngine()
+
+
+def _migrate_legacy_files():
+    """Importa al motor los archivos JSON del cache anterior y los elimina"""
+    try:
+        files = [f for f in os.listdir(CACHE_DIR) if f.endswith('.json')]
+    except OSError:
+        return
+    migrated = 0
+    for file in files:
+        path = os.path.join(CACHE_DIR, file)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            created = datetime.fromisoformat(data['timestamp']).timestamp()
+            _engine.put(
+                file[:-5], data.get('question', ''), data['response'], data.get('sources', []),
+                embedding=data.get('embedding'), date_key=data.get('date_key'),
+                expires_at=created + CACHE_EXPIRY_HOURS * 3600
+            )
+            os.remove(path)
+            migrated += 1
+        except Exception as e:
+            log.warning("⚠️ No se pudo migrar %s: %s", file, e)
+    if migrated:
+        log.info("📦 %s respuestas migradas del cache JSON anterior", migrated)
+
+
+_migrate_legacy_files()
+
+# Números escritos con letra en preguntas por lección ("la lección cinco")
+_NUMBER_WORDS = {
+    'dos': 2, 'tres': 3, 'cuatro': 4, 'cinco': 5, 'seis': 6, 'siete': 7, 'ocho': 8,
+    'nueve': 9, 'diez': 10, 'once': 11, 'doce': 12, 'trece': 13
+}
+
+
+def question_numbers(text: str) -> str:
+    """
+    Números de una pregunta, ordenados y sin repetir ("5,12"). Preguntas que
+    solo difieren en el número ("lección 5" / "lección 6") tienen embeddings
+    casi iguales, así que el cache semántico exige que coincidan.
+    """
+    tokens = re.findall(r'\w+', (text or '').lower())
+    numbers = {int(t) for t in tokens if t.isdigit()}
+    numbers |= {_NUMBER_WORDS[t] for t in tokens if t in _NUMBER_WORDS}
+    return ','.join(str(n) for n in sorted(numbers))
+
+
+def get_cache_key(question: str, num_docs: int = 5, date_key: str = None) -> str:
+    """
+    Genera una clave de cache basada en la pregunta y, si la hay, en la fecha
+    resuelta ("¿y mañana?" el lunes y el martes son claves distintas)
+    """
     cache_string = f"{question.lower().strip()}_{num_docs}"
+    if date_key:
+        cache_string = f"{cache_string}_{date_key}"
     return hashlib.md5(cache_string.encode()).hexdigest()
 
-def get_cached_response(question: str) -> dict | None:
-    """Obtiene una respuesta del cache si existe y no ha expirado"""
-    cache_key = get_cache_key(question)
-    cache_file = os.path.join(CACHE_DIR, f"{cache_key}.json")
-    
-    if not os.path.exists(cache_file):
-        return None
+def next_midnight(now: datetime = None) -> float:
+    """Epoch del próximo cambio de día (hora local)"""
+    now = now or datetime.now()
+    tomorrow = (now + timedelta(days=1)).date()
+    return datetime.combine(tomorrow, datetime.min.time()).timestamp()
+
+@span('cache_lookup')
+def get_cached_response(question: str, date_key: str = None) -> dict | None:
+    """
+    Obtiene una respuesta del cache si existe y no ha expirado
+
+    Args:
+        date_key: Fecha resuelta de la pregunta (ISO) o None
+    """
+    cache_key = get_cache_key(question, date_key=date_key)
     
     try:
-        with open(cache_file, 'r', encoding='utf-8') as f:
-            cached_data = json.load(f)
-        
-        # Verificar si el cache ha expirado
-        cached_time = datetime.fromisoformat(cached_data['timestamp'])
-        if datetime.now() - cached_time > timedelta(hours=CACHE_EXPIRY_HOURS):
-            print(f"⏰ Cache expirado para: {question[:50]}...")
-            os.remove(cache_file)
+        entry = _engine.get(cache_key)
+        if entry is None:
+            count(CACHE_LOOKUPS, cache='exact', result='miss')
             return None
         
-        print(f"✅ Respuesta obtenida del cache para: {question[:50]}...")
+        count(CACHE_LOOKUPS, cache='exact', result='hit')
+        log.info("✅ Respuesta obtenida del cache para: %.50s...", question)
         # Devolver el diccionario completo con response y sources
         return {
-            'response': cached_data['response'],
-            'sources': cached_data.get('sources', [])
+            'response': entry['response'],
+            'sources': entry.get('sources', [])
         }
     
     except Exception as e:
-        print(f"⚠️ Error leyendo cache: {e}")
+        log.warning("⚠️ Error leyendo cache: %s", e)
         return None
 
-def save_to_cache(question: str, response: str, sources: list = None):
-    """Guarda una respuesta en el cache"""
-    cache_key = get_cache_key(question)
-    cache_file = os.path.join(CACHE_DIR, f"{cache_key}.json")
+def save_to_cache(question: str, response: str, sources: list = None,
+                  embedding: list = None, date_key: str = None, relative_date: bool = False,
+                  embedded_text: str = None, embedding_model: str = None):
+    """
+    Guarda una respuesta en el cache
+
+    Args:
+        embedding: Embedding de la pregunta (el mismo usado para la búsqueda);
+                   si se indica, la respuesta entra también al cache semántico
+        date_key: Fecha resuelta de la pregunta (ISO) o None; forma parte de la
+                  clave y el cache semántico solo empareja preguntas con la misma fecha
+        relative_date: La fecha depende del día actual (hoy, mañana...); la
+                       entrada expira en el próximo cambio de día
+        embedded_text: Texto del que sale 'embedding' (la query contextual);
+                       sus números también particionan el cache semántico
+        embedding_model: Modelo que generó 'embedding'; sin él la respuesta no
+                         entra al cache semántico (no se sabe en qué espacio está)
+    """
+    cache_key = get_cache_key(question, date_key=date_key)
+    numbers = question_numbers(embedded_text or question)
     
     try:
-        cache_data = {
-            'question': question,
-            'response': response,
-            'sources': sources or [],
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump(cache_data, f, ensure_ascii=False, indent=2)
+        _engine.put(
+            cache_key, question, response, sources or [],
+            ttl_seconds=CACHE_EXPIRY_HOURS * 3600,
+            embedding=embedding, date_key=date_key,
+            expires_at=next_midnight() if relative_date else None,
+            numbers=numbers, embedding_model=embedding_model
+        )
+
+        if embedding is not None and embedding_model:
+            _semantic_index(embedding_model).add(
+                cache_key, embedding, (date_key, numbers), datetime.now().timestamp()
+            )
         
-        print(f"💾 Respuesta guardada en cache")
+        log.info("💾 Respuesta guardada en cache")
     
     except Exception as e:
-        print(f"⚠️ Error guardando en cache: {e}")
+        log.warning("⚠️ Error guardando en cache: %s", e)
 
 def clear_cache():
     """Limpia todo el cache"""
     try:
-        for file in os.listdir(CACHE_DIR):
-            if file.endswith('.json'):
-                os.remove(os.path.join(CACHE_DIR, file))
-        print("🗑️ Cache limpiado")
+        _engine.clear()
+        with _semantic_indexes_lock:
+            indexes = list(_semantic_indexes.values())
+        for index in indexes:
+            index.clear()
+        log.info("🗑️ Cache limpiado")
     except Exception as e:
-        print(f"⚠️ Error limpiando cache: {e}")
+        log.warning("⚠️ Error limpiando cache: %s", e)
+
+
+class SemanticIndex:
+    """
+    Índice en memoria de (embedding normalizado, partición) -> clave de cache
+    para un modelo de embeddings. La partición es (fecha resuelta, números de
+    la pregunta): solo se comparan preguntas de la misma partición. La
+    búsqueda es un producto punto vectorizado contra las filas de esa
+    partición (máscara sobre un arreglo de ids de partición).
+
+    La matriz se reserva con capacidad que crece al doble, así agregar una
+    entrada no copia todo el índice; al quitar una fila se mueve la última
+    a su lugar.
+
+    Embeddings de modelos distintos no son comparables (otro espacio, a veces
+    otra dimensión), así que hay un índice por modelo (ver _semantic_index).
+    """
+
+    def __init__(self, embedding_model, max_entries=SEMANTIC_CACHE_MAX_ENTRIES):
+        self.embedding_model = embedding_model
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._clear_locked()
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _ensure_loaded(self):
+        """Reconstruye el índice desde el almacén en disco la primera vez"""
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            for entry in _engine.iter_embeddings():
+                # Las entradas sin modelo (anteriores a la columna) no se pueden
+                # comparar con seguridad y se ignoran
+                if entry['embedding_model'] != self.embedding_model:
+                    continue
+                # Entradas anteriores a la columna 'numbers': se toman de la pregunta
+                numbers = entry['numbers']
+                if numbers is None:
+                    numbers = question_numbers(entry['question'])
+                self._add_locked(entry['key'], entry['embedding'], (entry['date_key'], numbers),
+                                 entry['created_at'])
+        except Exception as e:
+            log.warning("⚠️ Error cargando el índice semántico: %s", e)
+
+    def _grow_locked(self, dimension):
+        """Duplica la capacidad de la matriz y de los arreglos paralelos"""
+        capacity = max(16, 2 * len(self._partition_ids))
+        matrix = np.empty((capacity, dimension), dtype=np.float32)
+        partition_ids = np.empty(capacity, dtype=np.int32)
+        timestamps = np.empty(capacity, dtype=np.float64)
+        if self._matrix is not None:
+            matrix[:self._count] = self._matrix[:self._count]
+            partition_ids[:self._count] = self._partition_ids[:self._count]
+            timestamps[:self._count] = self._timestamps[:self._count]
+        self._matrix, self._partition_ids, self._timestamps = matrix, partition_ids, timestamps
+
+    def _add_locked(self, key, embedding, partition, timestamp):
+        vector = self._normalize(embedding)
+        if self._matrix is not None and self._matrix.shape[1] != vector.shape[0]:
+            # Cambió la dimensión del modelo de embeddings: se descarta el índice anterior
+            self._clear_locked()
+        row = self._rows.get(key)
+        if row is None:
+            if self._matrix is None or self._count == len(self._partition_ids):
+                self._grow_locked(vector.shape[0])
+            row = self._count
+            self._count += 1
+            self._rows[key] = row
+            self._keys.append(key)
+        partition_id = self._partition_codes.setdefault(partition, len(self._partition_codes))
+        self._matrix[row] = vector
+        self._partition_ids[row] = partition_id
+        self._timestamps[row] = timestamp
+        while self._count > self.max_entries:
+            # Se desaloja la entrada más antigua
+            self._remove_locked(int(np.argmin(self._timestamps[:self._count])))
+
+    def _remove_locked(self, row):
+        """Quita una fila moviendo la última a su lugar"""
+        last = self._count - 1
+        del self._rows[self._keys[row]]
+        if row != last:
+            moved_key = self._keys[last]
+            self._keys[row] = moved_key
+            self._rows[moved_key] = row
+            self._matrix[row] = self._matrix[last]
+            self._partition_ids[row] = self._partition_ids[last]
+            self._timestamps[row] = self._timestamps[last]
+        self._keys.pop()
+        self._count = last
+
+    def _clear_locked(self):
+        self._rows = {}  # clave -> fila
+        self._keys = []  # fila -> clave
+        self._partition_codes = {}  # partición -> id entero
+        # Capacidad x dimensión (crece al doble); solo valen las primeras _count filas
+        self._matrix = None
+        self._partition_ids = np.empty(0, dtype=np.int32)
+        self._timestamps = np.empty(0, dtype=np.float64)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, key, embedding, partition, timestamp):
+        with self._lock:
+            self._ensure_loaded()
+            self._add_locked(key, embedding, partition, timestamp)
+
+    def discard(self, key):
+        with self._lock:
+            row = self._rows.get(key)
+            if row is not None:
+                self._remove_locked(row)
+
+    def clear(self):
+        with self._lock:
+            self._clear_locked()
+
+    def search(self, embedding, partition, threshold):
+        """Devuelve (clave, similitud) del vecino más cercano sobre el umbral, o None"""
+        with self._lock:
+            self._ensure_loaded()
+            # Solo preguntas con la misma fecha resuelta ("hoy" ≠ "mañana") y los
+            # mismos números ("lección 5" ≠ "lección 6")
+            partition_id = self._partition_codes.get(partition)
+            if partition_id is None or self._count == 0:
+                return None
+            query = self._normalize(embedding)
+            if query.shape[0] != self._matrix.shape[1]:
+                return None
+            rows = np.flatnonzero(self._partition_ids[:self._count] == partition_id)
+            if rows.size == 0:
+                return None
+            similarities = self._matrix[rows] @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < threshold:
+                return None
+            return self._keys[rows[best]], float(similarities[best])
+
+
+_semantic_indexes = {}
+_semantic_indexes_lock = threading.Lock()
+_semantic_stats = {'hits': 0, 'misses': 0}
+
+
+def _semantic_index(embedding_model: str) -> SemanticIndex:
+    """Índice semántico del modelo de embeddings, creado la primera vez que se usa"""
+    with _semantic_indexes_lock:
+        index = _semantic_indexes.get(embedding_model)
+        if index is None:
+            index = _semantic_indexes[embedding_model] = SemanticIndex(embedding_model)
+        return index
+
+
+@span('semantic_cache_lookup')
+def find_semantic_match(embedding: list, date_key: str = None,
+                        threshold: float = None, embedded_text: str = None,
+                        embedding_model: str = None) -> dict | None:
+    """
+    Busca una respuesta cacheada para una pregunta semánticamente equivalente.
+
+    Args:
+        embedding: Embedding de la pregunta (reutiliza el de la búsqueda en Qdrant)
+        date_key: Fecha resuelta de la pregunta (ISO) o None
+        threshold: Similitud coseno mínima (por defecto SEMANTIC_CACHE_THRESHOLD)
+        embedded_text: Texto del que sale 'embedding'; sus números deben
+                       coincidir con los de la pregunta cacheada
+        embedding_model: Modelo que generó 'embedding'; solo se compara con
+                         preguntas cacheadas con el mismo modelo
+    """
+    if not SEMANTIC_CACHE_ENABLED or embedding is None or not embedding_model:
+        return None
+
+    threshold = SEMANTIC_CACHE_THRESHOLD if threshold is None else threshold
+    partition = (date_key, question_numbers(embedded_text))
+    index = _semantic_index(embedding_model)
+    match = index.search(embedding, partition, threshold)
+    if match is None:
+        _semantic_stats['misses'] += 1
+        count(CACHE_LOOKUPS, cache='semantic', result='miss')
+        return None
+
+    cache_key, similarity = match
+    entry = _engine.get(cache_key)
+    if entry is None:
+        # Expirada o desalojada por el motor: se saca del índice
+        index.discard(cache_key)
+        _semantic_stats['misses'] += 1
+        count(CACHE_LOOKUPS, cache='semantic', result='miss')
+        return None
+
+    _semantic_stats['hits'] += 1
+    count(CACHE_LOOKUPS, cache='semantic', result='hit')
+    log.info("✅ Respuesta del cache semántico (similitud %.3f): %.50s...", similarity, entry['question'])
+    return {
+        'response': entry['response'],
+        'sources': entry.get('sources', []),
+        'similarity': similarity
+    }
+
+
+def get_semantic_cache_stats() -> dict:
+    stats = dict(_semantic_stats)
+    with _semantic_indexes_lock:
+        indexes = list(_semantic_indexes.values())
+    stats['entries'] = sum(len(index) for index in indexes)
+    stats['models'] = [index.embedding_model for index in indexes]
+    stats['threshold'] = SEMANTIC_CACHE_THRESHOLD
+    return stats
+
+
+def get_cache_stats() -> dict:
+    """Estadísticas del motor de cache (niveles, límites y desalojos)"""
+    return _engine.get_stats()
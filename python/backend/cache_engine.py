@@ -0,0 +1,363 @@
+"""
+Motor del cache de respuestas del LLM.
+
+Dos niveles:
+1. Nivel caliente: LRU en memoria con las entradas más usadas
+2. Almacén en disco: SQLite indexado por clave, expiración y último acceso
+
+Límites de número de entradas y de bytes; al superarlos se desalojan las
+entradas menos usadas. Un hilo en segundo plano elimina periódicamente las
+entradas expiradas, aunque nadie vuelva a preguntarlas, y barre de inmediato
+cuando una escritura supera los límites.
+
+Los aciertos en memoria también cuentan como uso: su hora de acceso se
+acumula y se escribe en lotes, así las respuestas más populares (que casi
+nunca se leen de disco) no son las primeras en desalojarse.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from structured_logging import get_logger
+
+CACHE_DB_PATH = os.getenv('CACHE_DB_PATH', os.path.join('cache', 'responses.db'))
+CACHE_HOT_ENTRIES = int(os.getenv('CACHE_HOT_ENTRIES', '256'))
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '10000'))
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', str(50 * 1024 * 1024)))
+CACHE_SWEEP_INTERVAL = float(os.getenv('CACHE_SWEEP_INTERVAL', '300'))
+# Accesos en memoria acumulados antes de escribir su last_access en SQLite
+CACHE_ACCESS_FLUSH_SIZE = int(os.getenv('CACHE_ACCESS_FLUSH_SIZE', '64'))
+
+log = get_logger('cache_engine')
+
+
+class CacheEngine:
+    def __init__(self, db_path=CACHE_DB_PATH, hot_entries=CACHE_HOT_ENTRIES,
+                 max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES,
+                 sweep_interval=CACHE_SWEEP_INTERVAL):
+        self.db_path = db_path
+        self.hot_entries = max(1, hot_entries)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._hot = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._sweeper = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._pending_access = {}  # clave -> último acceso en memoria aún no escrito
+        self.stats = {
+            'hot_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'evicted': 0,
+        }
+
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, '
+                'question TEXT, '
+                'response TEXT, '
+                'sources TEXT, '
+                'embedding BLOB, '
+                'date_key TEXT, '
+                'numbers TEXT, '
+                'embedding_model TEXT, '
+                'created_at REAL, '
+                'expires_at REAL, '
+                'last_access REAL, '
+                'size INTEGER)'
+            )
+            # Columnas agregadas después de la primera versión del esquema
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(responses)')}
+            for column, column_type in (('numbers', 'TEXT'), ('embedding_model', 'TEXT')):
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE responses ADD COLUMN {column} {column_type}')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_expires ON responses (expires_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_access ON responses (last_access)')
+            # Totales aproximados para detectar en put() que se superaron los límites
+            # (un reemplazo los sobrestima; el barrido los corrige)
+            self._entries, self._bytes = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses'
+            ).fetchone()
+
+    def _connect(self):
+        # Una conexión por hilo: sqlite3 no permite compartirlas entre hilos
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _row_to_entry(row):
+        key, question, response, sources, embedding, date_key, created_at, expires_at = row
+        entry = {
+            'key': key,
+            'question': question,
+            'response': response,
+            'sources': json.loads(sources or '[]'),
+            'date_key': date_key,
+            'created_at': created_at,
+            'expires_at': expires_at,
+            'embedding': None,
+        }
+        if embedding:
+            vector = array('f')
+            vector.frombytes(embedding)
+            entry['embedding'] = vector.tolist()
+        return entry
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._hot[key] = entry
+            self._hot.move_to_end(key)
+            while len(self._hot) > self.hot_entries:
+                self._hot.popitem(last=False)
+
+    def _forget(self, key):
+        with self._lock:
+            self._hot.pop(key, None)
+            self._pending_access.pop(key, None)
+
+    def _flush_access(self):
+        """Escribe en SQLite el last_access de los aciertos en memoria acumulados"""
+        with self._lock:
+            pending, self._pending_access = self._pending_access, {}
+        if not pending:
+            return
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                'UPDATE responses SET last_access = ? WHERE key = ?',
+                [(accessed, key) for key, accessed in pending.items()]
+            )
+
+    def get(self, key):
+        """Entrada vigente para 'key' (dict) o None si no existe o expiró"""
+        now = time.time()
+
+        with self._lock:
+            entry = self._hot.get(key)
+            if entry is not None:
+                if entry['expires_at'] > now:
+                    self._hot.move_to_end(key)
+                    self.stats['hot_hits'] += 1
+                    self._pending_access[key] = now
+                    flush = len(self._pending_access) >= CACHE_ACCESS_FLUSH_SIZE
+                else:
+                    self._hot.pop(key, None)
+                    entry = None
+        if entry is not None:
+            if flush:
+                self._flush_access()
+            return entry
+
+        row = self._connect().execute(
+            'SELECT key, question, response, sources, embedding, date_key, created_at, expires_at '
+            'FROM responses WHERE key = ?', (key,)
+        ).fetchone()
+
+        if row is None:
+            with self._lock:
+                self.stats['misses'] += 1
+            return None
+
+        entry = self._row_to_entry(row)
+        conn = self._connect()
+        if entry['expires_at'] <= now:
+            with conn:
+                conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+            with self._lock:
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+            return None
+
+        with conn:
+            conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+        self._remember(key, entry)
+        with self._lock:
+            self.stats['disk_hits'] += 1
+        return entry
+
+    def put(self, key, question, response, sources=None, ttl_seconds=24 * 3600,
+            embedding=None, date_key=None, expires_at=None, numbers=None, embedding_model=None):
+        """
+        Guarda (o reemplaza) una entrada.
+
+        Args:
+            ttl_seconds: Vigencia desde ahora
+            expires_at: Fecha de expiración absoluta (epoch); tiene prioridad sobre ttl_seconds
+            numbers: Números de la pregunta embebida (partición del cache semántico)
+            embedding_model: Modelo que produjo 'embedding'
+        """
+        now = time.time()
+        expires_at = expires_at if expires_at is not None else now + ttl_seconds
+        sources_json = json.dumps(sources or [], ensure_ascii=False)
+        embedding_blob = array('f', embedding).tobytes() if embedding is not None else None
+        size = (len(question.encode('utf-8')) + len(response.encode('utf-8'))
+                + len(sources_json.encode('utf-8')) + len(embedding_blob or b''))
+
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO responses '
+                '(key, question, response, sources, embedding, date_key, numbers, embedding_model, '
+                'created_at, expires_at, last_access, size) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, question, response, sources_json, embedding_blob, date_key, numbers,
+                 embedding_model, now, expires_at, now, size)
+            )
+
+        self._remember(key, {
+            'key': key,
+            'question': question,
+            'response': response,
+            'sources': sources or [],
+            'date_key': date_key,
+            'created_at': now,
+            'expires_at': expires_at,
+            'embedding': list(embedding) if embedding is not None else None,
+        })
+        with self._lock:
+            self._entries += 1
+            self._bytes += size
+            over_limits = self._entries > self.max_entries or self._bytes > self.max_bytes
+        self._ensure_sweeper()
+        if over_limits:
+            # Desalojo sin esperar al próximo intervalo del barrido
+            self._wake.set()
+
+    def delete(self, key):
+        self._forget(key)
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._lock:
+            self._hot.clear()
+            self._pending_access.clear()
+            self._entries = self._bytes = 0
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM responses')
+
+    def iter_embeddings(self):
+        """
+        Entradas vigentes con embedding, como dicts con key, question,
+        embedding, date_key, numbers, embedding_model y created_at
+        """
+        rows = self._connect().execute(
+            'SELECT key, question, embedding, date_key, numbers, embedding_model, created_at '
+            'FROM responses WHERE embedding IS NOT NULL AND expires_at > ?', (time.time(),)
+        ).fetchall()
+        for key, question, blob, date_key, numbers, embedding_model, created_at in rows:
+            vector = array('f')
+            vector.frombytes(blob)
+            yield {
+                'key': key,
+                'question': question,
+                'embedding': vector.tolist(),
+                'date_key': date_key,
+                'numbers': numbers,
+                'embedding_model': embedding_model,
+                'created_at': created_at,
+            }
+
+    def sweep(self):
+        """
+        Elimina las entradas expiradas y desaloja las menos usadas hasta
+        cumplir max_entries y max_bytes.
+
+        Returns:
+            (expiradas, desalojadas)
+        """
+        now = time.time()
+        # Antes de elegir víctimas por last_access
+        self._flush_access()
+        conn = self._connect()
+        with conn:
+            expired = conn.execute('DELETE FROM responses WHERE expires_at <= ?', (now,)).rowcount
+
+            count, total_bytes = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses'
+            ).fetchone()
+
+            evicted = 0
+            if count > self.max_entries or total_bytes > self.max_bytes:
+                rows = conn.execute(
+                    'SELECT key, size FROM responses ORDER BY last_access ASC'
+                ).fetchall()
+                victims = []
+                for key, size in rows:
+                    if count <= self.max_entries and total_bytes <= self.max_bytes:
+                        break
+                    victims.append((key,))
+                    count -= 1
+                    total_bytes -= size or 0
+                conn.executemany('DELETE FROM responses WHERE key = ?', victims)
+                evicted = len(victims)
+                for (key,) in victims:
+                    self._forget(key)
+
+        with self._lock:
+            self._entries, self._bytes = count, total_bytes
+            self.stats['expired'] += expired
+            self.stats['evicted'] += evicted
+            for key in [k for k, e in self._hot.items() if e['expires_at'] <= now]:
+                self._hot.pop(key, None)
+
+        if expired or evicted:
+            log.info("🧹 Cache: %s entradas expiradas y %s desalojadas", expired, evicted)
+        return expired, evicted
+
+    def _sweep_loop(self):
+        while not self._stop.is_set():
+            # Cada sweep_interval, o antes si put() superó los límites
+            self._wake.wait(self.sweep_interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.sweep()
+            except Exception as e:
+                log.warning("⚠️ Error en el barrido del cache: %s", e)
+
+    def _ensure_sweeper(self):
+        """Arranca (una vez por proceso) el hilo de barrido en segundo plano"""
+        if self._sweeper is not None and self._sweeper.is_alive():
+            return
+        with self._lock:
+            if self._sweeper is not None and self._sweeper.is_alive():
+                return
+            self._sweeper = threading.Thread(
+                target=self._sweep_loop, name='cache-sweeper', daemon=True
+            )
+            self._sweeper.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def get_stats(self) -> dict:
+        count, total_bytes = self._connect().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses'
+        ).fetchone()
+        with self._lock:
+            stats = dict(self.stats)
+            stats['hot_entries'] = len(self._hot)
+        stats['entries'] = count
+        stats['bytes'] = total_bytes
+        stats['max_entries'] = self.max_entries
+        stats['max_bytes'] = self.max_bytes
+        return stats
@@ -0,0 +1,134 @@
+"""
+Piezas de /chat y /ask compartidas por app.py (Flask) y asgi.py (Quart).
+
+Viven aparte para que el modo ASGI no importe app.py, que al importarse crea
+la app de Flask y arranca sus hilos de fondo.
+"""
+from cache import get_cache_key
+from metrics import span
+from structured_logging import get_logger
+
+log = get_logger('chat')
+
+# Colecciones creadas con /build_chatbot (las consulta /ask_chatbot/<id>)
+chatbot_status = {}
+
+
+# Respuestas directas para saludos y mensajes simples (sin llamadas API)
+SIMPLE_GREETINGS = {
+    'hola': '¡Hola! Soy tu asistente de la Escuela Sabática. ¿En qué puedo ayudarte hoy?',
+    'hello': 'Hello! I am your Sabbath School assistant. How can I help you today?',
+    'hi': 'Hi! How can I assist you with Sabbath School today?',
+    'buenos días': '¡Buenos días! ¿En qué puedo ayudarte con la Escuela Sabática?',
+    'buenas tardes': '¡Buenas tardes! ¿En qué te puedo ayudar?',
+    'buenas noches': '¡Buenas noches! ¿Tienes alguna pregunta sobre la Escuela Sabática?',
+    'gracias': '¡De nada! Estoy aquí para ayudarte.',
+    'thank you': 'You\'re welcome! I\'m here to help.',
+    'thanks': 'You\'re welcome!',
+    'adiós': '¡Hasta luego! Que tengas un buen día.',
+    'bye': 'Goodbye! Have a great day!',
+    'chao': '¡Chao! Vuelve pronto si tienes más preguntas.'
+}
+
+# Palabras temporales que indican que la pregunta ya tiene contexto temporal completo
+TEMPORAL_KEYWORDS = ['hoy', 'mañana', 'ayer', 'pasado', 'antes', 'lunes', 'martes', 
+                     'miércoles', 'jueves', 'viernes', 'sábado', 'domingo',
+                     'enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio',
+                     'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre']
+
+
+@span('contextual_query')
+def build_contextual_query(message, conversation_history):
+    """
+    Construir query contextual con historial reciente
+    Priorizar la pregunta actual pero incluir contexto si es una pregunta de seguimiento
+    """
+    contextual_query = message
+    
+    message_lower = message.lower()
+    has_temporal_keyword = any(keyword in message_lower for keyword in TEMPORAL_KEYWORDS)
+    
+    if conversation_history and len(conversation_history) > 0:
+        # Tomar los últimos 10 mensajes para contexto
+        recent_messages = conversation_history[-10:] if len(conversation_history) >= 10 else conversation_history
+        context_parts = []
+        for msg in recent_messages:
+            if msg.get('role') == 'user':
+                context_parts.append(msg.get('content', ''))
+        
+        # Si hay contexto previo y la pregunta actual es corta (probablemente de seguimiento)
+        # PERO NO tiene palabras temporales (para evitar conflictos como "hoy" vs "mañana")
+        if context_parts and len(message.split()) < 8 and not has_temporal_keyword:
+            # Combinar los últimos 2 mensajes del usuario con más peso en la pregunta actual
+            recent_context = ' '.join(context_parts[-2:])
+            contextual_query = f"{message} {recent_context}"
+            log.info("🔗 Query contextual (pregunta corta sin palabras temporales): %s", contextual_query)
+            
+            # IMPORTANTE: Si la pregunta corta menciona un día/número sin mes (ej: "y la del 31")
+            # Intentar extraer el mes del contexto previo
+            import re
+            meses = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 
+                     'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre']
+            
+            # Buscar número de día en la pregunta actual (ej: "31", "del 31", "el 31")
+            dia_match = re.search(r'\b(\d{1,2})\b', message.lower())
+            
+            # Buscar mes en el contexto previo
+            mes_match = None
+            for mes in meses:
+                if mes in recent_context.lower():
+                    mes_match = mes
+                    break
+            
+            # Si encontramos día en pregunta actual y mes en contexto previo
+            if dia_match and mes_match:
+                dia_numero = dia_match.group(1)
+                # Enriquecer el query contextual con fecha completa
+                contextual_query = f"{message} {dia_numero} de {mes_match}"
+                log.info("📅 Fecha detectada del contexto: %s de %s", dia_numero, mes_match)
+                log.info("🔗 Query enriquecido con fecha: %s", contextual_query)
+        elif has_temporal_keyword:
+            # Si tiene palabra temporal, usar SOLO el mensaje actual sin contexto
+            log.info("🔗 Query con palabra temporal detectada: '%s' (sin contexto adicional)", message)
+        else:
+            log.info("🔗 Query simple: %s", message)
+
+    return contextual_query
+
+
+def build_sources(relevant_documents):
+    """Extraer contenido de los documentos (pueden ser objetos Document de LangChain)"""
+    sources = []
+    if relevant_documents:
+        for i, doc in enumerate(relevant_documents[:3]):
+            # Si es un objeto Document, extraer page_content
+            if hasattr(doc, 'page_content'):
+                content = doc.page_content
+            # Si es string, usar directamente
+            elif isinstance(doc, str):
+                content = doc
+            else:
+                content = str(doc)
+            
+            sources.append({
+                'title': f'Documento {i+1}',
+                'snippet': content[:200] + '...' if len(content) > 200 else content,
+                'url': ''
+            })
+    return sources
+
+
+def quota_error_payload(error_message):
+    """Mensaje amigable para límite de cuota, o None si el error es de otro tipo"""
+    if "429" in error_message or "Resource exhausted" in error_message or "cuota" in error_message.lower():
+        return {
+            'error': 'Límite de cuota de Gemini alcanzado',
+            'message': 'Has alcanzado el límite de solicitudes por minuto. Por favor, espera un momento e intenta nuevamente, o cambia al modelo n8n.',
+            'details': error_message
+        }
+    return None
+
+
+def flight_key(kind, collection_name, question, date_key=None):
+    """Clave de coalescencia: la del cache de respuestas más la colección"""
+    return f"{kind}:{collection_name}:{get_cache_key(question, date_key=date_key)}"
@@ -0,0 +1,208 @@
+"""
+Empaquetado del MATERIAL DISPONIBLE con presupuesto de tokens.
+
+En vez de concatenar las páginas completas de todos los documentos
+relevantes, se parten en pasajes (párrafos), se descartan los casi
+duplicados (la misma página subida dos veces, encabezados repetidos) y se
+eligen los pasajes con mejor puntuación hasta llenar el presupuesto. Los
+pasajes elegidos se devuelven en su orden original para que el texto siga
+leyéndose como la lección.
+
+Cada página que aporta pasajes conserva su encabezado ("Lección X | Día N
+de Mes", la primera línea): el prompt se apoya en él para responder una sola
+fecha, y un pasaje sin su encabezado quedaría bajo el de otra página. Si el
+primer pasaje de la página no se eligió, su primera línea se antepone y
+cuenta para el presupuesto.
+
+La puntuación combina la posición del documento en el ranking de búsqueda
+(el primero suele ser la coincidencia exacta de fecha) con el solapamiento
+de palabras entre el pasaje y la pregunta.
+"""
+import os
+import re
+import threading
+import unicodedata
+from rate_limiter import estimate_tokens
+from structured_logging import get_logger
+
+CONTEXT_PACKER_ENABLED = os.getenv('CONTEXT_PACKER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Tokens máximos del MATERIAL DISPONIBLE por solicitud
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000'))
+# Similitud de Jaccard (trigramas de palabras) a partir de la cual un pasaje es duplicado
+CONTEXT_DUPLICATE_THRESHOLD = float(os.getenv('CONTEXT_DUPLICATE_THRESHOLD', '0.8'))
+# Los pasajes más largos se parten por líneas u oraciones (PyPDF2 rara vez deja párrafos)
+MAX_PASSAGE_CHARS = 1200
+
+# Peso del ranking de búsqueda frente al solapamiento con la pregunta
+RANK_WEIGHT = 1.0
+# Bono para el primer pasaje de cada página ("Lección X | Sábado 18 de octubre")
+HEADER_BONUS = 0.3
+
+_STOPWORDS = {
+    'a', 'al', 'como', 'con', 'cual', 'de', 'del', 'dice', 'el', 'en', 'es', 'esta', 'este',
+    'la', 'las', 'le', 'lo', 'los', 'me', 'mi', 'para', 'por', 'que', 'se', 'si', 'sobre',
+    'su', 'sus', 'trata', 'un', 'una', 'y', 'o', 'hoy', 'leccion'
+}
+_WORD_PATTERN = re.compile(r'\w+')
+_SENTENCE_PATTERN = re.compile(r'(?<=[.!?])\s+')
+
+log = get_logger('context_packer')
+
+_stats = {'requests': 0, 'tokens_in': 0, 'tokens_out': 0, 'duplicates_dropped': 0}
+_stats_lock = threading.Lock()
+
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+
+def _terms(text: str) -> set:
+    return {w for w in _WORD_PATTERN.findall(_normalize(text)) if w not in _STOPWORDS and len(w) > 2}
+
+
+def _shingles(text: str) -> set:
+    words = _WORD_PATTERN.findall(_normalize(text))
+    if len(words) < 3:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + 3]) for i in range(len(words) - 2)}
+
+
+def _units(paragraph: str) -> list:
+    """Líneas del párrafo; las líneas muy largas se parten por oraciones"""
+    units = []
+    for line in paragraph.split('\n'):
+        if len(line) <= MAX_PASSAGE_CHARS:
+            units.append(line)
+        else:
+            units.extend(s for s in _SENTENCE_PATTERN.split(line) if s)
+    return units
+
+
+def split_passages(content: str) -> list:
+    """Parte una página en párrafos, y los párrafos largos en grupos de líneas u oraciones"""
+    passages = []
+    for paragraph in re.split(r'\n\s*\n', content):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= MAX_PASSAGE_CHARS:
+            passages.append(paragraph)
+            continue
+        current = ''
+        for unit in _units(paragraph):
+            if current and len(current) + len(unit) + 1 > MAX_PASSAGE_CHARS:
+                passages.append(current)
+                current = ''
+            current = f"{current}\n{unit}" if current else unit
+        if current:
+            passages.append(current)
+    return passages
+
+
+def page_header(content: str) -> str:
+    """Primera línea no vacía de la página ("Lección 3 | Domingo 12 de octubre")"""
+    return next((line.strip() for line in content.split('\n') if line.strip()), '')
+
+
+def pack_context(question, documents, token_budget=None) -> tuple:
+    """
+    Arma el texto del MATERIAL DISPONIBLE dentro de un presupuesto de tokens.
+
+    Args:
+        question: Pregunta del usuario (para puntuar los pasajes)
+        documents: Documentos relevantes en orden de ranking
+        token_budget: Tokens máximos (por defecto CONTEXT_TOKEN_BUDGET)
+
+    Returns:
+        (texto, estadísticas) con tokens de entrada/salida, ahorrados y
+        pasajes usados/descartados
+    """
+    token_budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    full_text = ''.join(document.content + '\n\n' for document in documents or [])
+    tokens_in = estimate_tokens(full_text) if full_text else 0
+
+    if not CONTEXT_PACKER_ENABLED or not full_text.strip():
+        return full_text, {'tokens_in': tokens_in, 'tokens_out': tokens_in, 'tokens_saved': 0}
+
+    question_terms = _terms(question or '')
+    candidates = []
+    headers = {}
+    for doc_rank, document in enumerate(documents):
+        header = page_header(document.content)
+        headers[doc_rank] = (header, estimate_tokens(header) if header else 0)
+        for position, passage in enumerate(split_passages(document.content)):
+            overlap = len(question_terms & _terms(passage)) / len(question_terms) if question_terms else 0
+            score = RANK_WEIGHT / (1 + doc_rank) + overlap + (HEADER_BONUS if position == 0 else 0)
+            candidates.append({
+                'order': (doc_rank, position),
+                'text': passage,
+                'tokens': estimate_tokens(passage),
+                'score': score
+            })
+
+    selected = []
+    selected_shingles = []
+    headed_docs = set()  # páginas cuyo encabezado ya está pagado
+    used_tokens = 0
+    duplicates = 0
+    for candidate in sorted(candidates, key=lambda c: c['score'], reverse=True):
+        doc_rank, position = candidate['order']
+        cost = candidate['tokens']
+        if position != 0 and doc_rank not in headed_docs:
+            cost += headers[doc_rank][1]
+        if used_tokens + cost > token_budget:
+            continue
+        shingles = _shingles(candidate['text'])
+        if any(len(shingles & other) / len(shingles | other) >= CONTEXT_DUPLICATE_THRESHOLD
+               for other in selected_shingles):
+            duplicates += 1
+            continue
+        selected.append(candidate)
+        selected_shingles.append(shingles)
+        headed_docs.add(doc_rank)
+        used_tokens += cost
+
+    # Orden original: documento por documento, pasaje por pasaje, cada página
+    # bajo su propio encabezado
+    selected.sort(key=lambda c: c['order'])
+    parts = []
+    last_doc = None
+    for candidate in selected:
+        doc_rank, position = candidate['order']
+        if doc_rank != last_doc:
+            if last_doc is not None:
+                parts.append('')
+            header = headers[doc_rank][0]
+            if position != 0 and header:
+                parts.append(header)
+        parts.append(candidate['text'])
+        last_doc = doc_rank
+    text = '\n'.join(parts) + '\n\n' if parts else ''
+
+    tokens_out = estimate_tokens(text) if text else 0
+    stats = {
+        'tokens_in': tokens_in,
+        'tokens_out': tokens_out,
+        'tokens_saved': max(0, tokens_in - tokens_out),
+        'passages_used': len(selected),
+        'passages_total': len(candidates),
+        'duplicates_dropped': duplicates
+    }
+    with _stats_lock:
+        _stats['requests'] += 1
+        _stats['tokens_in'] += tokens_in
+        _stats['tokens_out'] += tokens_out
+        _stats['duplicates_dropped'] += duplicates
+    log.info("📦 Material: %s/%s tokens (%s/%s pasajes, %s duplicados, %s tokens ahorrados)",
+             tokens_out, tokens_in, len(selected), len(candidates), duplicates, stats['tokens_saved'])
+    return text, stats
+
+
+def get_context_packer_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['tokens_saved'] = stats['tokens_in'] - stats['tokens_out']
+    stats['token_budget'] = CONTEXT_TOKEN_BUDGET
+    stats['enabled'] = CONTEXT_PACKER_ENABLED
+    return stats
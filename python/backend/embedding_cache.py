@@ -0,0 +1,155 @@
+"""
+Cache de embeddings de consultas en dos niveles:
+1. LRU en memoria del proceso (tamaño acotado)
+2. Almacén persistente opcional en SQLite que sobrevive reinicios
+
+La clave es (modelo, task_type, texto normalizado), de modo que la misma
+pregunta enriquecida no vuelve a pagar la llamada a la API de embeddings.
+"""
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from structured_logging import get_logger
+
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', '2048'))
+EMBEDDING_CACHE_PERSIST = os.getenv('EMBEDDING_CACHE_PERSIST', 'true').lower() in ('1', 'true', 'yes')
+EMBEDDING_CACHE_DB = os.getenv('EMBEDDING_CACHE_DB', os.path.join('cache', 'embeddings.db'))
+
+log = get_logger('embedding_cache')
+
+
+def normalize_text(text: str) -> str:
+    """Normaliza el texto para la clave: Unicode NFC, minúsculas y espacios colapsados"""
+    text = unicodedata.normalize('NFC', text or '')
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+
+def make_key(model: str, task_type, text: str) -> str:
+    """Clave estable para (modelo, task_type, texto normalizado)"""
+    raw = f"{model}\x1f{task_type or ''}\x1f{normalize_text(text)}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, max_entries=EMBEDDING_CACHE_MAX_ENTRIES, db_path=None):
+        self.max_entries = max(1, max_entries)
+        self.db_path = db_path
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.stats = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'stores': 0,
+        }
+
+        if self.db_path:
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            with self._connect() as conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS embeddings ('
+                    'key TEXT PRIMARY KEY, model TEXT, task_type TEXT, vector BLOB)'
+                )
+
+    def _connect(self):
+        # Una conexión por hilo: sqlite3 no permite compartirlas entre hilos
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key, vector):
+        with self._lock:
+            self._lru[key] = vector
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+
+    def get(self, model: str, task_type, text: str):
+        """Devuelve el vector cacheado o None si no existe en ningún nivel"""
+        key = make_key(model, task_type, text)
+
+        with self._lock:
+            vector = self._lru.get(key)
+            if vector is not None:
+                self._lru.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return list(vector)
+
+        if self.db_path:
+            try:
+                row = self._connect().execute(
+                    'SELECT vector FROM embeddings WHERE key = ?', (key,)
+                ).fetchone()
+            except sqlite3.Error as e:
+                log.warning("⚠️ Error leyendo cache de embeddings: %s", e)
+                row = None
+            if row:
+                vector = array('f')
+                vector.frombytes(row[0])
+                self._remember(key, vector)
+                with self._lock:
+                    self.stats['disk_hits'] += 1
+                return vector.tolist()
+
+        with self._lock:
+            self.stats['misses'] += 1
+        return None
+
+    def put(self, model: str, task_type, text: str, vector: list):
+        """Guarda el vector en memoria y, si está habilitado, en disco"""
+        key = make_key(model, task_type, text)
+        packed = array('f', vector)
+        self._remember(key, packed)
+
+        if self.db_path:
+            try:
+                conn = self._connect()
+                with conn:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO embeddings (key, model, task_type, vector) '
+                        'VALUES (?, ?, ?, ?)',
+                        (key, model, task_type or '', packed.tobytes())
+                    )
+            except sqlite3.Error as e:
+                log.warning("⚠️ Error guardando cache de embeddings: %s", e)
+
+        with self._lock:
+            self.stats['stores'] += 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats['memory_entries'] = len(self._lru)
+        hits = stats['memory_hits'] + stats['disk_hits']
+        total = hits + stats['misses']
+        stats['hits'] = hits
+        stats['hit_rate'] = round(hits / total, 4) if total else 0.0
+        stats['persistent'] = bool(self.db_path)
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+        if self.db_path:
+            conn = self._connect()
+            with conn:
+                conn.execute('DELETE FROM embeddings')
+
+
+# Instancia compartida por todo el proceso
+embedding_cache = EmbeddingCache(
+    db_path=EMBEDDING_CACHE_DB if EMBEDDING_CACHE_PERSIST else None
+)
+
+
+def get_embedding_cache_stats() -> dict:
+    """Contadores de aciertos/fallos del cache de embeddings"""
+    return embedding_cache.get_stats()
@@ -1,16 +1,35 @@
 import os
 import uuid
-import time
-import PyPDF2
+import hashlib
+import asyncio
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import google.generativeai as genai
 from qdrant_client import QdrantClient
+from qdrant_client.models import VectorParams, Distance, PointStruct
 from document import Document
+from pdf_extraction import extract_pages, iter_pages, count_pages
+from embedding_cache import embedding_cache
+from local_embeddings import LOCAL_EMBEDDING_MODEL, LOCAL_EMBEDDING_BATCH_SIZE, local_embed, local_embedding_dimension
+from qdrant_transport import qdrant_request, async_qdrant_request, get_qdrant_url
+from lesson_dates import (
+    extract_lesson_fields, infer_year, ensure_lesson_indexes, find_page_by_date,
+    find_page_by_date_async, FILENAME_FIELD, LESSON_DATE_FIELD
+)
+from rate_limiter import rate_limiter, estimate_tokens, parse_retry_after
+from lexical_index import lexical_search, reciprocal_rank_fusion, index_points, remove_points
+from vector_mirror import mirror_search, mirror_find, mirror_upsert, mirror_delete
+from metrics import span, count, QUOTA_ERRORS, SEARCH_REQUESTS, FALLBACK_SCROLLS
+from structured_logging import get_logger, VERBOSE
+
+log = get_logger('embeddings')
 
 # Configurar Google Gemini para embeddings
-print("🔄 Configurando Google Gemini para embeddings...")
+log.info("🔄 Configurando Google Gemini para embeddings...")
 genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-print("✅ Google Gemini configurado")
+log.info("✅ Google Gemini configurado")
 
 # Modelos disponibles con rotación para evitar límites de cuota
 EMBEDDING_MODELS = [
@@ -20,6 +39,66 @@ EMBEDDING_MODELS = [
 # Índice para rotación de modelos (se incrementa en cada llamada)
 _model_index = 0
 
+# Ingesta por lotes: páginas por llamada a embed_content (máx. 100 en la API)
+# y número de lotes que se envían en paralelo
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', '50'))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv('EMBEDDING_MAX_CONCURRENCY', '4'))
+EMBEDDING_BATCH_RETRIES = int(os.getenv('EMBEDDING_BATCH_RETRIES', '3'))
+EMBEDDING_INGEST_MAX_WAIT = float(os.getenv('EMBEDDING_INGEST_MAX_WAIT', '120'))
+
+# Upserts de la ingesta: páginas por PUT /points, upserts pendientes a la vez
+# y si Qdrant responde al indexar (wait=true) o al aceptar el lote
+QDRANT_UPSERT_BATCH_SIZE = int(os.getenv('QDRANT_UPSERT_BATCH_SIZE', '100'))
+QDRANT_UPSERT_MAX_IN_FLIGHT = int(os.getenv('QDRANT_UPSERT_MAX_IN_FLIGHT', '2'))
+QDRANT_UPSERT_WAIT = os.getenv('QDRANT_UPSERT_WAIT', 'true').lower() in ('1', 'true', 'yes')
+
+# Espacio de nombres para los IDs deterministas de página (uuid5)
+POINT_ID_NAMESPACE = uuid.UUID('6f1c3f5e-2d7a-5b8e-9c41-8a2f0e7d3b6c')
+
+# Backend de embeddings: 'gemini' (API) o 'local' (sentence-transformers en CPU).
+# Cada colección usa siempre el mismo para que la dimensión de los vectores
+# coincida: EMBEDDING_BACKENDS="COLECCION=local,OTRA=gemini"; las demás usan
+# EMBEDDING_BACKEND
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'gemini').lower()
+EMBEDDING_BACKENDS = dict(
+    (name.strip(), backend.strip().lower())
+    for name, backend in (
+        item.split('=', 1) for item in os.getenv('EMBEDDING_BACKENDS', '').split(',') if '=' in item
+    )
+)
+GEMINI_EMBEDDING_DIMENSION = 768
+
+# Presupuesto de la API de embeddings (cada texto de un lote cuenta como solicitud)
+rate_limiter.register_model(
+    'models/text-embedding-004',
+    rpm=int(os.getenv('EMBEDDING_RPM', '1500')),
+    tpm=int(os.getenv('EMBEDDING_TPM', '0')) or None
+)
+
+def get_embedding_backend(collection_name=None) -> str:
+    """Backend de embeddings configurado para una colección"""
+    return EMBEDDING_BACKENDS.get(collection_name, EMBEDDING_BACKEND)
+
+
+def embedding_model_name(backend=None) -> str:
+    """Modelo que produce los vectores de un backend (vectores de modelos distintos no se comparan)"""
+    if (backend or EMBEDDING_BACKEND) == 'local':
+        return LOCAL_EMBEDDING_MODEL
+    return 'models/text-embedding-004'
+
+
+def get_embedding_model(collection_name=None) -> str:
+    """Modelo de embeddings de una colección (según su backend)"""
+    return embedding_model_name(get_embedding_backend(collection_name))
+
+
+def embedding_dimension(backend=None) -> int:
+    """Dimensión de los vectores que produce un backend"""
+    if (backend or EMBEDDING_BACKEND) == 'local':
+        return local_embedding_dimension()
+    return GEMINI_EMBEDDING_DIMENSION
+
+
 def get_next_embedding_model():
     """Obtiene el siguiente modelo de la lista para rotación"""
     global _model_index
@@ -27,49 +106,205 @@ def get_next_embedding_model():
     _model_index += 1
     return model
 
-def generate_embedding(text: str, task_type=None, retry_delay=2) -> list:
+def _embed_with_limits(texts, task_type, retry_delay, max_retries, max_wait=None):
+    """
+    Llama a embed_content respetando el presupuesto compartido del modelo.
+    En un 429 usa la pista de Retry-After si la API la da; si no, una
+    espera lineal como antes. La espera la hace el limitador, que además
+    la contabiliza.
+    """
+    model_name = 'models/text-embedding-004'
+    is_batch = isinstance(texts, list)
+    num_requests = len(texts) if is_batch else 1
+
+    for attempt in range(max_retries):
+        rate_limiter.acquire(
+            model_name,
+            tokens=estimate_tokens(texts),
+            requests=num_requests,
+            max_wait=max_wait
+        )
+        try:
+            # Si task_type es None, no lo pasamos (comportamiento por defecto de n8n)
+            embed_params = {
+                'model': model_name,
+                'content': texts
+            }
+            if task_type is not None:
+                embed_params['task_type'] = task_type
+
+            return genai.embed_content(**embed_params)['embedding']
+        except Exception as e:
+            error_msg = str(e)
+            if "429" in error_msg or "Resource exhausted" in error_msg:
+                count(QUOTA_ERRORS, api='embedding', model=model_name)
+                if attempt < max_retries - 1:
+                    wait_time = parse_retry_after(e) or retry_delay * (attempt + 1)
+                    rate_limiter.penalize(model_name, wait_time)
+                    log.warning("⚠️ Rate limit alcanzado. El modelo queda en pausa %ss antes de reintentar...", wait_time)
+                else:
+                    log.error("❌ Error generando embedding después de %s intentos: %s", max_retries, e)
+                    raise
+            else:
+                log.error("❌ Error generando embedding: %s", e)
+                raise
+
+
+def generate_embedding(text: str, task_type=None, retry_delay=2, use_cache=True, backend=None) -> list:
     """
     Genera embedding usando Google Gemini
     Usa el modelo 'models/text-embedding-004' que es compatible con n8n
-    Incluye delay automático para evitar rate limiting
+    El ritmo de llamadas lo controla el rate_limiter compartido
     
     Args:
         text: Texto para generar embedding
         task_type: None para compatibilidad con n8n, o 'retrieval_document'/'retrieval_query' si se especifica
-        retry_delay: Tiempo de espera entre reintentos
+        retry_delay: Espera base entre reintentos si la API no indica Retry-After
+        use_cache: Consultar/guardar en el cache de embeddings (un acierto evita
+                   la llamada a la API)
+        backend: 'gemini' o 'local' (por defecto EMBEDDING_BACKEND; ver
+                 get_embedding_backend). El backend local ignora task_type.
     
     IMPORTANTE: n8n NO especifica task_type, así que usamos None por defecto
     para que los embeddings sean compatibles con las búsquedas de n8n
     """
+    local = (backend or EMBEDDING_BACKEND) == 'local'
+    model_name = embedding_model_name(backend)
+    if use_cache:
+        cached_vector = embedding_cache.get(model_name, task_type, text)
+        if cached_vector is not None:
+            log.debug("⚡ Embedding obtenido del cache")
+            return cached_vector
+
+    if local:
+        vector = local_embed([text])[0]
+    else:
+        vector = _embed_with_limits(text, task_type, retry_delay, max_retries=3)
+    if use_cache:
+        embedding_cache.put(model_name, task_type, text, vector)
+    return vector
+
+async def generate_embedding_async(text: str, task_type=None, retry_delay=2, use_cache=True,
+                                   backend=None) -> list:
+    """
+    Versión asíncrona de generate_embedding (embed_content_async de Gemini).
+    Comparte el cache de embeddings y el presupuesto del rate_limiter.
+    Con el backend local, la inferencia corre en un hilo aparte; el cache
+    de embeddings (SQLite) también, para no bloquear el loop.
+    """
+    if (backend or EMBEDDING_BACKEND) == 'local':
+        return await asyncio.to_thread(
+            generate_embedding, text, task_type, retry_delay, use_cache, 'local'
+        )
+
+    model_name = 'models/text-embedding-004'
+    if use_cache:
+        cached_vector = await asyncio.to_thread(embedding_cache.get, model_name, task_type, text)
+        if cached_vector is not None:
+            log.debug("⚡ Embedding obtenido del cache")
+            return cached_vector
+
     max_retries = 3
     for attempt in range(max_retries):
+        await rate_limiter.acquire_async(model_name, tokens=estimate_tokens(text))
         try:
-            # Si task_type es None, no lo pasamos (comportamiento por defecto de n8n)
             embed_params = {
-                'model': 'models/text-embedding-004',
+                'model': model_name,
                 'content': text
             }
             if task_type is not None:
                 embed_params['task_type'] = task_type
-                
-            result = genai.embed_content(**embed_params)
-            # Pequeño delay después de cada llamada exitosa para evitar rate limiting
-            time.sleep(0.5)
-            return result['embedding']
+
+            vector = (await genai.embed_content_async(**embed_params))['embedding']
+            if use_cache:
+                await asyncio.to_thread(embedding_cache.put, model_name, task_type, text, vector)
+            return vector
         except Exception as e:
             error_msg = str(e)
-            if "429" in error_msg or "Resource exhausted" in error_msg:
-                if attempt < max_retries - 1:
-                    wait_time = retry_delay * (attempt + 1)
-                    print(f"⚠️ Rate limit alcanzado. Esperando {wait_time}s antes de reintentar...")
-                    time.sleep(wait_time)
-                else:
-                    print(f"❌ Error generando embedding después de {max_retries} intentos: {e}")
-                    raise
+            if ("429" in error_msg or "Resource exhausted" in error_msg) and attempt < max_retries - 1:
+                wait_time = parse_retry_after(e) or retry_delay * (attempt + 1)
+                rate_limiter.penalize(model_name, wait_time)
+                log.warning("⚠️ Rate limit alcanzado. El modelo queda en pausa %ss antes de reintentar...", wait_time)
             else:
-                print(f"❌ Error generando embedding: {e}")
+                log.error("❌ Error generando embedding: %s", e)
                 raise
 
+def generate_embeddings_batch(texts: list, task_type=None, retry_delay=2,
+                              max_retries=EMBEDDING_BATCH_RETRIES) -> list:
+    """
+    Genera embeddings para varios textos en UNA sola llamada a la API
+    (embed_content acepta una lista en 'content').
+
+    Si el lote falla por rate limit se reintenta SOLO ese lote, sin
+    repetir los demás lotes del archivo.
+
+    Returns:
+        Lista de vectores en el mismo orden que 'texts'
+    """
+    if not texts:
+        return []
+
+    # La ingesta no atiende a un usuario esperando: puede esperar más cuota
+    vectors = _embed_with_limits(
+        list(texts), task_type, retry_delay, max_retries,
+        max_wait=EMBEDDING_INGEST_MAX_WAIT
+    )
+    if len(vectors) != len(texts):
+        raise ValueError(
+            f"La API devolvió {len(vectors)} embeddings para {len(texts)} textos"
+        )
+    return vectors
+
+
+def generate_embeddings_concurrent(texts: list, task_type=None,
+                                   batch_size=None, max_concurrency=None,
+                                   on_batch_done=None, backend=None) -> list:
+    """
+    Divide 'texts' en lotes y los envía a la API de embeddings con un
+    número acotado de lotes en vuelo a la vez.
+
+    El orden de salida coincide con el de entrada: el vector i corresponde
+    al texto i, sin importar en qué orden terminen los lotes.
+
+    Args:
+        on_batch_done: Callback opcional on_batch_done(num_textos) al terminar cada lote
+        backend: 'gemini' o 'local'. El backend local codifica los lotes en
+                 serie: el modelo ya usa todos los núcleos en cada lote.
+    """
+    if (backend or EMBEDDING_BACKEND) == 'local':
+        vectors = []
+        for start in range(0, len(texts), LOCAL_EMBEDDING_BATCH_SIZE):
+            batch = texts[start:start + LOCAL_EMBEDDING_BATCH_SIZE]
+            vectors.extend(local_embed(batch))
+            if on_batch_done:
+                on_batch_done(len(batch))
+        return vectors
+
+    batch_size = max(1, min(batch_size or EMBEDDING_BATCH_SIZE, 100))
+    max_concurrency = max(1, max_concurrency or EMBEDDING_MAX_CONCURRENCY)
+
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    if not batches:
+        return []
+
+    log.info("🔄 Generando embeddings en %s lotes de hasta %s (máx. %s en paralelo)...",
+             len(batches), batch_size, max_concurrency)
+
+    with ThreadPoolExecutor(max_workers=min(max_concurrency, len(batches))) as executor:
+        # executor.map conserva el orden de los lotes
+        def embed_batch(batch):
+            batch_vectors = generate_embeddings_batch(batch, task_type=task_type)
+            if on_batch_done:
+                on_batch_done(len(batch))
+            return batch_vectors
+
+        results = executor.map(embed_batch, batches)
+        vectors = []
+        for batch_vectors in results:
+            vectors.extend(batch_vectors)
+
+    return vectors
+
 def get_qdrant_client():
     """Obtener cliente de Qdrant con configuración desde variables de entorno"""
     qdrant_url = os.getenv('QDRANT_URL', 'http://localhost:6333')
@@ -90,17 +325,14 @@ def get_qdrant_client():
 def create_embeddings(chatbot_id, file_name):
     """Extraer texto del PDF y crear embeddings en Qdrant"""
     # Extraer el texto del pdf
-    with open(os.path.join('pdf_files', file_name), 'rb') as pdf_file:
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
-
-        documents = []
-        for page_num, page in enumerate(pdf_reader.pages):
-            document = Document(
-                doc_id=str(uuid.uuid4()),
-                content=page.extract_text(),
-                metadata={'page_number': str(page_num), 'filename': file_name}
-            )
-            documents.append(document)
+    documents = []
+    for page_num, content in enumerate(extract_pages(os.path.join('pdf_files', file_name))):
+        document = Document(
+            doc_id=str(uuid.uuid4()),
+            content=content,
+            metadata={'page_number': str(page_num), 'filename': file_name}
+        )
+        documents.append(document)
 
     # Conectar a Qdrant
     client = get_qdrant_client()
@@ -113,17 +345,15 @@ def create_embeddings(chatbot_id, file_name):
         client.create_collection(
             collection_name=chatbot_id,
             vectors_config=VectorParams(
-                size=768,  # Dimensión del modelo paraphrase-multilingual-mpnet-base-v2
+                size=local_embedding_dimension(),  # 768 con paraphrase-multilingual-mpnet-base-v2
                 distance=Distance.COSINE
             )
         )
     
-    # Crear embeddings y guardar en Qdrant
+    # Crear embeddings (modelo local, por lotes) y guardar en Qdrant
+    vectors = local_embed([doc.content for doc in documents])
     points = []
-    for doc in documents:
-        # Generar embedding
-        vector = embedding_model.encode(doc.content).tolist()
-        
+    for doc, vector in zip(documents, vectors):
         # Crear punto
         point = PointStruct(
             id=str(uuid.uuid4()),
@@ -141,428 +371,742 @@ def create_embeddings(chatbot_id, file_name):
         points=points
     )
 
-def add_pdf_to_collection(collection_name, file_path, file_name):
+def _iter_page_documents(file_path, file_name, total_pages, progress):
+    """Genera un Document por cada página con contenido, a medida que se extraen"""
+    lesson_year = None
+    for page_num, content in enumerate(iter_pages(file_path)):
+        if not content.strip():  # Solo agregar páginas con contenido
+            continue
+        if lesson_year is None:
+            # El año sale del nombre o de la portada ("Para el 18 de octubre de 2025")
+            lesson_year = infer_year(file_name, content)
+        metadata = {
+            'page_number': str(page_num + 1),
+            'filename': file_name,
+            'total_pages': str(total_pages)
+        }
+        # Campos estructurados "Lección X" + fecha ISO para búsquedas filtradas
+        metadata.update(extract_lesson_fields(content, lesson_year))
+        metadata['content_hash'] = page_content_hash(content)
+        progress('parsed', 1)
+        yield Document(
+            doc_id=page_point_id(file_name, page_num + 1, metadata['content_hash']),
+            content=content,
+            metadata=metadata
+        )
+
+
+def page_content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def page_point_id(file_name, page_number, content_hash) -> str:
     """
-    Agregar un PDF a una colección existente de Qdrant
+    ID determinista de una página: el mismo (archivo, página, contenido)
+    produce siempre el mismo punto, así re-subir un PDF no duplica puntos
     """
-    print(f"📄 Procesando PDF: {file_name}")
-    
-    # Extraer el texto del PDF
-    with open(file_path, 'rb') as pdf_file:
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
-        total_pages = len(pdf_reader.pages)
-        print(f"📖 Total de páginas: {total_pages}")
-
-        documents = []
-        for page_num, page in enumerate(pdf_reader.pages):
-            content = page.extract_text()
-            if content.strip():  # Solo agregar páginas con contenido
-                document = Document(
-                    doc_id=str(uuid.uuid4()),
-                    content=content,
-                    metadata={
-                        'page_number': str(page_num + 1),
-                        'filename': file_name,
-                        'total_pages': str(total_pages)
-                    }
-                )
-                documents.append(document)
-        
-        print(f"✅ Extraídas {len(documents)} páginas con contenido")
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, f"{file_name}|{page_number}|{content_hash}"))
 
-    # Verificar que la colección existe usando REST API
-    qdrant_url = os.getenv('QDRANT_URL', 'http://localhost:6333')
-    api_key = os.getenv('QDRANT_API_KEY', None)
-    
-    headers = {'Content-Type': 'application/json'}
-    if api_key:
-        headers['api-key'] = api_key
-    
+
+def get_file_point_ids(collection_name, file_name, page_size=256) -> set:
+    """IDs de los puntos ya subidos para un archivo (filtro por metadata.filename)"""
+    point_ids = set()
+    offset = None
+    while True:
+        body = {
+            'filter': {'must': [{'key': FILENAME_FIELD, 'match': {'value': file_name}}]},
+            'limit': page_size,
+            'with_payload': False,
+            'with_vector': False
+        }
+        if offset is not None:
+            body['offset'] = offset
+        response = qdrant_request(
+            'POST', f"/collections/{collection_name}/points/scroll", json=body, idempotent=True
+        )
+        if response.status_code != 200:
+            raise ValueError(f"Error listando puntos de '{file_name}': {response.status_code}")
+
+        result = response.json().get('result', {})
+        point_ids.update(str(point['id']) for point in result.get('points', []))
+        offset = result.get('next_page_offset')
+        if offset is None:
+            return point_ids
+
+
+def delete_points(collection_name, point_ids, wait=None):
+    """Elimina puntos por ID (páginas cuyo contenido cambió o ya no existen)"""
+    wait = QDRANT_UPSERT_WAIT if wait is None else wait
+    response = qdrant_request(
+        'POST',
+        f"/collections/{collection_name}/points/delete?wait={'true' if wait else 'false'}",
+        json={'points': list(point_ids)},
+        idempotent=True
+    )
+    if response.status_code != 200:
+        raise ValueError(f"Error eliminando puntos: {response.status_code} - {response.text}")
+    remove_points(collection_name, point_ids)
+    mirror_delete(collection_name, point_ids)
+
+
+def _iter_batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def check_collection_dimension(collection_name, collection_info, backend):
+    """Falla si la dimensión de la colección no coincide con la del backend"""
+    vectors_config = (
+        collection_info.get('result', {}).get('config', {}).get('params', {}).get('vectors', {})
+    )
+    size = vectors_config.get('size') if isinstance(vectors_config, dict) else None
+    if size is None:
+        return
+    expected = embedding_dimension(backend)
+    if size != expected:
+        raise ValueError(
+            f"La colección '{collection_name}' tiene vectores de dimensión {size} pero el backend "
+            f"'{backend}' produce {expected}; revisa EMBEDDING_BACKENDS"
+        )
+
+
+def upsert_points(collection_name, points, wait=None):
+    """
+    Sube un lote de puntos a Qdrant (PUT /points)
+
+    Args:
+        wait: Si es True, Qdrant responde cuando el lote ya está indexado;
+              si es False, al aceptarlo (por defecto QDRANT_UPSERT_WAIT)
+    """
+    wait = QDRANT_UPSERT_WAIT if wait is None else wait
     try:
-        response = requests.get(
-            f"{qdrant_url}/collections/{collection_name}",
-            headers=headers,
-            timeout=10
+        response = qdrant_request(
+            'PUT',
+            f"/collections/{collection_name}/points?wait={'true' if wait else 'false'}",
+            json={'points': points},
+            timeout=60
         )
+    except requests.RequestException as e:
+        log.error("❌ Error al conectar con Qdrant: %s", e)
+        raise ValueError(f"No se pudo subir a Qdrant: {e}")
+
+    if response.status_code != 200:
+        log.error("❌ Error al subir puntos: %s - %s", response.status_code, response.text)
+        raise ValueError(f"Error al subir puntos a Qdrant: {response.status_code}")
+    index_points(collection_name, points)
+    mirror_upsert(collection_name, points)
+    return len(points)
+
+
+def add_pdf_to_collection(collection_name, file_path, file_name, batched=True, progress=None,
+                          batch_size=None, max_in_flight=None, wait=None):
+    """
+    Agregar un PDF a una colección existente de Qdrant
+
+    Las páginas fluyen extracción -> embeddings -> upsert en lotes de
+    batch_size, con a lo sumo max_in_flight upserts pendientes; nunca se
+    arma la lista completa de puntos, así la memoria no crece con el tamaño
+    del documento y un fallo solo afecta a un lote.
+
+    Re-subir un PDF es idempotente: cada página tiene un ID derivado de
+    (archivo, página, hash del contenido). Las páginas que ya están en la
+    colección no se vuelven a embeber, y al terminar se eliminan los puntos
+    anteriores del archivo que ya no corresponden (páginas corregidas o
+    subidas con IDs aleatorios).
+
+    Args:
+        batched: Si es True, genera los embeddings por lotes concurrentes
+                 (generate_embeddings_concurrent). Si es False, usa el modo
+                 anterior de una llamada por página.
+        progress: Callback opcional progress(etapa, páginas, total=None) con
+                  etapa 'parsed', 'embedded', 'upserted' o 'skipped' (ver ingestion_jobs)
+        batch_size: Páginas por upsert (por defecto QDRANT_UPSERT_BATCH_SIZE)
+        max_in_flight: Upserts pendientes a la vez (por defecto QDRANT_UPSERT_MAX_IN_FLIGHT)
+        wait: Semántica wait de Qdrant para cada upsert (ver upsert_points)
+    """
+    progress = progress or (lambda stage, count, total=None: None)
+    backend = get_embedding_backend(collection_name)
+    batch_size = max(1, batch_size or QDRANT_UPSERT_BATCH_SIZE)
+    max_in_flight = max(1, max_in_flight or QDRANT_UPSERT_MAX_IN_FLIGHT)
+    log.info("📄 Procesando PDF: %s", file_name)
+
+    # Verificar que la colección existe antes de extraer nada (pool compartido)
+    try:
+        response = qdrant_request('GET', f"/collections/{collection_name}")
         
         if response.status_code == 200:
             collection_info = response.json()
             points_count = collection_info.get('result', {}).get('points_count', 0)
-            print(f"✅ Colección '{collection_name}' encontrada: {points_count} puntos existentes")
+            log.info("✅ Colección '%s' encontrada: %s puntos existentes", collection_name, points_count)
+            check_collection_dimension(collection_name, collection_info, backend)
         else:
-            print(f"❌ Error: La colección '{collection_name}' no existe (status: {response.status_code})")
+            log.error("❌ Error: La colección '%s' no existe (status: %s)", collection_name, response.status_code)
             raise ValueError(f"La colección '{collection_name}' no existe")
     except requests.RequestException as e:
-        print(f"❌ Error al verificar colección: {e}")
+        log.error("❌ Error al verificar colección: %s", e)
         raise ValueError(f"No se pudo conectar a Qdrant: {e}")
-    
-    # Crear embeddings y puntos para Qdrant
-    print("🔄 Generando embeddings...")
-    points = []
-    for i, doc in enumerate(documents):
-        # Generar embedding usando Google Gemini (sin task_type, igual que n8n)
-        vector = generate_embedding(doc.content)
-        
-        # Crear punto en formato dict para REST API
-        # IMPORTANTE: n8n usa 'content' como campo principal
-        point = {
-            'id': str(uuid.uuid4()),
-            'vector': vector,
-            'payload': {
-                'content': doc.content,  # n8n usa 'content'
-                'metadata': doc.metadata
-            }
-        }
-        points.append(point)
-        
-        if (i + 1) % 10 == 0:
-            print(f"   Procesadas {i + 1}/{len(documents)} páginas...")
-    
-    print(f"✅ Embeddings generados para {len(points)} páginas")
-    
-    # Subir puntos a Qdrant usando REST API
+
+    # Índices de payload para lesson_date / lesson_number (idempotente)
     try:
-        payload = {
-            'points': points
-        }
-        
-        print(f"🔄 Subiendo {len(points)} puntos a Qdrant...")
-        response = requests.put(
-            f"{qdrant_url}/collections/{collection_name}/points",
-            headers=headers,
-            json=payload,
-            timeout=60
-        )
-        
-        if response.status_code == 200:
-            result = response.json()
-            print(f"✅ PDF agregado exitosamente!")
-            print(f"   Status: {result.get('status')}")
-        else:
-            print(f"❌ Error al subir puntos: {response.status_code} - {response.text}")
-            raise ValueError(f"Error al subir puntos a Qdrant: {response.status_code}")
-            
+        ensure_lesson_indexes(collection_name)
     except requests.RequestException as e:
-        print(f"❌ Error al conectar con Qdrant: {e}")
-        raise ValueError(f"No se pudo subir a Qdrant: {e}")
-    
+        log.warning("⚠️ No se pudieron crear los índices de lección: %s", e)
+
+    # Puntos que ya tiene este archivo (re-ingesta)
+    try:
+        existing_ids = get_file_point_ids(collection_name, file_name)
+    except (requests.RequestException, ValueError) as e:
+        log.warning("⚠️ No se pudieron listar los puntos existentes de '%s': %s", file_name, e)
+        existing_ids = None
+    if existing_ids:
+        log.info("♻️ '%s' ya tiene %s puntos; solo se subirán las páginas nuevas o cambiadas", file_name, len(existing_ids))
+
+    total_pages = count_pages(file_path)
+    log.info("📖 Total de páginas: %s", total_pages)
+    progress('parsed', 0, total=total_pages)
+
+    documents_added = 0
+    dated_pages = 0
+    batches = 0
+    kept_ids = set()
+    skipped = [0]
+    pending = deque()
+
+    def changed_documents():
+        """Descarta las páginas cuyo ID (mismo contenido) ya está en la colección"""
+        for doc in _iter_page_documents(file_path, file_name, total_pages, progress):
+            kept_ids.add(doc.id)
+            if existing_ids and doc.id in existing_ids:
+                skipped[0] += 1
+                progress('skipped', 1)
+                continue
+            yield doc
+
+    log.info("🧩 Backend de embeddings para '%s': %s", collection_name, backend)
+    log.info("🔄 Generando embeddings y subiendo en lotes de %s (máx. %s upserts en vuelo)...",
+             batch_size, max_in_flight)
+    with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='upsert') as executor:
+        try:
+            for batch in _iter_batches(changed_documents(), batch_size):
+                # Crear embeddings (sin task_type, igual que n8n)
+                if batched:
+                    vectors = generate_embeddings_concurrent(
+                        [doc.content for doc in batch],
+                        on_batch_done=lambda count: progress('embedded', count),
+                        backend=backend
+                    )
+                else:
+                    vectors = []
+                    for doc in batch:
+                        vectors.append(generate_embedding(doc.content, use_cache=False, backend=backend))
+                        progress('embedded', 1)
+
+                # Crear puntos en formato dict para REST API
+                # IMPORTANTE: n8n usa 'content' como campo principal
+                points = [
+                    {
+                        'id': doc.id,
+                        'vector': vector,
+                        'payload': {
+                            'content': doc.content,  # n8n usa 'content'
+                            'metadata': doc.metadata
+                        }
+                    }
+                    for doc, vector in zip(batch, vectors)
+                ]
+                documents_added += len(batch)
+                dated_pages += sum(1 for doc in batch if 'lesson_date' in doc.metadata)
+                batches += 1
+
+                # Contrapresión: no embeber más lotes si ya hay max_in_flight upserts pendientes
+                if len(pending) >= max_in_flight:
+                    progress('upserted', pending.popleft().result())
+                pending.append(executor.submit(upsert_points, collection_name, points, wait))
+                log.info("   Procesadas %s/%s páginas...", documents_added, total_pages)
+
+            while pending:
+                progress('upserted', pending.popleft().result())
+        finally:
+            for future in pending:
+                future.cancel()
+
+    # Solo después de subir todo: si algo falló antes, el contenido anterior sigue ahí
+    stale_ids = (existing_ids or set()) - kept_ids
+    if stale_ids:
+        delete_points(collection_name, stale_ids, wait)
+        log.info("🧹 Eliminados %s puntos anteriores de '%s'", len(stale_ids), file_name)
+
+    log.info("✅ Subidas %s páginas nuevas o cambiadas en %s lotes, %s sin cambios (%s con fecha de lección)",
+             documents_added, batches, skipped[0], dated_pages)
+
     # Verificar resultado final con REST API
-    response = requests.get(
-        f"{qdrant_url}/collections/{collection_name}",
-        headers=headers,
-        timeout=10
-    )
+    response = qdrant_request('GET', f"/collections/{collection_name}")
     
     if response.status_code == 200:
         updated_info = response.json()
         total_points = updated_info.get('result', {}).get('points_count', 0)
-        print(f"   Puntos totales en '{collection_name}': {total_points}")
+        log.info("✅ PDF agregado exitosamente!")
+        log.info("   Puntos totales en '%s': %s", collection_name, total_points)
         
         return {
-            'pages_added': len(documents),
+            'pages_added': documents_added,
+            'pages_unchanged': skipped[0],
+            'pages_removed': len(stale_ids),
             'total_points': total_points,
             'filename': file_name
         }
     else:
         return {
-            'pages_added': len(documents),
+            'pages_added': documents_added,
+            'pages_unchanged': skipped[0],
+            'pages_removed': len(stale_ids),
             'total_points': 'unknown',
             'filename': file_name
         }
 
 
-def get_documents(collection_name, question, limit=8):
+# Nombres en español para días y meses
+DIAS = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
+MESES = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 
+         'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre']
+
+
+def _resolve_date_reference(question, now=None, verbose=True):
     """
-    Buscar documentos relevantes en Qdrant usando búsqueda semántica
-    Genera embedding de la pregunta y busca los documentos más similares
+    Detecta referencias temporales en la pregunta y calcula la fecha.
+
+    Returns:
+        (target_date, kind): kind es 'relative' (hoy, mañana, ayer...),
+        'explicit' ("30 de octubre") o None si no hay referencia temporal
+    """
+    from datetime import date, timedelta
+    import re
+
+    dias = DIAS
+    meses = MESES
+
+    question_lower = question.lower()
+    now = now or datetime.now()
+    note = log.info if verbose else (lambda *args, **kwargs: None)
     
-    IMPORTANTE: Usa task_type=None para compatibilidad con n8n
-    Usa limit=8 por defecto para obtener mejor contexto y permitir re-ranking por fecha
+    # 1. Detectar referencias relativas (hoy, mañana, ayer, etc.)
+    # IMPORTANTE: Detectar frases más específicas PRIMERO (pasado mañana antes que mañana)
+    if 'hoy' in question_lower or 'de hoy' in question_lower or 'esta lección' in question_lower or 'lección de hoy' in question_lower or 'actual' in question_lower or 'esta semana' in question_lower:
+        note(f"📅 Detectado: HOY")
+        return now, 'relative'
+    elif 'pasado mañana' in question_lower or 'pasado-mañana' in question_lower or 'pasadomañana' in question_lower:
+        note(f"📅 Detectado: PASADO MAÑANA")
+        return now + timedelta(days=2), 'relative'
+    elif 'antes de ayer' in question_lower or 'anteayer' in question_lower or 'antesdeayer' in question_lower:
+        note(f"📅 Detectado: ANTES DE AYER")
+        return now - timedelta(days=2), 'relative'
+    elif 'mañana' in question_lower:
+        target_date = now + timedelta(days=1)
+        note(f"📅 Detectado: MAÑANA → {dias[target_date.weekday()]} {target_date.day} de {meses[target_date.month - 1]}")
+        return target_date, 'relative'
+    elif 'ayer' in question_lower:
+        target_date = now - timedelta(days=1)
+        note(f"📅 Detectado: AYER → {dias[target_date.weekday()]} {target_date.day} de {meses[target_date.month - 1]}")
+        return target_date, 'relative'
+
+    # 2. Detectar fechas explícitas en formato "DD de mes" (ej: "30 de octubre", "3 de noviembre")
+    # Patrón: número + "de" + nombre_del_mes
+    fecha_pattern = r'(\d{1,2})\s+de\s+(' + '|'.join(meses) + r')'
+    match = re.search(fecha_pattern, question_lower)
+    
+    if match:
+        dia_numero = int(match.group(1))
+        mes_nombre = match.group(2)
+        mes_numero = meses.index(mes_nombre) + 1
+        
+        # Construir la fecha con el año actual
+        try:
+            target_date = date(now.year, mes_numero, dia_numero)
+            note(f"📅 Detectado fecha explícita: {dia_numero} de {mes_nombre}")
+            return target_date, 'explicit'
+        except ValueError:
+            # Fecha inválida (ej: 31 de febrero)
+            note(f"⚠️ Fecha inválida: {dia_numero} de {mes_nombre}")
+
+    return None, None
+
+
+def resolve_target_date(question, now=None):
+    """
+    Detecta referencias temporales en la pregunta (hoy, mañana, "30 de octubre"...)
+    y calcula la fecha correspondiente.
+
+    Returns:
+        (target_date, enriched_question): target_date es None si no hay
+        referencia temporal; enriched_question agrega "Día N de mes"
     """
-    from datetime import datetime
+    target_date, _ = _resolve_date_reference(question, now)
+    enriched_question = question
     
-    qdrant_url = os.getenv('QDRANT_URL', 'http://localhost:6333')
-    api_key = os.getenv('QDRANT_API_KEY', None)
+    # Si detectamos una referencia temporal, enriquecer la pregunta
+    if target_date:
+        dia_semana = DIAS[target_date.weekday()]
+        dia_numero = target_date.day
+        mes = MESES[target_date.month - 1]
+        
+        enriched_question = f"{question} {dia_semana} {dia_numero} de {mes}"
+        log.info("🔍 Pregunta enriquecida con contexto temporal: %s", enriched_question)
+
+    return target_date, enriched_question
+
+
+def resolve_cache_date(question, now=None):
+    """
+    Fecha resuelta de la pregunta para la clave del cache de respuestas
+    ("mañana" → "2026-10-19"), sin logs.
+
+    Returns:
+        (date_key, is_relative): date_key en ISO o None; is_relative indica
+        que la fecha depende del día actual (hoy, mañana, ayer...)
+    """
+    target_date, kind = _resolve_date_reference(question, now, verbose=False)
+    return query_date_key(target_date), kind == 'relative'
+
+
+def build_search_payload(question_vector, target_date, limit):
+    """
+    Cuerpo de /points/search. Con fecha específica se amplía a 20 resultados
+    para capturar todos los días de la lección; luego se reduce a 'limit'
+    después del re-ranking.
+    """
+    search_limit = 20 if target_date else limit
     
-    headers = {'Content-Type': 'application/json'}
-    if api_key:
-        headers['api-key'] = api_key
+    if target_date:
+        log.info("🔎 Búsqueda HÍBRIDA activada para: %s %s de %s (%s docs, consulta filtrada por fecha si no hay match exacto)",
+                 DIAS[target_date.weekday()], target_date.day, MESES[target_date.month - 1], search_limit)
     
-    try:
-        # Nombres en español para días y meses
-        dias = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
-        meses = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 
-                 'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre']
+    return {
+        "vector": question_vector,
+        "limit": search_limit,
+        "with_payload": True,
+        "with_vector": False
+        # SIN score_threshold - n8n no lo usa por defecto
+    }
+
+
+def fuse_lexical_results(collection_name, query, points, limit):
+    """
+    Búsqueda híbrida: combina los resultados vectoriales con los del índice
+    BM25 en memoria por Reciprocal Rank Fusion
+    """
+    lexical_points = lexical_search(collection_name, query, limit)
+    if not lexical_points:
+        return points
+    fused = reciprocal_rank_fusion(points, lexical_points)
+    added = len(fused) - len(points)
+    log.debug("🔤 BM25: %s resultados (%s nuevos), fusionados por RRF", len(lexical_points), added)
+    return fused
+
+
+def has_exact_date_match(points, target_date) -> bool:
+    """Indica si algún resultado vectorial es la página exacta de target_date"""
+    dia_semana_target = DIAS[target_date.weekday()]
+    dia_numero_target = str(target_date.day)
+    mes_target = MESES[target_date.month - 1]
+    target_iso = target_date.strftime('%Y-%m-%d')
+    
+    for point in points:
+        point_payload = point.get('payload', {})
+        if (point_payload.get('metadata') or {}).get('lesson_date') == target_iso:
+            return True
+        content = point_payload.get('content', '')
+        content_lower = content.lower()
+        if (dia_semana_target.lower() in content_lower and 
+            dia_numero_target in content and 
+            mes_target in content_lower):
+            return True
+    return False
+
+
+def date_payload_filter(target_date) -> dict:
+    """Filtro por metadata.lesson_date para el espejo local (ver date_filter_body)"""
+    return {LESSON_DATE_FIELD: target_date.strftime('%Y-%m-%d')}
+
+
+def prepend_date_point(points, date_points, target_date):
+    """Agrega al inicio, con score alto, la página encontrada por consulta filtrada"""
+    if date_points:
+        date_point = date_points[0]
+        log.info("✅ ¡ENCONTRADO por fecha! Agregando al inicio de resultados (ID: %s)", date_point.get('id'))
         
-        # DEBUG: Ver qué query recibimos
-        print(f"🔍 Query recibida en semantic_search: '{question}'")
+        points.insert(0, {
+            'id': date_point.get('id'),
+            'score': 1.5,  # Score artificial alto para priorizarlo
+            'payload': date_point.get('payload', {})
+        })
+    else:
+        log.warning("❌ No se encontró documento con: %s %s de %s",
+                    DIAS[target_date.weekday()], target_date.day, MESES[target_date.month - 1])
+    return points
+
+
+def rank_documents(points, target_date, limit):
+    """
+    Re-ranking de los resultados (prioriza la fecha exacta si la hay) y
+    conversión a objetos Document, limitado a 'limit'.
+    """
+    if not points:
+        log.warning("⚠️  No se encontraron documentos relevantes (¿colección vacía o embeddings con otro task_type?)")
+        return []
+    
+    # Primero, construir la lista de documentos con scores
+    doc_candidates = []
+    for point in points:
+        payload = point.get('payload', {})
+        content = payload.get('content', payload.get('text', ''))
         
-        # Enriquecer la pregunta con contexto temporal
-        question_lower = question.lower()
-        enriched_question = question
-        target_date = None
+        if content:
+            score = point.get('score', 0)
+            doc_candidates.append({
+                'point': point,
+                'content': content,
+                'score': score,
+                'payload': payload
+            })
+    
+    # RE-RANKING: Si la pregunta tiene fecha específica, priorizar documentos con esa fecha
+    if target_date:  # Si se detectó una referencia temporal
+        log.debug("🎯 Aplicando re-ranking por coincidencia de fecha exacta")
         
-        # Detectar referencias temporales y calcular la fecha correspondiente
-        from datetime import timedelta
-        import re
-        now = datetime.now()
+        # Extraer los componentes de la fecha objetivo
+        dia_semana = DIAS[target_date.weekday()]
+        dia_numero = str(target_date.day)
+        mes_actual = MESES[target_date.month - 1]
         
-        # 1. Detectar referencias relativas (hoy, mañana, ayer, etc.)
-        # IMPORTANTE: Detectar frases más específicas PRIMERO (pasado mañana antes que mañana)
-        if 'hoy' in question_lower or 'de hoy' in question_lower or 'esta lección' in question_lower or 'lección de hoy' in question_lower or 'actual' in question_lower or 'esta semana' in question_lower:
-            target_date = now
-            print(f"📅 Detectado: HOY")
-        elif 'pasado mañana' in question_lower or 'pasado-mañana' in question_lower or 'pasadomañana' in question_lower:
-            target_date = now + timedelta(days=2)
-            print(f"📅 Detectado: PASADO MAÑANA")
-        elif 'antes de ayer' in question_lower or 'anteayer' in question_lower or 'antesdeayer' in question_lower:
-            target_date = now - timedelta(days=2)
-            print(f"📅 Detectado: ANTES DE AYER")
-        elif 'mañana' in question_lower:
-            target_date = now + timedelta(days=1)
-            print(f"📅 Detectado: MAÑANA → {dias[target_date.weekday()]} {target_date.day} de {meses[target_date.month - 1]}")
-        elif 'ayer' in question_lower:
-            target_date = now - timedelta(days=1)
-            print(f"📅 Detectado: AYER → {dias[target_date.weekday()]} {target_date.day} de {meses[target_date.month - 1]}")
-        else:
-            # 2. Detectar fechas explícitas en formato "DD de mes" (ej: "30 de octubre", "3 de noviembre")
-            # Patrón: número + "de" + nombre_del_mes
-            fecha_pattern = r'(\d{1,2})\s+de\s+(' + '|'.join(meses) + r')'
-            match = re.search(fecha_pattern, question_lower)
-            
-            if match:
-                dia_numero = int(match.group(1))
-                mes_nombre = match.group(2)
-                mes_numero = meses.index(mes_nombre) + 1
-                
-                # Construir la fecha con el año actual
-                from datetime import date
-                try:
-                    target_date = date(now.year, mes_numero, dia_numero)
-                    print(f"📅 Detectado fecha explícita: {dia_numero} de {mes_nombre}")
-                except ValueError:
-                    # Fecha inválida (ej: 31 de febrero)
-                    print(f"⚠️ Fecha inválida: {dia_numero} de {mes_nombre}")
-                    target_date = None
+        # Re-ordenar documentos: los que contienen la fecha exacta van primero
+        exact_matches = []
+        partial_matches = []
+        other_docs = []
         
-        # Si detectamos una referencia temporal, enriquecer la pregunta
-        if target_date:
-            dia_semana = dias[target_date.weekday()]
-            dia_numero = target_date.day
-            mes = meses[target_date.month - 1]
+        for doc in doc_candidates:
+            content_lower = doc['content'].lower()
             
-            enriched_question = f"{question} {dia_semana} {dia_numero} de {mes}"
-            print(f"🔍 Pregunta enriquecida con contexto temporal: {enriched_question}")
+            # Coincidencia EXACTA: contiene día de semana + número + mes
+            if (dia_semana.lower() in content_lower and 
+                dia_numero in doc['content'] and 
+                mes_actual in content_lower):
+                # BOOST: dar score adicional a coincidencias exactas
+                doc['score'] = doc['score'] + 0.5  
+                exact_matches.append(doc)
+                log.info("   ✅ MATCH EXACTO: %.100s... (score: %.3f)", doc['content'], doc['score'], extra=VERBOSE)
+            # Coincidencia PARCIAL: solo día de semana o solo número+mes
+            elif (dia_semana.lower() in content_lower or 
+                  (dia_numero in doc['content'] and mes_actual in content_lower)):
+                doc['score'] = doc['score'] + 0.2
+                partial_matches.append(doc)
+                log.info("   🔸 MATCH PARCIAL: %.100s... (score: %.3f)", doc['content'], doc['score'], extra=VERBOSE)
+            else:
+                other_docs.append(doc)
+                log.info("   📄 Doc encontrado (score: %.3f): %.100s...", doc['score'], doc['content'], extra=VERBOSE)
         
-        # Generar embedding SIN task_type para compatibilidad con n8n
-        print(f"🔍 Generando embedding para búsqueda (modo n8n compatible): {enriched_question}")
-        question_vector = generate_embedding(enriched_question, task_type=None)
+        # Combinar: exact matches primero, luego partial, luego otros
+        doc_candidates = exact_matches + partial_matches + other_docs
+    else:
+        # Sin enriquecimiento de fecha, solo mostrar scores
+        for doc in doc_candidates:
+            log.info("   📄 Doc encontrado (score: %.3f): %.100s...", doc['score'], doc['content'], extra=VERBOSE)
+    
+    # Convertir a objetos Document
+    relevant_docs = []
+    for doc in doc_candidates[:limit]:  # Limitar al número solicitado
+        relevant_docs.append(Document(
+            doc_id=str(doc['point'].get('id', '')),
+            content=doc['content'],
+            metadata=doc['payload'].get('metadata', {})
+        ))
+    
+    log.info("📚 Total de documentos procesados: %s", len(relevant_docs))
+    return relevant_docs
+
+
+def embed_query(question, collection_name=None):
+    """
+    Resuelve la fecha de la pregunta y genera su embedding de búsqueda con
+    el backend de la colección (get_embedding_backend).
+
+    Returns:
+        (target_date, enriched_question, question_vector). Se puede pasar a
+        get_documents(embedded_query=...) para no recalcularlo, y el vector
+        sirve también como clave del cache semántico de respuestas.
+    """
+    with span('query_enrichment'):
+        target_date, enriched_question = resolve_target_date(question)
+    
+    # Generar embedding SIN task_type para compatibilidad con n8n
+    log.debug("🔍 Generando embedding para búsqueda (modo n8n compatible): %s", enriched_question)
+    with span('embedding'):
+        question_vector = generate_embedding(
+            enriched_question, task_type=None, backend=get_embedding_backend(collection_name)
+        )
+    return target_date, enriched_question, question_vector
+
+
+def query_date_key(target_date):
+    """Fecha resuelta en formato ISO (o None) para claves de cache"""
+    return target_date.strftime('%Y-%m-%d') if target_date else None
+
+
+async def embed_query_async(question, collection_name=None):
+    """Versión asíncrona de embed_query"""
+    with span('query_enrichment'):
+        target_date, enriched_question = resolve_target_date(question)
+    with span('embedding'):
+        question_vector = await generate_embedding_async(
+            enriched_question, task_type=None, backend=get_embedding_backend(collection_name)
+        )
+    return target_date, enriched_question, question_vector
+
+
+def get_documents(collection_name, question, limit=8, embedded_query=None):
+    """
+    Buscar documentos relevantes en Qdrant usando búsqueda semántica
+    Genera embedding de la pregunta y busca los documentos más similares
+    
+    IMPORTANTE: Usa task_type=None para compatibilidad con n8n
+    Usa limit=8 por defecto para obtener mejor contexto y permitir re-ranking por fecha
+
+    Args:
+        embedded_query: Resultado de embed_query(question) si ya se calculó
+    """
+    qdrant_url = get_qdrant_url()
+    
+    try:
+        # DEBUG: Ver qué query recibimos
+        log.info("🔍 Query recibida en semantic_search: '%s'", question)
+        
+        target_date, enriched_question, question_vector = embedded_query or embed_query(question, collection_name)
         
         if not question_vector:
-            print("❌ Error: No se pudo generar el vector de la pregunta")
+            log.error("❌ Error: No se pudo generar el vector de la pregunta")
             return []
         
-        print(f"✅ Vector generado exitosamente (dimensión: {len(question_vector)})")
+        log.debug("✅ Vector generado exitosamente (dimensión: %s)", len(question_vector))
         
         # Buscar documentos similares usando búsqueda semántica
-        # Aumentar limit a 20 para capturar todos los días de la lección cuando hay fecha específica
-        # Luego se reduce a 'limit' después del re-ranking
-        search_limit = 20 if target_date else limit
+        payload = build_search_payload(question_vector, target_date, limit)
         
-        payload = {
-            "vector": question_vector,
-            "limit": search_limit,
-            "with_payload": True,
-            "with_vector": False
-            # SIN score_threshold - n8n no lo usa por defecto
-        }
+        # Primero el espejo local (sin red); Qdrant si no está vigente
+        with span('vector_search'):
+            points = mirror_search(collection_name, question_vector, payload['limit'])
+            if points is not None:
+                count(SEARCH_REQUESTS, source='mirror')
+                log.info("⚡ Búsqueda en el espejo local: %s resultados", len(points))
+            else:
+                count(SEARCH_REQUESTS, source='qdrant')
+                log.info("🔎 Buscando en Qdrant: %s/collections/%s/points/search", qdrant_url, collection_name)
+                response = qdrant_request(
+                    'POST',
+                    f"/collections/{collection_name}/points/search",
+                    json=payload,
+                    idempotent=True
+                )
+                
+                log.debug("📡 Respuesta de Qdrant: Status %s", response.status_code)
+                
+                if response.status_code != 200:
+                    log.error("❌ Error en la búsqueda de Qdrant: %s - %s", response.status_code, response.text)
+                    return []
+
+                points = response.json().get('result', [])
+                log.info("📄 Resultados encontrados: %s", len(points))
+        with span('lexical_fusion'):
+            points = fuse_lexical_results(collection_name, enriched_question, points, payload['limit'])
         
-        # Si hay fecha específica, agregar búsqueda híbrida con scroll
-        # para garantizar que encontremos el documento exacto
-        if target_date:
-            dia_semana_target = dias[target_date.weekday()]
-            dia_numero_target = str(target_date.day)
-            mes_target = meses[target_date.month - 1]
-            
-            print(f"🔎 Búsqueda HÍBRIDA activada para: {dia_semana_target} {dia_numero_target} de {mes_target}")
-            print(f"   - Búsqueda vectorial: {search_limit} docs")
-            print(f"   - Búsqueda por scroll: revisando toda la colección")
+        # Si hay fecha específica y no encontramos el documento exacto, consulta filtrada
+        if target_date and not has_exact_date_match(points, target_date):
+            log.info("⚠️  No se encontró match exacto en los %s resultados vectoriales", len(points))
+            log.info("🔄 Consulta filtrada por fecha: %s", target_date.strftime('%Y-%m-%d'))
+            try:
+                with span('scroll'):
+                    date_points = mirror_find(collection_name, date_payload_filter(target_date))
+                    if date_points is None:
+                        date_points = find_page_by_date(collection_name, target_date)
+                        count(FALLBACK_SCROLLS, source='qdrant')
+                    else:
+                        count(FALLBACK_SCROLLS, source='mirror')
+                prepend_date_point(points, date_points, target_date)
+            except Exception as scroll_error:
+                log.warning("⚠️  Error en consulta filtrada por fecha: %s", scroll_error)
         
-        print(f"🔎 Buscando en Qdrant: {qdrant_url}/collections/{collection_name}/points/search")
-        print(f"   - Limit: {search_limit} ({'ampliado para búsqueda por fecha' if search_limit > limit else 'normal'})")
-        print(f"   - Sin score_threshold (compatible con n8n)")
+        with span('rerank'):
+            return rank_documents(points, target_date, limit)
+            
+    except Exception as e:
+        log.exception("❌ Error en get_documents: %s", e)
+        return []
+
+
+async def get_documents_async(collection_name, question, limit=8, embedded_query=None):
+    """
+    Versión asíncrona de get_documents para el modo ASGI: el embedding y las
+    llamadas a Qdrant ceden el event loop mientras esperan la red.
+    Misma lógica de fechas y re-ranking que la versión síncrona.
+    """
+    try:
+        log.info("🔍 Query recibida en semantic_search: '%s'", question)
         
-        response = requests.post(
-            f"{qdrant_url}/collections/{collection_name}/points/search",
-            headers=headers,
-            json=payload,
-            timeout=10
+        target_date, enriched_question, question_vector = (
+            embedded_query or await embed_query_async(question, collection_name)
         )
+        if not question_vector:
+            log.error("❌ Error: No se pudo generar el vector de la pregunta")
+            return []
         
-        print(f"📡 Respuesta de Qdrant: Status {response.status_code}")
-        
-        if response.status_code == 200:
-            data = response.json()
-            points = data.get('result', [])
-            
-            print(f"� Resultados encontrados: {len(points)}")
-            
-            # Si hay fecha específica y no encontramos el documento exacto, hacer scroll search
-            if target_date:
-                dia_semana_target = dias[target_date.weekday()]
-                dia_numero_target = str(target_date.day)
-                mes_target = meses[target_date.month - 1]
-                
-                # Buscar si alguno de los resultados es match exacto
-                has_exact_match = False
-                for point in points:
-                    content = point.get('payload', {}).get('content', '')
-                    content_lower = content.lower()
-                    if (dia_semana_target.lower() in content_lower and 
-                        dia_numero_target in content and 
-                        mes_target in content_lower):
-                        has_exact_match = True
-                        break
-                
-                # Si NO encontramos match exacto, hacer scroll para buscarlo
-                if not has_exact_match:
-                    print(f"⚠️  No se encontró match exacto en los {len(points)} resultados vectoriales")
-                    print(f"🔄 Ejecutando scroll search para encontrar: {dia_semana_target} {dia_numero_target} de {mes_target}")
-                    
-                    try:
-                        scroll_payload = {
-                            "limit": 200,  # Aumentado a 200 para cubrir toda la colección (124 docs actuales)
-                            "with_payload": True,
-                            "with_vector": False
-                        }
-                        
-                        scroll_response = requests.post(
-                            f"{qdrant_url}/collections/{collection_name}/points/scroll",
-                            headers=headers,
-                            json=scroll_payload,
-                            timeout=10
-                        )
-                        
-                        if scroll_response.status_code == 200:
-                            scroll_data = scroll_response.json()
-                            scroll_points = scroll_data.get('result', {}).get('points', [])
-                            print(f"📜 Scroll encontró {len(scroll_points)} documentos en total")
-                            print(f"🔍 Buscando coincidencia exacta de: '{dia_semana_target}' + '{dia_numero_target}' + '{mes_target}'")
-                            
-                            # Buscar el documento con fecha exacta
-                            found_match = False
-                            for scroll_point in scroll_points:
-                                content = scroll_point.get('payload', {}).get('content', '')
-                                content_lower = content.lower()
-                                
-                                # Debug: mostrar primeros 100 caracteres de cada documento revisado
-                                if 'lección 6' in content_lower and 'noviembre' in content_lower:
-                                    print(f"   🔎 Revisando: {content[:120]}...")
-                                
-                                if (dia_semana_target.lower() in content_lower and 
-                                    dia_numero_target in content and 
-                                    mes_target in content_lower):
-                                    
-                                    print(f"✅ ¡ENCONTRADO en scroll! Agregando al inicio de resultados")
-                                    print(f"   ID: {scroll_point.get('id')}")
-                                    print(f"   Contenido: {content[:150]}...")
-                                    
-                                    # Agregar este documento al inicio con score alto
-                                    points.insert(0, {
-                                        'id': scroll_point.get('id'),
-                                        'score': 1.5,  # Score artificial alto para priorizarlo
-                                        'payload': scroll_point.get('payload', {})
-                                    })
-                                    found_match = True
-                                    break
-                            
-                            if not found_match:
-                                print(f"❌ No se encontró documento con: {dia_semana_target} {dia_numero_target} de {mes_target}")
-                    except Exception as scroll_error:
-                        print(f"⚠️  Error en scroll search: {scroll_error}")
-            
-            if not points:
-                print("⚠️  No se encontraron documentos relevantes")
-                print("   Esto puede significar que:")
-                print("   1. La colección está vacía (points_count = 0)")
-                print("   2. El score threshold es muy alto")
-                print("   3. Los embeddings no coinciden (diferentes task_types)")
-                return []
-            
-            # Primero, construir la lista de documentos con scores
-            doc_candidates = []
-            for point in points:
-                payload = point.get('payload', {})
-                content = payload.get('content', payload.get('text', ''))
-                
-                if content:
-                    score = point.get('score', 0)
-                    doc_candidates.append({
-                        'point': point,
-                        'content': content,
-                        'score': score,
-                        'payload': payload
-                    })
-            
-            # RE-RANKING: Si la pregunta tiene fecha específica, priorizar documentos con esa fecha
-            if target_date:  # Si se detectó una referencia temporal
-                print(f"🎯 Aplicando re-ranking por coincidencia de fecha exacta...")
-                
-                # Extraer los componentes de la fecha objetivo
-                dia_semana = dias[target_date.weekday()]
-                dia_numero = str(target_date.day)
-                mes_actual = meses[target_date.month - 1]
-                
-                # Re-ordenar documentos: los que contienen la fecha exacta van primero
-                exact_matches = []
-                partial_matches = []
-                other_docs = []
+        payload = build_search_payload(question_vector, target_date, limit)
+        with span('vector_search'):
+            # El espejo toma un lock de archivo y lee disco: fuera del event loop
+            points = await asyncio.to_thread(mirror_search, collection_name, question_vector, payload['limit'])
+            if points is not None:
+                count(SEARCH_REQUESTS, source='mirror')
+                log.info("⚡ Búsqueda en el espejo local: %s resultados", len(points))
+            else:
+                count(SEARCH_REQUESTS, source='qdrant')
+                response = await async_qdrant_request(
+                    'POST',
+                    f"/collections/{collection_name}/points/search",
+                    json=payload,
+                    idempotent=True
+                )
                 
-                for doc in doc_candidates:
-                    content_lower = doc['content'].lower()
-                    
-                    # Coincidencia EXACTA: contiene día de semana + número + mes
-                    if (dia_semana.lower() in content_lower and 
-                        dia_numero in doc['content'] and 
-                        mes_actual in content_lower):
-                        # BOOST: dar score adicional a coincidencias exactas
-                        doc['score'] = doc['score'] + 0.5  
-                        exact_matches.append(doc)
-                        print(f"   ✅ MATCH EXACTO: {doc['content'][:100]}... (score: {doc['score']:.3f})")
-                    # Coincidencia PARCIAL: solo día de semana o solo número+mes
-                    elif (dia_semana.lower() in content_lower or 
-                          (dia_numero in doc['content'] and mes_actual in content_lower)):
-                        doc['score'] = doc['score'] + 0.2
-                        partial_matches.append(doc)
-                        print(f"   🔸 MATCH PARCIAL: {doc['content'][:100]}... (score: {doc['score']:.3f})")
+                if response.status_code != 200:
+                    log.error("❌ Error en la búsqueda de Qdrant: %s - %s", response.status_code, response.text)
+                    return []
+
+                points = response.json().get('result', [])
+                log.info("📄 Resultados encontrados: %s", len(points))
+        with span('lexical_fusion'):
+            points = fuse_lexical_results(collection_name, enriched_question, points, payload['limit'])
+        
+        if target_date and not has_exact_date_match(points, target_date):
+            log.info("🔄 Consulta filtrada por fecha: %s", target_date.strftime('%Y-%m-%d'))
+            try:
+                with span('scroll'):
+                    date_points = await asyncio.to_thread(
+                        mirror_find, collection_name, date_payload_filter(target_date)
+                    )
+                    if date_points is None:
+                        date_points = await find_page_by_date_async(collection_name, target_date)
+                        count(FALLBACK_SCROLLS, source='qdrant')
                     else:
-                        other_docs.append(doc)
-                        print(f"   📄 Doc encontrado (score: {doc['score']:.3f}): {doc['content'][:100]}...")
-                
-                # Combinar: exact matches primero, luego partial, luego otros
-                doc_candidates = exact_matches + partial_matches + other_docs
-            else:
-                # Sin enriquecimiento de fecha, solo mostrar scores
-                for doc in doc_candidates:
-                    print(f"   📄 Doc encontrado (score: {doc['score']:.3f}): {doc['content'][:100]}...")
-            
-            # Convertir a objetos Document
-            relevant_docs = []
-            for doc in doc_candidates[:limit]:  # Limitar al número solicitado
-                relevant_docs.append(Document(
-                    doc_id=str(doc['point'].get('id', '')),
-                    content=doc['content'],
-                    metadata=doc['payload'].get('metadata', {})
-                ))
-            
-            print(f"📚 Total de documentos procesados: {len(relevant_docs)}")
-            return relevant_docs
-        else:
-            print(f"❌ Error en la búsqueda de Qdrant: {response.status_code} - {response.text}")
-            return []
+                        count(FALLBACK_SCROLLS, source='mirror')
+                prepend_date_point(points, date_points, target_date)
+            except Exception as scroll_error:
+                log.warning("⚠️  Error en consulta filtrada por fecha: %s", scroll_error)
+        
+        with span('rerank'):
+            return rank_documents(points, target_date, limit)
             
     except Exception as e:
-        print(f"❌ Error en get_documents: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("❌ Error en get_documents_async: %s", e)
         return []
@@ -0,0 +1,451 @@
+"""
+Sustitutos locales de Gemini y Qdrant para benchmarks (ver benchmark.py).
+
+- FakeGemini reemplaza embed_content / GenerativeModel de google.generativeai
+  con latencia configurable e inyección de errores 429.
+- FakeQdrant es un servidor HTTP en un hilo que implementa la parte de la API
+  REST que usa el backend (colección, search, scroll con filtro, upsert,
+  delete, payload e índices), sembrado con páginas sintéticas de lecciones.
+
+Los embeddings falsos son una bolsa de palabras con vectores aleatorios por
+término (deterministas), así que textos parecidos dan vectores parecidos y
+la búsqueda devuelve resultados con sentido.
+"""
+import json
+import time
+import random
+import hashlib
+import textwrap
+import threading
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import numpy as np
+import google.generativeai as genai
+from google.api_core.exceptions import ResourceExhausted
+from lesson_dates import MESES, infer_year, extract_lesson_fields
+from lexical_index import tokenize
+
+DIAS = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
+EMBEDDING_DIMENSION = 768
+
+_TOPICS = [
+    ('LAS PLAGAS', ['plagas', 'Egipto', 'faraón', 'Moisés', 'juicio', 'libertad']),
+    ('LA FÓRMULA DEL ÉXITO', ['Josué', 'éxito', 'ley', 'meditar', 'valor', 'promesa']),
+    ('DIOS PELEA POR USTEDES', ['Jericó', 'Rahab', 'herem', 'guerra', 'batalla', 'fe']),
+    ('EL ENEMIGO INTERNO', ['Acán', 'pecado', 'Hai', 'confesión', 'pueblo', 'pacto']),
+    ('MONUMENTOS DE GRACIA', ['Jordán', 'piedras', 'memoria', 'gracia', 'arca', 'generaciones']),
+]
+_FILLER = ('la lección estudia cómo el pueblo de Dios aprende a confiar en sus promesas '
+           'mientras enfrenta pruebas y decide seguir su voluntad cada día').split()
+
+_term_vectors = {}
+_term_lock = threading.Lock()
+
+
+def _term_vector(term):
+    with _term_lock:
+        vector = _term_vectors.get(term)
+        if vector is None:
+            seed = int.from_bytes(hashlib.md5(term.encode('utf-8')).digest()[:8], 'little')
+            vector = np.random.default_rng(seed).standard_normal(EMBEDDING_DIMENSION).astype(np.float32)
+            _term_vectors[term] = vector
+        return vector
+
+
+def fake_embedding(text) -> list:
+    """Embedding determinista (bolsa de palabras) de dimensión 768"""
+    vector = np.zeros(EMBEDDING_DIMENSION, dtype=np.float32)
+    for term in tokenize(text):
+        vector += _term_vector(term)
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+def synthetic_lesson_pages(weeks=6, start=None, seed=0, page_chars=2500) -> list:
+    """
+    Páginas de lecciones (una por día) alrededor de hoy: cada una con el
+    encabezado "Lección N | Día D de mes" que usa la búsqueda por fecha.
+    Devuelve dicts {'content', 'lesson_number', 'lesson_date'}.
+    """
+    rng = random.Random(seed)
+    today = date.today()
+    # Las lecciones empiezan en sábado; se centra el rango en la semana actual
+    start = start or today - timedelta(days=(today.weekday() - 5) % 7 + 7 * (weeks // 2))
+    pages = []
+    for week in range(weeks):
+        title, keywords = _TOPICS[week % len(_TOPICS)]
+        lesson_number = week + 1
+        for offset in range(7):
+            day = start + timedelta(days=7 * week + offset)
+            header = (f"Lección {lesson_number} | {DIAS[day.weekday()]} {day.day} de "
+                      f"{MESES[day.month - 1]}\n{title}\n")
+            words = []
+            while sum(len(w) + 1 for w in words) < page_chars - len(header):
+                words.append(rng.choice(keywords) if rng.random() < 0.15 else rng.choice(_FILLER))
+            body = '\n'.join(textwrap.wrap(' '.join(words), 90))
+            pages.append({
+                'content': header + body,
+                'lesson_number': lesson_number,
+                'lesson_date': day.strftime('%Y-%m-%d')
+            })
+    return pages
+
+
+def build_pdf(page_texts) -> bytes:
+    """PDF mínimo (Helvetica, WinAnsi) con una página por texto, legible por PyPDF2"""
+    def escape(line):
+        return line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+    objects = {
+        1: b"<< /Type /Catalog /Pages 2 0 R >>",
+        3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    }
+    page_ids = []
+    next_id = 4
+    for text in page_texts:
+        page_id, content_id = next_id, next_id + 1
+        next_id += 2
+        lines = [escape(line) for line in text.split('\n')]
+        stream = "BT /F1 9 Tf 11 TL 40 800 Td " + ' '.join(f"({line}) Tj T*" for line in lines) + " ET"
+        data = stream.encode('cp1252', 'replace')
+        objects[content_id] = b"<< /Length %d >>\nstream\n" % len(data) + data + b"\nendstream"
+        objects[page_id] = (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>"
+        ).encode()
+        page_ids.append(page_id)
+    kids = ' '.join(f"{page_id} 0 R" for page_id in page_ids)
+    objects[2] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode()
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for object_id in range(1, next_id):
+        offsets[object_id] = len(out)
+        out += b"%d 0 obj\n" % object_id + objects[object_id] + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % next_id
+    for object_id in range(1, next_id):
+        out += b"%010d 00000 n \n" % offsets[object_id]
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (next_id, xref)
+    return bytes(out)
+
+
+# --- Gemini ---
+
+class _FakeUsage:
+    def __init__(self, total_token_count):
+        self.total_token_count = total_token_count
+
+
+class _FakeResponse:
+    def __init__(self, text, tokens):
+        self.text = text
+        self.usage_metadata = _FakeUsage(tokens)
+
+
+class _FakeStream:
+    def __init__(self, chunks, tokens, delay):
+        self._chunks = chunks
+        self._delay = delay
+        self.usage_metadata = _FakeUsage(tokens)
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            time.sleep(self._delay)
+            yield _FakeResponse(chunk, 0)
+
+
+class FakeGemini:
+    """
+    Sustituye la API de Gemini mientras está instalado.
+
+    Args:
+        embed_latency: Segundos por llamada a embed_content (lote o texto)
+        llm_latency: Segundos por respuesta del LLM (se reparte entre fragmentos en streaming)
+        error_rate: Probabilidad de responder 429 en cada llamada
+        jitter: Variación relativa de la latencia (0.2 = ±20 %)
+        slow_rate: Probabilidad de que una respuesta del LLM caiga en la cola lenta
+        slow_factor: Cuántas veces más tarda una respuesta de la cola lenta
+    """
+
+    def __init__(self, embed_latency=0.05, llm_latency=0.8, error_rate=0.0, jitter=0.2, seed=0,
+                 slow_rate=0.0, slow_factor=5.0):
+        self.embed_latency = embed_latency
+        self.llm_latency = llm_latency
+        self.error_rate = error_rate
+        self.jitter = jitter
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self._saved = {}
+        self.stats = {'embed_calls': 0, 'embedded_texts': 0, 'llm_calls': 0, 'injected_429': 0, 'slow_llm': 0}
+
+    def _sleep(self, seconds):
+        with self._rng_lock:
+            factor = 1 + self._rng.uniform(-self.jitter, self.jitter)
+        time.sleep(max(0.0, seconds * factor))
+
+    def _llm_latency(self):
+        with self._rng_lock:
+            slow = self._rng.random() < self.slow_rate
+        if slow:
+            self.stats['slow_llm'] += 1
+            return self.llm_latency * self.slow_factor
+        return self.llm_latency
+
+    def _maybe_fail(self, kind):
+        with self._rng_lock:
+            fail = self._rng.random() < self.error_rate
+        if fail:
+            self.stats['injected_429'] += 1
+            if kind == 'llm':
+                raise ResourceExhausted('429 Resource exhausted (fake)')
+            raise Exception('429 Resource exhausted (fake)')
+
+    def embed_content(self, model=None, content=None, task_type=None, **kwargs):
+        self._sleep(self.embed_latency)
+        self._maybe_fail('embed')
+        self.stats['embed_calls'] += 1
+        if isinstance(content, list):
+            self.stats['embedded_texts'] += len(content)
+            return {'embedding': [fake_embedding(text) for text in content]}
+        self.stats['embedded_texts'] += 1
+        return {'embedding': fake_embedding(content)}
+
+    async def embed_content_async(self, model=None, content=None, task_type=None, **kwargs):
+        import asyncio
+        return await asyncio.to_thread(self.embed_content, model, content, task_type)
+
+    def _answer(self, content):
+        text = str(content)
+        question = text.rsplit('PREGUNTA DEL USUARIO:', 1)[-1].split('\n', 1)[0].strip()
+        answer = f"Respuesta simulada para: {question}. " + ' '.join(_FILLER[:20])
+        return answer, len(text) // 4 + len(answer) // 4
+
+    def generative_model(self, model_name='gemini-fake', system_instruction=None, **kwargs):
+        fake = self
+
+        class FakeGenerativeModel:
+            def __init__(self):
+                self.model_name = model_name
+                self._system_instruction = system_instruction
+
+            def generate_content(self, content, stream=False, **kw):
+                fake._maybe_fail('llm')
+                fake.stats['llm_calls'] += 1
+                answer, tokens = fake._answer(content)
+                if stream:
+                    chunks = [answer[i:i + 40] for i in range(0, len(answer), 40)]
+                    return _FakeStream(chunks, tokens, fake.llm_latency / max(1, len(chunks)))
+                fake._sleep(fake._llm_latency())
+                return _FakeResponse(answer, tokens)
+
+            async def generate_content_async(self, content, **kw):
+                import asyncio
+                return await asyncio.to_thread(self.generate_content, content)
+
+        return FakeGenerativeModel()
+
+    def install(self):
+        self._saved = {
+            'embed_content': genai.embed_content,
+            'embed_content_async': genai.embed_content_async,
+            'GenerativeModel': genai.GenerativeModel,
+            'configure': genai.configure,
+        }
+        genai.embed_content = self.embed_content
+        genai.embed_content_async = self.embed_content_async
+        genai.GenerativeModel = self.generative_model
+        genai.configure = lambda **kwargs: None
+        return self
+
+    def uninstall(self):
+        for name, value in self._saved.items():
+            setattr(genai, name, value)
+        self._saved = {}
+
+
+# --- Qdrant ---
+
+class _Collection:
+    def __init__(self, size):
+        self.size = size
+        self.points = {}  # id -> (vector normalizado, payload)
+        self.lock = threading.Lock()
+
+
+def _payload_value(payload, dotted_key):
+    value = payload
+    for part in dotted_key.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def _matches(payload, query_filter):
+    for condition in (query_filter or {}).get('must', []):
+        if _payload_value(payload, condition['key']) != condition.get('match', {}).get('value'):
+            return False
+    return True
+
+
+class FakeQdrant:
+    """
+    Servidor HTTP local compatible con las rutas REST de Qdrant que usa el
+    backend. latency simula el viaje de red por solicitud.
+    """
+
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.collections = {}
+        self.stats = {'requests': 0}
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _handle(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'{}') if length else {}
+                fake.stats['requests'] += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                status, response = fake.handle(method, urlparse(self.path).path, body)
+                self._reply(status, response)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def do_PUT(self):
+                self._handle('PUT')
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-qdrant', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def create_collection(self, name, size=EMBEDDING_DIMENSION):
+        self.collections[name] = _Collection(size)
+        return self.collections[name]
+
+    def upsert(self, name, points):
+        collection = self.collections[name]
+        with collection.lock:
+            for point in points:
+                vector = np.asarray(point['vector'], dtype=np.float32)
+                norm = np.linalg.norm(vector)
+                collection.points[str(point['id'])] = (vector / norm if norm else vector, point.get('payload', {}))
+
+    def seed_lessons(self, name, weeks=6, file_name='Leccion-sintetica.pdf'):
+        """Crea la colección con páginas sintéticas (mismo formato que la ingesta)"""
+        self.create_collection(name)
+        pages = synthetic_lesson_pages(weeks)
+        year = infer_year(file_name, pages[0]['content'])
+        points = []
+        for page_number, page in enumerate(pages, start=1):
+            metadata = {'page_number': str(page_number), 'filename': file_name,
+                        'total_pages': str(len(pages))}
+            metadata.update(extract_lesson_fields(page['content'], year))
+            points.append({
+                'id': f"00000000-0000-4000-8000-{page_number:012d}",
+                'vector': fake_embedding(page['content']),
+                'payload': {'content': page['content'], 'metadata': metadata}
+            })
+        self.upsert(name, points)
+        return pages
+
+    def handle(self, method, path, body):
+        parts = path.strip('/').split('/')
+        if len(parts) < 2 or parts[0] != 'collections':
+            return 404, {'status': {'error': 'Not found'}}
+        collection = self.collections.get(parts[1])
+        if collection is None:
+            return 404, {'status': {'error': f"Collection {parts[1]} not found"}}
+        action = '/'.join(parts[2:])
+
+        if method == 'GET' and action == '':
+            return 200, {'result': {
+                'status': 'green',
+                'points_count': len(collection.points),
+                'config': {'params': {'vectors': {'size': collection.size, 'distance': 'Cosine'}}}
+            }, 'status': 'ok'}
+        if method == 'PUT' and action == 'index':
+            return 200, {'result': {'status': 'acknowledged'}, 'status': 'ok'}
+        if method == 'PUT' and action == 'points':
+            self.upsert(parts[1], body.get('points', []))
+            return 200, {'result': {'status': 'completed'}, 'status': 'ok'}
+        if method == 'POST' and action == 'points/delete':
+            with collection.lock:
+                for point_id in body.get('points', []):
+                    collection.points.pop(str(point_id), None)
+            return 200, {'result': {'status': 'completed'}, 'status': 'ok'}
+        if method == 'POST' and action == 'points/payload':
+            with collection.lock:
+                for point_id in body.get('points', []):
+                    vector, payload = collection.points[str(point_id)]
+                    collection.points[str(point_id)] = (vector, {**payload, **body.get('payload', {})})
+            return 200, {'result': {'status': 'completed'}, 'status': 'ok'}
+        if method == 'POST' and action == 'points/search':
+            return 200, {'result': self._search(collection, body), 'status': 'ok'}
+        if method == 'POST' and action == 'points/scroll':
+            return 200, {'result': self._scroll(collection, body), 'status': 'ok'}
+        return 404, {'status': {'error': f"Unsupported {method} {path}"}}
+
+    def _search(self, collection, body):
+        with collection.lock:
+            items = list(collection.points.items())
+        if not items:
+            return []
+        query = np.asarray(body['vector'], dtype=np.float32)
+        norm = np.linalg.norm(query)
+        query = query / norm if norm else query
+        scores = np.stack([vector for _, (vector, _) in items]) @ query
+        top = np.argsort(-scores)[:body.get('limit', 10)]
+        return [{'id': items[i][0], 'version': 0, 'score': float(scores[i]), 'payload': items[i][1][1]}
+                for i in top]
+
+    def _scroll(self, collection, body):
+        with collection.lock:
+            items = sorted(collection.points.items())
+        items = [item for item in items if _matches(item[1][1], body.get('filter'))]
+        start = int(body.get('offset') or 0)
+        limit = body.get('limit', 10)
+        page = items[start:start + limit]
+        points = []
+        for point_id, (vector, payload) in page:
+            point = {'id': point_id}
+            if body.get('with_payload', True):
+                point['payload'] = payload
+            if body.get('with_vector'):
+                point['vector'] = vector.tolist()
+            points.append(point)
+        next_offset = start + limit if start + limit < len(items) else None
+        return {'points': points, 'next_page_offset': next_offset}
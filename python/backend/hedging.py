@@ -0,0 +1,228 @@
+"""
+Solicitudes cubiertas (hedging) al LLM para recortar la cola de latencia.
+
+La mayoría de las respuestas de Gemini llegan en ~2 s, pero algunas tardan
+10 s o más. Con LLM_HEDGE_ENABLED, si el modelo elegido no respondió dentro
+del percentil LLM_HEDGE_PERCENTILE de su latencia reciente, el mismo prompt
+se envía a un segundo modelo de GEMINI_MODELS: gana la primera respuesta
+correcta, y si una de las dos falla se espera a la otra.
+
+En asyncio la tarea perdedora se cancela. En hilos (Flask) las dos llamadas
+corren en un pool y terminan en un mismo resultado compartido; el hilo de la
+solicitud espera solo a ese resultado, así que responde en cuanto gana la
+primera. Una llamada bloqueante en curso no se puede interrumpir: la
+perdedora sigue hasta terminar y su respuesta se descarta (si aún esperaba
+turno en el pool, ya no se envía).
+
+Las coberturas salen de un presupuesto: cada solicitud aporta
+LLM_HEDGE_BUDGET coberturas y cada cobertura gasta una entera, así que a la
+larga no pasan de esa fracción de las solicitudes (más LLM_HEDGE_BURST
+acumuladas) y la cuota no se duplica. Además, solo se cubre con un modelo
+de circuito cerrado que tenga presupuesto RPM/TPM en ese momento.
+"""
+import os
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from metrics import count, LLM_HEDGES
+
+LLM_HEDGE_ENABLED = os.getenv('LLM_HEDGE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+# Percentil de la latencia reciente del modelo tras el que se cubre
+LLM_HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', '95'))
+# Respuestas necesarias para confiar en el percentil; con menos se usa la espera por defecto
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', '20'))
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv('LLM_HEDGE_DEFAULT_DELAY', '5'))
+LLM_HEDGE_MIN_DELAY = float(os.getenv('LLM_HEDGE_MIN_DELAY', '0.5'))
+# Coberturas por solicitud (0.1 = como mucho un 10 % más de llamadas) y reserva acumulable
+LLM_HEDGE_BUDGET = float(os.getenv('LLM_HEDGE_BUDGET', '0.1'))
+LLM_HEDGE_BURST = float(os.getenv('LLM_HEDGE_BURST', '3'))
+# Hilos para las llamadas del modo síncrono (la principal y la cobertura)
+LLM_HEDGE_WORKERS = int(os.getenv('LLM_HEDGE_WORKERS', '64'))
+
+
+class HedgeBudget:
+    """Presupuesto de coberturas proporcional al número de solicitudes"""
+
+    def __init__(self, ratio, burst):
+        self.ratio = ratio
+        self.burst = burst
+        self._balance = burst
+        self._lock = threading.Lock()
+        self.stats = {
+            'requests': 0, 'hedges': 0, 'budget_denied': 0, 'no_model': 0,
+            'hedge_wins': 0, 'primary_wins': 0
+        }
+
+    def deposit(self):
+        with self._lock:
+            self.stats['requests'] += 1
+            self._balance = min(self.burst, self._balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._balance < 1:
+                self.stats['budget_denied'] += 1
+                return False
+            self._balance -= 1
+            return True
+
+    def refund(self):
+        """La cobertura no se lanzó (ningún modelo disponible)"""
+        with self._lock:
+            self._balance = min(self.burst, self._balance + 1)
+            self.stats['no_model'] += 1
+
+    def record(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats['balance'] = round(self._balance, 3)
+        return stats
+
+
+hedge_budget = HedgeBudget(LLM_HEDGE_BUDGET, LLM_HEDGE_BURST)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=LLM_HEDGE_WORKERS, thread_name_prefix='llm-hedge')
+        return _executor
+
+
+def hedge_delay(router, model) -> float:
+    """Segundos que se espera al modelo principal antes de cubrir"""
+    latency = router.latency_percentile(model, LLM_HEDGE_PERCENTILE, LLM_HEDGE_MIN_SAMPLES)
+    if latency is None:
+        return LLM_HEDGE_DEFAULT_DELAY
+    return max(LLM_HEDGE_MIN_DELAY, latency)
+
+
+def _start_hedge(choose_hedge):
+    """Modelo de cobertura si el presupuesto lo permite (o None)"""
+    if not hedge_budget.withdraw():
+        count(LLM_HEDGES, result='budget_denied')
+        return None
+    model = choose_hedge()
+    if model is None:
+        hedge_budget.refund()
+        count(LLM_HEDGES, result='no_model')
+        return None
+    hedge_budget.record('hedges')
+    count(LLM_HEDGES, result='launched')
+    return model
+
+
+def _record_winner(launched, winner, primary):
+    if launched > 1:
+        won = winner != primary
+        hedge_budget.record('hedge_wins' if won else 'primary_wins')
+        count(LLM_HEDGES, result='won' if won else 'lost')
+
+
+class _Race:
+    """Resultado compartido de la principal y la cobertura: gana el primer éxito"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.winner = None  # (modelo, resultado)
+        self.errors = {}
+
+    def run(self, model, call):
+        try:
+            value = call(model)
+        except BaseException as e:
+            with self._condition:
+                self.errors[model] = e
+                self._condition.notify_all()
+            return
+        with self._condition:
+            if self.winner is None:
+                self.winner = (model, value)
+            self._condition.notify_all()
+
+    def wait(self, launched, timeout=None) -> bool:
+        """Hasta un éxito o hasta que fallen las 'launched' llamadas; False si vence timeout"""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self.winner is not None or len(self.errors) >= launched, timeout
+            )
+
+
+def run_hedged(primary, call, delay, choose_hedge, tried):
+    """
+    Ejecuta call(primary) y, si no termina en 'delay' segundos, también
+    call(modelo de cobertura); el modelo de cobertura se agrega a 'tried'.
+
+    Returns:
+        El primer resultado correcto
+
+    Raises:
+        El error del modelo principal si ninguna llamada tuvo éxito
+    """
+    hedge_budget.deposit()
+    executor = _get_executor()
+    race = _Race()
+    # Cada llamada con su copia del contexto (request_id de los logs)
+    futures = [executor.submit(contextvars.copy_context().run, race.run, primary, call)]
+
+    if not race.wait(1, timeout=delay):
+        hedge = _start_hedge(choose_hedge)
+        if hedge is not None:
+            tried.add(hedge)
+            futures.append(executor.submit(contextvars.copy_context().run, race.run, hedge, call))
+
+    race.wait(len(futures))
+    # La perdedora que aún esperaba turno en el pool ya no se envía
+    for future in futures:
+        future.cancel()
+    if race.winner is None:
+        raise race.errors[primary]
+    model, value = race.winner
+    _record_winner(len(futures), model, primary)
+    return value
+
+
+async def run_hedged_async(primary, call, delay, choose_hedge, tried):
+    """Variante asyncio de run_hedged: call(modelo) devuelve la corrutina y la perdedora se cancela"""
+    hedge_budget.deposit()
+    tasks = {asyncio.ensure_future(call(primary)): primary}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            hedge = _start_hedge(choose_hedge)
+            if hedge is not None:
+                tried.add(hedge)
+                tasks[asyncio.ensure_future(call(hedge))] = hedge
+
+        pending, errors = set(tasks), {}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    _record_winner(len(tasks), tasks[task], primary)
+                    return task.result()
+                errors[tasks[task]] = task.exception()
+        raise errors[primary]
+    finally:
+        # La perdedora (o todas, si esta solicitud se canceló)
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+def get_hedging_stats() -> dict:
+    return {
+        'enabled': LLM_HEDGE_ENABLED,
+        'percentile': LLM_HEDGE_PERCENTILE,
+        'budget_ratio': LLM_HEDGE_BUDGET,
+        **hedge_budget.get_stats()
+    }
@@ -0,0 +1,142 @@
+"""
+Cola de trabajos de ingesta de PDFs en segundo plano.
+
+/upload y /build_chatbot guardan el archivo, encolan el trabajo y responden
+de inmediato con un job_id. Un pool acotado de hilos (INGESTION_WORKERS)
+ejecuta add_pdf_to_collection, de modo que la ingesta nunca ocupa todos los
+workers que atienden el chat. GET /jobs/<job_id> reporta el progreso.
+"""
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from embeddings import add_pdf_to_collection
+from structured_logging import get_logger
+
+INGESTION_WORKERS = int(os.getenv('INGESTION_WORKERS', '1'))
+INGESTION_JOB_HISTORY = int(os.getenv('INGESTION_JOB_HISTORY', '100'))
+
+log = get_logger('ingestion')
+
+
+class IngestionJob:
+    def __init__(self, collection_name, file_path, file_name):
+        self.id = uuid.uuid4().hex
+        self.collection_name = collection_name
+        self.file_path = file_path
+        self.file_name = file_name
+        self.status = 'queued'
+        self.pages_total = None
+        self.pages_parsed = 0
+        self.pages_embedded = 0
+        self.pages_upserted = 0
+        self.pages_skipped = 0
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def progress(self, stage, count, total=None):
+        """
+        Callback de progreso de add_pdf_to_collection.
+
+        Args:
+            stage: 'parsed' (páginas con contenido), 'embedded', 'upserted' o
+                   'skipped' (sin cambios)
+            count: Páginas completadas en esta llamada (se acumulan)
+            total: Total de páginas del PDF, si ya se conoce
+        """
+        with self._lock:
+            if total is not None:
+                self.pages_total = total
+            if stage == 'parsed':
+                self.pages_parsed += count
+            elif stage == 'embedded':
+                self.pages_embedded += count
+            elif stage == 'upserted':
+                self.pages_upserted += count
+            elif stage == 'skipped':
+                self.pages_skipped += count
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'job_id': self.id,
+                'status': self.status,
+                'filename': self.file_name,
+                'collection': self.collection_name,
+                'pages_total': self.pages_total,
+                'pages_parsed': self.pages_parsed,
+                'pages_embedded': self.pages_embedded,
+                'pages_upserted': self.pages_upserted,
+                'pages_skipped': self.pages_skipped,
+                'result': self.result,
+                'error': self.error,
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+            }
+
+
+class IngestionQueue:
+    def __init__(self, workers=INGESTION_WORKERS, history=INGESTION_JOB_HISTORY):
+        self.workers = max(1, workers)
+        self.history = history
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix='ingestion'
+        )
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, collection_name, file_path, file_name) -> IngestionJob:
+        job = IngestionJob(collection_name, file_path, file_name)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim_locked()
+        self._executor.submit(self._run, job)
+        log.info("📥 Trabajo de ingesta %s encolado: %s", job.id, file_name)
+        return job
+
+    def _run(self, job):
+        with job._lock:
+            job.status = 'running'
+            job.started_at = time.time()
+        try:
+            result = add_pdf_to_collection(
+                job.collection_name, job.file_path, job.file_name, progress=job.progress
+            )
+            with job._lock:
+                job.result = result
+                job.status = 'done'
+            log.info("✅ Trabajo de ingesta %s terminado: %s páginas", job.id, result.get('pages_added'))
+        except Exception as e:
+            with job._lock:
+                job.error = str(e)
+                job.status = 'failed'
+            log.error("❌ Trabajo de ingesta %s falló: %s", job.id, e)
+        finally:
+            with job._lock:
+                job.finished_at = time.time()
+
+    def _trim_locked(self):
+        """Descarta los trabajos terminados más antiguos por encima del historial"""
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in ('done', 'failed')]
+        while len(self._jobs) > self.history and finished:
+            self._jobs.pop(finished.pop(0), None)
+
+    def get(self, job_id) -> IngestionJob | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> list:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [job.to_dict() for job in reversed(jobs)]
+
+
+# Cola compartida por todo el proceso
+ingestion_queue = IngestionQueue()
@@ -0,0 +1,204 @@
+"""
+Extracción en tiempo de ingesta de la fecha de cada página de lección.
+
+Las páginas de la Escuela Sabática llevan un encabezado del tipo
+"Lección 6 | Martes 4 de noviembre" (o "Lección 4: ..." seguido de
+"Domingo 20 de julio" en las ediciones para maestros). Al ingerir se guarda como campos
+estructurados en el payload (metadata.lesson_number y metadata.lesson_date
+en formato ISO), indexados en Qdrant, para que una pregunta con fecha se
+resuelva con una consulta filtrada en lugar de recorrer toda la colección.
+"""
+import re
+import unicodedata
+from datetime import date, datetime
+from qdrant_transport import qdrant_request, async_qdrant_request
+from structured_logging import get_logger
+
+MESES = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio',
+         'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre']
+
+LESSON_NUMBER_FIELD = 'metadata.lesson_number'
+# Lo usa la re-ingesta para encontrar las páginas ya subidas de un archivo
+FILENAME_FIELD = 'metadata.filename'
+LESSON_DATE_FIELD = 'metadata.lesson_date'
+
+log = get_logger('lesson_dates')
+
+# "Domingo 12 de octubre" (el día de la semana evita capturar "Para el 18 de octubre")
+_DAY_PATTERN = re.compile(
+    r'(lunes|martes|mi[eé]rcoles|jueves|viernes|s[aá]bado|domingo)\s+'
+    r'(\d{1,2})\s+de\s+(' + '|'.join(MESES) + r')(?![a-záéíóúñ])',
+    re.IGNORECASE
+)
+_LESSON_PATTERN = re.compile(r'lecci[oó]n\s*(\d{1,2})\b', re.IGNORECASE)
+_YEAR_PATTERN = re.compile(r'(?<!\d)(20\d{2})(?!\d)')
+
+# Colecciones cuyos índices ya se crearon en este proceso
+_indexed_collections = set()
+
+
+def _normalize(text: str) -> str:
+    return unicodedata.normalize('NFC', text or '')
+
+
+def infer_year(file_name: str, content: str = '', default=None) -> int:
+    """Año de la lección: del nombre del archivo, del texto, o el año actual"""
+    for source in (file_name or '', content or ''):
+        match = _YEAR_PATTERN.search(source)
+        if match:
+            return int(match.group(1))
+    return default or datetime.now().year
+
+
+def extract_lesson_fields(content: str, year: int) -> dict:
+    """
+    Busca el número de lección ("Lección 3 | ...", "Lección 4: ...") y el
+    encabezado del día ("Domingo 12 de octubre") en el texto de la página.
+
+    Returns:
+        Diccionario con lesson_number y/o lesson_date (ISO), vacío si la
+        página no trae encabezados reconocibles
+    """
+    content = _normalize(content)
+    fields = {}
+
+    match = _LESSON_PATTERN.search(content)
+    if not match:
+        # Sin "Lección X" no es una página de lección (ej. fechas de un BOE)
+        return fields
+    fields['lesson_number'] = int(match.group(1))
+
+    match = _DAY_PATTERN.search(content)
+    if match:
+        day = int(match.group(2))
+        month = MESES.index(match.group(3).lower()) + 1
+        try:
+            fields['lesson_date'] = date(year, month, day).isoformat()
+        except ValueError:
+            pass
+    return fields
+
+
+def ensure_lesson_indexes(collection_name: str):
+    """Crea (una vez por proceso) los índices de payload para los campos de lección y el archivo"""
+    if collection_name in _indexed_collections:
+        return
+
+    for field_name, schema in ((LESSON_DATE_FIELD, 'keyword'), (LESSON_NUMBER_FIELD, 'integer'),
+                               (FILENAME_FIELD, 'keyword')):
+        response = qdrant_request(
+            'PUT',
+            f"/collections/{collection_name}/index",
+            json={'field_name': field_name, 'field_schema': schema}
+        )
+        if response.status_code != 200:
+            log.warning("⚠️ No se pudo crear el índice %s: %s - %s",
+                        field_name, response.status_code, response.text)
+            return
+
+    _indexed_collections.add(collection_name)
+    log.info("🗂️ Índices de lección listos en '%s'", collection_name)
+
+
+def date_filter_body(target_date, limit=1) -> dict:
+    """Cuerpo de /points/scroll filtrado por metadata.lesson_date (date o datetime)"""
+    return {
+        'filter': {
+            'must': [
+                {'key': LESSON_DATE_FIELD, 'match': {'value': target_date.strftime('%Y-%m-%d')}}
+            ]
+        },
+        'limit': limit,
+        'with_payload': True,
+        'with_vector': False
+    }
+
+
+def _date_points(response) -> list:
+    if response.status_code != 200:
+        log.warning("⚠️ Error en búsqueda filtrada por fecha: %s - %s", response.status_code, response.text)
+        return []
+    return response.json().get('result', {}).get('points', [])
+
+
+def find_page_by_date(collection_name: str, target_date, limit=1) -> list:
+    """
+    Devuelve los puntos cuya metadata.lesson_date coincide con target_date
+    usando una consulta filtrada (una sola llamada, independiente del
+    tamaño de la colección).
+    """
+    response = qdrant_request(
+        'POST',
+        f"/collections/{collection_name}/points/scroll",
+        json=date_filter_body(target_date, limit),
+        idempotent=True
+    )
+    return _date_points(response)
+
+
+async def find_page_by_date_async(collection_name: str, target_date, limit=1) -> list:
+    """Versión asíncrona de find_page_by_date"""
+    response = await async_qdrant_request(
+        'POST',
+        f"/collections/{collection_name}/points/scroll",
+        json=date_filter_body(target_date, limit),
+        idempotent=True
+    )
+    return _date_points(response)
+
+
+def backfill_lesson_fields(collection_name: str, year=None, page_size=256) -> int:
+    """
+    Agrega los campos de lección a los puntos existentes (por ejemplo los
+    cargados desde n8n) recorriendo la colección UNA vez, paginada.
+
+    Returns:
+        Número de puntos actualizados
+    """
+    ensure_lesson_indexes(collection_name)
+    updated = 0
+    offset = None
+
+    while True:
+        body = {'limit': page_size, 'with_payload': True, 'with_vector': False}
+        if offset is not None:
+            body['offset'] = offset
+        response = qdrant_request(
+            'POST', f"/collections/{collection_name}/points/scroll", json=body, idempotent=True
+        )
+        if response.status_code != 200:
+            raise ValueError(f"Error recorriendo '{collection_name}': {response.status_code}")
+
+        result = response.json().get('result', {})
+        for point in result.get('points', []):
+            payload = point.get('payload', {})
+            metadata = payload.get('metadata') or {}
+            if 'lesson_date' in metadata:
+                continue
+            point_year = year or infer_year(metadata.get('filename', ''), payload.get('content', ''))
+            fields = extract_lesson_fields(payload.get('content', ''), point_year)
+            if not fields:
+                continue
+            qdrant_request(
+                'POST',
+                f"/collections/{collection_name}/points/payload",
+                json={'payload': {'metadata': {**metadata, **fields}}, 'points': [point['id']]}
+            )
+            updated += 1
+
+        offset = result.get('next_page_offset')
+        if offset is None:
+            break
+
+    log.info("✅ Campos de lección agregados a %s puntos de '%s'", updated, collection_name)
+    return updated
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    target_collection = sys.argv[1] if len(sys.argv) > 1 else os.getenv('QDRANT_COLLECTION', 'ESCUELA-SABATICA')
+    backfill_lesson_fields(target_collection)
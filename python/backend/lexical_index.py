@@ -0,0 +1,224 @@
+"""
+Índice léxico BM25 en memoria para búsqueda híbrida.
+
+Los embeddings fallan justo donde el usuario escribe términos exactos
+("lección 6", "herem", "Rahab"). Este índice vive en el proceso: se
+construye desde los payloads de la colección en Qdrant al arrancar (en
+segundo plano) y se actualiza de forma incremental en cada ingesta. Sus
+resultados se combinan con los de la búsqueda vectorial por Reciprocal Rank
+Fusion (RRF), que solo usa posiciones y no necesita normalizar scores de
+naturaleza distinta.
+"""
+import os
+import re
+import math
+import threading
+import unicodedata
+from collections import Counter
+from qdrant_transport import qdrant_request
+from structured_logging import get_logger
+
+LEXICAL_INDEX_ENABLED = os.getenv('LEXICAL_INDEX_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+BM25_K1 = float(os.getenv('BM25_K1', '1.5'))
+BM25_B = float(os.getenv('BM25_B', '0.75'))
+# Constante k de RRF: 1 / (k + posición)
+RRF_K = int(os.getenv('RRF_K', '60'))
+
+log = get_logger('lexical_index')
+
+_STOPWORDS = {
+    'a', 'al', 'como', 'con', 'cual', 'de', 'del', 'el', 'en', 'es', 'esta', 'este', 'la',
+    'las', 'le', 'lo', 'los', 'me', 'mi', 'para', 'por', 'que', 'se', 'si', 'su', 'sus',
+    'un', 'una', 'y', 'o', 'u', 'e'
+}
+_WORD_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> list:
+    """
+    Palabras normalizadas (minúsculas, sin tildes ni stopwords). Además, cada
+    palabra seguida de un número genera un término compuesto ("leccion_6"),
+    para que "lección 6" no se diluya entre todos los "6" del documento.
+    """
+    text = unicodedata.normalize('NFKD', (text or '').lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    words = _WORD_PATTERN.findall(text)
+    terms = [w for w in words if w not in _STOPWORDS]
+    for word, following in zip(words, words[1:]):
+        if following.isdigit() and not word.isdigit():
+            terms.append(f"{word}_{following}")
+    return terms
+
+
+class BM25Index:
+    """Índice invertido BM25 de una colección (id de punto -> payload)"""
+
+    def __init__(self, collection_name):
+        self.collection_name = collection_name
+        self._postings = {}   # término -> {id: frecuencia}
+        self._lengths = {}    # id -> número de términos
+        self._doc_terms = {}  # id -> términos distintos (para poder quitar el punto)
+        self._payloads = {}   # id -> payload (para devolver puntos sin ir a Qdrant)
+        self._total_length = 0
+        self._lock = threading.Lock()
+        self.ready = False
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def _remove_locked(self, point_id):
+        length = self._lengths.pop(point_id, None)
+        if length is None:
+            return
+        self._total_length -= length
+        del self._payloads[point_id]
+        for term in self._doc_terms.pop(point_id):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(point_id, None)
+                if not postings:
+                    del self._postings[term]
+
+    def add(self, point_id, payload):
+        point_id = str(point_id)
+        terms = Counter(tokenize(payload.get('content', payload.get('text', ''))))
+        with self._lock:
+            self._remove_locked(point_id)
+            for term, frequency in terms.items():
+                self._postings.setdefault(term, {})[point_id] = frequency
+            length = sum(terms.values())
+            self._lengths[point_id] = length
+            self._doc_terms[point_id] = list(terms)
+            self._payloads[point_id] = payload
+            self._total_length += length
+
+    def add_points(self, points):
+        for point in points:
+            self.add(point['id'], point.get('payload', {}))
+
+    def remove(self, point_ids):
+        with self._lock:
+            for point_id in point_ids:
+                self._remove_locked(str(point_id))
+
+    def search(self, query, limit=8) -> list:
+        """Devuelve puntos {'id', 'score', 'payload'} ordenados por BM25"""
+        query_terms = set(tokenize(query))
+        with self._lock:
+            total_docs = len(self._lengths)
+            if not total_docs or not query_terms:
+                return []
+            avg_length = self._total_length / total_docs
+            scores = Counter()
+            for term in query_terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (total_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for point_id, frequency in postings.items():
+                    norm = 1 - BM25_B + BM25_B * self._lengths[point_id] / avg_length
+                    scores[point_id] += idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * norm)
+            return [
+                {'id': point_id, 'score': score, 'payload': self._payloads[point_id]}
+                for point_id, score in scores.most_common(limit)
+            ]
+
+    def build(self, page_size=256):
+        """Carga todos los payloads de la colección desde Qdrant (scroll sin vectores)"""
+        offset = None
+        loaded = 0
+        while True:
+            body = {'limit': page_size, 'with_payload': True, 'with_vector': False}
+            if offset is not None:
+                body['offset'] = offset
+            response = qdrant_request(
+                'POST', f"/collections/{self.collection_name}/points/scroll", json=body,
+                timeout=30, idempotent=True
+            )
+            if response.status_code != 200:
+                raise ValueError(f"Error recorriendo '{self.collection_name}': {response.status_code}")
+
+            result = response.json().get('result', {})
+            points = result.get('points', [])
+            self.add_points(points)
+            loaded += len(points)
+            offset = result.get('next_page_offset')
+            if offset is None:
+                break
+
+        self.ready = True
+        log.info("🔤 Índice BM25 de '%s' listo: %s páginas, %s términos",
+                 self.collection_name, loaded, len(self._postings))
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {'ready': self.ready, 'documents': len(self._lengths), 'terms': len(self._postings)}
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_lexical_index(collection_name) -> BM25Index:
+    """Índice de la colección; la primera vez lo construye en segundo plano"""
+    with _indexes_lock:
+        index = _indexes.get(collection_name)
+        if index is not None:
+            return index
+        index = _indexes[collection_name] = BM25Index(collection_name)
+
+    def build():
+        try:
+            index.build()
+        except Exception as e:
+            log.warning("⚠️ No se pudo construir el índice BM25 de '%s': %s", collection_name, e)
+            with _indexes_lock:
+                # Se reintenta en la próxima consulta
+                if _indexes.get(collection_name) is index and not index.ready:
+                    del _indexes[collection_name]
+
+    threading.Thread(target=build, name=f'bm25-{collection_name}', daemon=True).start()
+    return index
+
+
+def lexical_search(collection_name, query, limit=8) -> list:
+    """Búsqueda BM25; lista vacía si está desactivado o el índice aún se construye"""
+    if not LEXICAL_INDEX_ENABLED:
+        return []
+    index = get_lexical_index(collection_name)
+    if not index.ready:
+        return []
+    return index.search(query, limit)
+
+
+def index_points(collection_name, points):
+    """Actualización incremental tras un upsert de la ingesta"""
+    if LEXICAL_INDEX_ENABLED:
+        get_lexical_index(collection_name).add_points(points)
+
+
+def remove_points(collection_name, point_ids):
+    if LEXICAL_INDEX_ENABLED:
+        get_lexical_index(collection_name).remove(point_ids)
+
+
+def reciprocal_rank_fusion(*rankings, k=None) -> list:
+    """
+    Une varias listas de puntos (cada una ordenada por relevancia) en una
+    sola: score = suma de 1 / (k + posición). El score de cada punto se
+    reemplaza por el de la fusión.
+    """
+    k = RRF_K if k is None else k
+    fused = {}
+    for ranking in rankings:
+        for position, point in enumerate(ranking, start=1):
+            point_id = str(point.get('id'))
+            entry = fused.setdefault(point_id, {**point, 'score': 0.0})
+            entry['score'] += 1.0 / (k + position)
+    return sorted(fused.values(), key=lambda p: p['score'], reverse=True)
+
+
+def get_lexical_index_stats() -> dict:
+    with _indexes_lock:
+        indexes = dict(_indexes)
+    return {name: index.get_stats() for name, index in indexes.items()}
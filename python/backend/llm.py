@@ -1,119 +1,73 @@
 # -*- coding: utf-8 -*-
 import os
 import time
+import asyncio
+import threading
 from datetime import datetime, timedelta
 import google.generativeai as genai
-from google.api_core.exceptions import ResourceExhausted
-
-# Modelos Gemini disponibles con rotación automática
+from google.generativeai import caching
+from google.api_core.exceptions import (
+    ResourceExhausted, ServiceUnavailable, InternalServerError, DeadlineExceeded, NotFound
+)
+from context_packer import pack_context
+from rate_limiter import rate_limiter, estimate_tokens, parse_retry_after, RateLimitExceeded
+from metrics import span, count, observe_stage, QUOTA_ERRORS, LLM_REQUESTS
+from structured_logging import get_logger
+from model_router import ModelRouter
+from hedging import LLM_HEDGE_ENABLED, run_hedged, run_hedged_async, hedge_delay
+
+log = get_logger('llm')
+
+# Modelos Gemini disponibles; el enrutador elige entre ellos (en empate, por este orden)
 GEMINI_MODELS = [
     'gemini-2.0-flash-exp',      # Modelo principal: 10 RPM, 250K TPM
     'gemini-2.5-flash',           # Alternativa: 10 RPM, 250K TPM  
     'gemini-2.0-flash-lite',      # Backup: 30 RPM, 1M TPM (más rápido)
 ]
 
-_llm_model_index = 0
+# Presupuestos RPM/TPM por modelo para el limitador compartido
+GEMINI_MODEL_LIMITS = {
+    'gemini-2.0-flash-exp': {'rpm': 10, 'tpm': 250_000},
+    'gemini-2.5-flash': {'rpm': 10, 'tpm': 250_000},
+    'gemini-2.0-flash-lite': {'rpm': 30, 'tpm': 1_000_000},
+}
 
-def get_next_llm_model():
-    """Obtiene el siguiente modelo LLM para rotación"""
-    global _llm_model_index
-    model = GEMINI_MODELS[_llm_model_index % len(GEMINI_MODELS)]
-    _llm_model_index += 1
-    return model
+# Errores de Gemini tras los que se prueba otro modelo de inmediato
+TRANSIENT_ERRORS = (ServiceUnavailable, InternalServerError, DeadlineExceeded)
 
-def query_llm(question, relevant_documents, context_lesson=None, max_retries=3):
-    """
-    Genera respuesta usando Google Gemini con el mismo prompt que n8n.
-    
-    Args:
-        question: Pregunta del usuario
-        relevant_documents: Lista de documentos relevantes de Qdrant
-        context_lesson: Lección/fecha del contexto conversacional (opcional)
-        max_retries: Número de reintentos en caso de error de cuota
-    """
-    # Obtener fecha actual en español EN TIEMPO REAL
-    now = datetime.now()
-    
-    # Nombres de días y meses en español
-    dias = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
-    meses = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 
-             'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre']
-    
-    # Calcular fechas relativas EN TIEMPO REAL
-    hoy = now
-    manana = now + timedelta(days=1)
-    pasado_manana = now + timedelta(days=2)
-    ayer = now - timedelta(days=1)
-    antes_ayer = now - timedelta(days=2)
-    
-    # Formatear fechas
-    def format_fecha(fecha):
-        return f"{dias[fecha.weekday()]} {fecha.day} de {meses[fecha.month - 1]} de {fecha.year}"
-    
-    fecha_hoy = format_fecha(hoy)
-    fecha_manana = format_fecha(manana)
-    fecha_pasado_manana = format_fecha(pasado_manana)
-    fecha_ayer = format_fecha(ayer)
-    fecha_antes_ayer = format_fecha(antes_ayer)
-    
-    trimestre = f"{(now.month - 1) // 3 + 1}° Trimestre, {now.year}"
-    
-    # Log para debugging: mostrar el calendario calculado
-    print(f"📅 Calendario en tiempo real:")
-    print(f"   HOY: {fecha_hoy}")
-    print(f"   MAÑANA: {fecha_manana}")
-    print(f"   PASADO MAÑANA: {fecha_pasado_manana}")
-    print(f"   AYER: {fecha_ayer}")
-    print(f"   ANTES DE AYER: {fecha_antes_ayer}")
-    
-    # Construir contexto de documentos relevantes
-    information = ''
-    if relevant_documents:
-        for document in relevant_documents:
-            information += document.content + '\n\n'
-    
-    # Construcción separada del bloque de memoria conversacional (sin triple quotes anidadas)
-    if context_lesson:
-        memory_context = (
-            f"MEMORIA CONVERSACIONAL - CONTEXTO DE LECCIÓN\n\n"
-            f"CONTEXTO DETECTADO: Estás consultando sobre **{context_lesson}**\n\n"
-            f"REGLA FUNDAMENTAL:\n"
-            f"Las preguntas que no especifican una lección/fecha diferente se refieren a **{context_lesson}**.\n\n"
-            f"PRIORIDAD DE BÚSQUEDA:\n"
-            f"1. PRIMERO: Busca en el MATERIAL DISPONIBLE sobre **{context_lesson}**\n"
-            f"2. SEGUNDO: Si no encuentras ahí, busca en otras lecciones disponibles\n"
-            f"3. TERCERO: Informa al usuario de dónde proviene la información\n\n"
-            f"Si encuentras la respuesta sobre {context_lesson}:\n"
-            f"[Responde normalmente sin aclaraciones adicionales]\n\n"
-            f"Si encuentras la respuesta en OTRA lección:\n"
-            f"ADVERTENCIA: Esta información proviene de la Lección [X] ([fechas]), no de {context_lesson} que estabas consultando.\n\n"
-            f"[Respuesta con el contenido encontrado...]\n\n"
-            f"¿Quieres que continúe con la Lección [X] o prefieres volver a {context_lesson}?\n\n"
-            f"Si NO encuentras la respuesta en ninguna lección:\n"
-            f"No encontré información sobre [tema] en {context_lesson} ni en las otras lecciones disponibles.\n\n"
-            f"Si tienes el PDF de una lección que trate este tema, puedes subirlo.\n\n"
-            f"---\n"
-        )
-    else:
-        memory_context = ""
+# Pausa por defecto de un modelo tras un 429 sin pista de Retry-After
+QUOTA_COOLDOWN_SECONDS = float(os.getenv('QUOTA_COOLDOWN_SECONDS', '30'))
 
-    # System Message completo para Escuela Sabática
-    # Basado en system-message-strict-dates.txt con contexto de fechas en tiempo real
-    prompt = f'''INSTRUCCIÓN CRÍTICA: Eres un asistente amable y servicial especializado en Escuela Sabática Adventista. Tu ÚNICA fuente es el MATERIAL DISPONIBLE proporcionado. NO uses conocimiento interno.
+# Context caching de Gemini para SYSTEM_INSTRUCTION: el prefijo fijo se guarda
+# en el servidor y no se factura/procesa completo en cada turno. Requiere un
+# modelo con soporte y un prefijo sobre el mínimo de tokens del proveedor; si
+# la creación falla, ese modelo usa system_instruction normal
+LLM_CONTEXT_CACHE = os.getenv('LLM_CONTEXT_CACHE', 'false').lower() in ('1', 'true', 'yes')
+LLM_CONTEXT_CACHE_TTL = int(os.getenv('LLM_CONTEXT_CACHE_TTL', '3600'))
+# Margen para renovar el cache antes de que expire en el servidor
+LLM_CONTEXT_CACHE_REFRESH_MARGIN = 120
+# Si crear el cache falla, segundos con system_instruction normal antes de reintentar
+LLM_CONTEXT_CACHE_RETRY_SECONDS = float(os.getenv('LLM_CONTEXT_CACHE_RETRY_SECONDS', '600'))
 
----
+for _model, _limits in GEMINI_MODEL_LIMITS.items():
+    rate_limiter.register_model(_model, **_limits)
 
-CONTEXTO TEMPORAL (EN TIEMPO REAL):
+# Enrutador por salud de cada modelo: latencia, 429 y errores recientes
+model_router = ModelRouter(GEMINI_MODELS)
 
-FECHA ACTUAL DEL SISTEMA: {fecha_hoy}
-TRIMESTRE ACTUAL: {trimestre}
 
-CALENDARIO DE REFERENCIA:
-* HOY es: {fecha_hoy}
-* MAÑANA será: {fecha_manana}
-* PASADO MAÑANA será: {fecha_pasado_manana}
-* AYER fue: {fecha_ayer}
-* ANTES DE AYER fue: {fecha_antes_ayer}
+def get_next_llm_model(tokens=0, exclude=()):
+    """Modelo para el próximo intento según el enrutador (ver model_router.py)"""
+    return model_router.choose(tokens, exclude)
+
+
+# System Message completo para Escuela Sabática (basado en
+# system-message-strict-dates.txt). Es fijo: va como system_instruction de los
+# modelos cacheados y, si está activo, en el context caching de Gemini; solo el
+# calendario, la memoria, el material y la pregunta se renderizan por solicitud
+SYSTEM_INSTRUCTION = '''INSTRUCCIÓN CRÍTICA: Eres un asistente amable y servicial especializado en Escuela Sabática Adventista. Tu ÚNICA fuente es el MATERIAL DISPONIBLE proporcionado. NO uses conocimiento interno.
+
+Cada mensaje del usuario trae el CONTEXTO TEMPORAL (fecha actual y calendario), la MEMORIA CONVERSACIONAL si la hay, el MATERIAL DISPONIBLE y la PREGUNTA DEL USUARIO.
 
 ---
 
@@ -136,7 +90,6 @@ REGLA: Responde solo lo que el usuario preguntó. Si quiere más información, t
 
 ---
 
-{memory_context}
 TIPOS DE PREGUNTAS QUE RECIBIRÁS:
 
 1. Preguntas con fecha específica (ej: "¿de qué trata la lección de hoy?", "¿y la de mañana?")
@@ -220,10 +173,91 @@ Si NO encuentras un documento con la fecha exacta solicitada:
 
 - NO uses documentos de otras fechas como sustituto
 - NO sugieras otros días de forma invasiva
-- Mantén un tono servicial pero no insistente
+- Mantén un tono servicial pero no insistente'''
+
+
+@span('prompt_build')
+def build_request_content(question, relevant_documents, context_lesson=None):
+    """
+    Construye la parte variable del prompt: el calendario en tiempo real,
+    la memoria conversacional, el material de los documentos relevantes y
+    la pregunta. Las instrucciones fijas van en SYSTEM_INSTRUCTION.
+    """
+    # Obtener fecha actual en español EN TIEMPO REAL
+    now = datetime.now()
+    
+    # Nombres de días y meses en español
+    dias = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
+    meses = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 
+             'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre']
+    
+    # Calcular fechas relativas EN TIEMPO REAL
+    hoy = now
+    manana = now + timedelta(days=1)
+    pasado_manana = now + timedelta(days=2)
+    ayer = now - timedelta(days=1)
+    antes_ayer = now - timedelta(days=2)
+    
+    # Formatear fechas
+    def format_fecha(fecha):
+        return f"{dias[fecha.weekday()]} {fecha.day} de {meses[fecha.month - 1]} de {fecha.year}"
+    
+    fecha_hoy = format_fecha(hoy)
+    fecha_manana = format_fecha(manana)
+    fecha_pasado_manana = format_fecha(pasado_manana)
+    fecha_ayer = format_fecha(ayer)
+    fecha_antes_ayer = format_fecha(antes_ayer)
+    
+    trimestre = f"{(now.month - 1) // 3 + 1}° Trimestre, {now.year}"
+    
+    # Log para debugging (nivel DEBUG): el calendario calculado
+    log.debug("📅 Calendario en tiempo real: HOY %s | MAÑANA %s | PASADO MAÑANA %s | AYER %s | ANTES DE AYER %s",
+              fecha_hoy, fecha_manana, fecha_pasado_manana, fecha_ayer, fecha_antes_ayer)
+    
+    # Construir contexto de documentos relevantes: solo los mejores pasajes,
+    # sin duplicados, dentro del presupuesto de tokens (CONTEXT_TOKEN_BUDGET)
+    information, _ = pack_context(question, relevant_documents)
+    
+    # Construcción separada del bloque de memoria conversacional (sin triple quotes anidadas)
+    if context_lesson:
+        memory_context = (
+            f"MEMORIA CONVERSACIONAL - CONTEXTO DE LECCIÓN\n\n"
+            f"CONTEXTO DETECTADO: Estás consultando sobre **{context_lesson}**\n\n"
+            f"REGLA FUNDAMENTAL:\n"
+            f"Las preguntas que no especifican una lección/fecha diferente se refieren a **{context_lesson}**.\n\n"
+            f"PRIORIDAD DE BÚSQUEDA:\n"
+            f"1. PRIMERO: Busca en el MATERIAL DISPONIBLE sobre **{context_lesson}**\n"
+            f"2. SEGUNDO: Si no encuentras ahí, busca en otras lecciones disponibles\n"
+            f"3. TERCERO: Informa al usuario de dónde proviene la información\n\n"
+            f"Si encuentras la respuesta sobre {context_lesson}:\n"
+            f"[Responde normalmente sin aclaraciones adicionales]\n\n"
+            f"Si encuentras la respuesta en OTRA lección:\n"
+            f"ADVERTENCIA: Esta información proviene de la Lección [X] ([fechas]), no de {context_lesson} que estabas consultando.\n\n"
+            f"[Respuesta con el contenido encontrado...]\n\n"
+            f"¿Quieres que continúe con la Lección [X] o prefieres volver a {context_lesson}?\n\n"
+            f"Si NO encuentras la respuesta en ninguna lección:\n"
+            f"No encontré información sobre [tema] en {context_lesson} ni en las otras lecciones disponibles.\n\n"
+            f"Si tienes el PDF de una lección que trate este tema, puedes subirlo.\n\n"
+            f"---\n"
+        )
+    else:
+        memory_context = ""
+
+    return f'''CONTEXTO TEMPORAL (EN TIEMPO REAL):
+
+FECHA ACTUAL DEL SISTEMA: {fecha_hoy}
+TRIMESTRE ACTUAL: {trimestre}
+
+CALENDARIO DE REFERENCIA:
+* HOY es: {fecha_hoy}
+* MAÑANA será: {fecha_manana}
+* PASADO MAÑANA será: {fecha_pasado_manana}
+* AYER fue: {fecha_ayer}
+* ANTES DE AYER fue: {fecha_antes_ayer}
 
 ---
 
+{memory_context}
 MATERIAL DISPONIBLE:
 {information if information.strip() else "No se encontró material relevante en la base de conocimiento para esta consulta."}
 
@@ -233,31 +267,379 @@ PREGUNTA DEL USUARIO: {question}
 
 RESPUESTA (siguiendo las reglas de formato y tono):'''
 
-    # Configure Gemini API
-    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+
+def build_prompt(question, relevant_documents, context_lesson=None):
+    """
+    Construye el prompt completo (mismo que n8n) en un solo texto:
+    SYSTEM_INSTRUCTION seguido de la parte variable de la solicitud.
+    """
+    return f"{SYSTEM_INSTRUCTION}\n\n---\n\n{build_request_content(question, relevant_documents, context_lesson)}"
+
+
+SYSTEM_INSTRUCTION_TOKENS = estimate_tokens(SYSTEM_INSTRUCTION)
+
+_genai_configured = False
+_model_handles = {}
+# _handles_lock solo protege los diccionarios; la creación de un handle (una
+# llamada de red con context caching) se hace con el lock de ese modelo
+_model_locks = {}
+_handles_lock = threading.Lock()
+
+
+def _configure_genai():
+    global _genai_configured
+    if not _genai_configured:
+        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+        _genai_configured = True
+
+
+def _create_cached_model(model_name):
+    """Crea el context cache de SYSTEM_INSTRUCTION y un modelo que lo usa"""
+    cached = caching.CachedContent.create(
+        model=f"models/{model_name}",
+        display_name='escuela-sabatica-system',
+        system_instruction=SYSTEM_INSTRUCTION,
+        ttl=timedelta(seconds=LLM_CONTEXT_CACHE_TTL)
+    )
+    log.info("🧠 Context cache creado para %s: %s", model_name, cached.name)
+    return genai.GenerativeModel.from_cached_content(cached), cached
+
+
+def _delete_context_cache(cached):
+    """Borra un context cache reemplazado (se factura mientras exista)"""
+    try:
+        cached.delete()
+        log.info("🧹 Context cache anterior borrado: %s", cached.name)
+    except Exception as e:
+        log.warning("⚠️ No se pudo borrar el context cache %s: %s", cached.name, e)
+
+
+def _valid_handle(model_name, now):
+    handle = _model_handles.get(model_name)
+    if handle is not None and (handle['expires_at'] is None or handle['expires_at'] > now):
+        return handle
+    return None
+
+
+def get_model(model_name):
+    """
+    Devuelve el GenerativeModel reutilizable de un modelo, con
+    SYSTEM_INSTRUCTION ya incorporado (en context cache si está activo).
+    """
+    with _handles_lock:
+        handle = _valid_handle(model_name, time.time())
+        if handle is not None:
+            return handle['model']
+        model_lock = _model_locks.setdefault(model_name, threading.Lock())
+
+    # Solo espera quien necesita este mismo modelo; los demás siguen
+    with model_lock:
+        now = time.time()
+        with _handles_lock:
+            handle = _valid_handle(model_name, now)
+            if handle is not None:
+                return handle['model']
+            previous = _model_handles.get(model_name)
+
+        _configure_genai()
+        model, cached, expires_at = None, None, None
+        if LLM_CONTEXT_CACHE:
+            try:
+                model, cached = _create_cached_model(model_name)
+                expires_at = now + LLM_CONTEXT_CACHE_TTL - LLM_CONTEXT_CACHE_REFRESH_MARGIN
+            except Exception as e:
+                # El handle sin cache vence a los LLM_CONTEXT_CACHE_RETRY_SECONDS y se reintenta
+                expires_at = now + LLM_CONTEXT_CACHE_RETRY_SECONDS
+                log.warning("⚠️ Context caching no disponible para %s (%s); se usa system_instruction "
+                            "y se reintenta en %.0fs", model_name, e, LLM_CONTEXT_CACHE_RETRY_SECONDS)
+        if model is None:
+            model = genai.GenerativeModel(model_name, system_instruction=SYSTEM_INSTRUCTION)
+
+        with _handles_lock:
+            _model_handles[model_name] = {'model': model, 'cache': cached, 'expires_at': expires_at}
+
+    if previous is not None and previous.get('cache') is not None:
+        _delete_context_cache(previous['cache'])
+    return model
+
+
+def discard_model(model_name):
+    """Olvida el handle de un modelo (su context cache ya no existe en el servidor)"""
+    with _handles_lock:
+        _model_handles.pop(model_name, None)
+
+
+def is_context_cache_error(model_name, error) -> bool:
+    """El error indica que el context cache del handle ya no existe"""
+    with _handles_lock:
+        handle = _model_handles.get(model_name)
+        uses_cache = handle is not None and handle.get('cache') is not None
+    message = str(error).lower()
+    return uses_cache and (isinstance(error, NotFound) or 'cachedcontent' in message or 'cached content' in message)
+
+
+def handle_quota_error(model_name, error):
+    """
+    Intento sin cuota. Un 429 de Gemini pausa el modelo en el limitador y
+    abre su circuito en el enrutador; el presupuesto local agotado solo lo
+    descarta para este intento.
+    """
+    if isinstance(error, ResourceExhausted):
+        retry_after = parse_retry_after(error)
+        rate_limiter.penalize(model_name, retry_after or QUOTA_COOLDOWN_SECONDS)
+        model_router.record_failure(model_name, 'quota', retry_after)
+        count(QUOTA_ERRORS, api='llm', model=model_name)
+        count(LLM_REQUESTS, model=model_name, result='quota')
+    else:
+        model_router.record_skipped(model_name)
+        count(LLM_REQUESTS, model=model_name, result='rate_limited')
+
+
+def handle_model_error(model_name, error):
+    """
+    Error no relacionado con cuota: cuenta para el circuito del modelo. Si
+    el context cache del handle ya no existe, el handle se recrea la próxima
+    vez; los demás errores (503, timeouts...) no tocan el cache.
+    """
+    model_router.record_failure(model_name, 'error')
+    count(LLM_REQUESTS, model=model_name, result='error')
+    if is_context_cache_error(model_name, error):
+        log.warning("⚠️ Context cache de %s no encontrado; se recrea en la próxima solicitud", model_name)
+        discard_model(model_name)
+
+
+def quota_exhausted_error(max_retries):
+    log.error("❌ Límite de cuota agotado en todos los modelos después de %s intentos", max_retries)
+    return Exception(
+        "Límite de cuota de Gemini alcanzado. Por favor, espera unos minutos o usa el modelo n8n."
+    )
+
+
+def call_model(model_name, content, prompt_tokens):
+    """
+    Una generación con model_name, con su contabilidad: presupuesto del
+    limitador, resultado en el enrutador y métricas. Los errores se
+    propagan ya registrados.
+    """
+    try:
+        waited = rate_limiter.acquire(model_name, tokens=prompt_tokens)
+        if waited > 0:
+            log.info("⏳ Esperados %.2fs por presupuesto de %s", waited, model_name)
+        log.info("🤖 Usando modelo: %s", model_name)
+
+        model = get_model(model_name)
+        started = time.perf_counter()
+        with span('generation'):
+            response = model.generate_content(content)
+        model_router.record_success(model_name, time.perf_counter() - started)
+        count(LLM_REQUESTS, model=model_name, result='ok')
+        usage = getattr(response, 'usage_metadata', None)
+        rate_limiter.adjust_tokens(
+            model_name, prompt_tokens, getattr(usage, 'total_token_count', None)
+        )
+        return response.text
+    except (ResourceExhausted, RateLimitExceeded) as e:
+        handle_quota_error(model_name, e)
+        raise
+    except BaseException as e:
+        handle_model_error(model_name, e)
+        raise
+
+
+async def call_model_async(model_name, content, prompt_tokens):
+    """Versión asíncrona de call_model (generate_content_async de Gemini)"""
+    try:
+        await rate_limiter.acquire_async(model_name, tokens=prompt_tokens)
+        log.info("🤖 Usando modelo (async): %s", model_name)
+
+        # get_model toma un lock y puede crear el context cache (llamada de red)
+        model = await asyncio.to_thread(get_model, model_name)
+        started = time.perf_counter()
+        with span('generation'):
+            response = await model.generate_content_async(content)
+        model_router.record_success(model_name, time.perf_counter() - started)
+        count(LLM_REQUESTS, model=model_name, result='ok')
+        usage = getattr(response, 'usage_metadata', None)
+        rate_limiter.adjust_tokens(
+            model_name, prompt_tokens, getattr(usage, 'total_token_count', None)
+        )
+        return response.text
+    except (ResourceExhausted, RateLimitExceeded) as e:
+        handle_quota_error(model_name, e)
+        raise
+    except asyncio.CancelledError:
+        # Cliente desconectado o cobertura perdedora: no es culpa del modelo
+        model_router.record_skipped(model_name)
+        raise
+    except BaseException as e:
+        handle_model_error(model_name, e)
+        raise
+
+
+def choose_hedge_model(prompt_tokens, exclude):
+    """Segundo modelo para cubrir: circuito cerrado y presupuesto RPM/TPM sin espera"""
+    model = model_router.choose(prompt_tokens, exclude, require_available=True)
+    if model is not None and rate_limiter.seconds_until_available(model, prompt_tokens) > 0:
+        model_router.record_skipped(model)
+        return None
+    if model is not None:
+        log.info("🪁 Cubriendo la generación con %s", model)
+    return model
+
+
+def query_llm(question, relevant_documents, context_lesson=None, max_retries=3):
+    """
+    Genera respuesta usando Google Gemini con el mismo prompt que n8n.
+    
+    Args:
+        question: Pregunta del usuario
+        relevant_documents: Lista de documentos relevantes de Qdrant
+        context_lesson: Lección/fecha del contexto conversacional (opcional)
+        max_retries: Número de intentos (cada uno con un modelo distinto si hay)
+    """
+    # Solo la parte variable; las instrucciones fijas ya van en el modelo
+    content = build_request_content(question, relevant_documents, context_lesson)
     
-    # Generate response with retry logic and model rotation
+    # El enrutador elige el modelo con menor tiempo esperado; tras un 429 o un
+    # error transitorio el siguiente intento va de inmediato a otro modelo y
+    # solo se espera lo que pida el presupuesto
+    prompt_tokens = SYSTEM_INSTRUCTION_TOKENS + estimate_tokens(content)
+    tried = set()
     for attempt in range(max_retries):
+        current_model = get_next_llm_model(prompt_tokens, exclude=tried)
+        tried.add(current_model)
         try:
-            # Obtener el siguiente modelo en rotación
-            current_model = get_next_llm_model()
-            print(f"🤖 Usando modelo: {current_model}")
-            
-            model = genai.GenerativeModel(current_model)
-            response = model.generate_content(prompt)
-            return response.text
-        except ResourceExhausted as e:
-            if attempt < max_retries - 1:
-                wait_time = (attempt + 1) * 5  # 5s, 10s, 15s (reducido para rotar más rápido)
-                print(f"⚠️ Límite de cuota alcanzado en {current_model}. Rotando a otro modelo en {wait_time}s... (intento {attempt + 2}/{max_retries})")
-                time.sleep(wait_time)
-            else:
-                print(f"❌ Límite de cuota agotado en todos los modelos después de {max_retries} intentos")
-                raise Exception(
-                    "Límite de cuota de Gemini alcanzado. Por favor, espera unos minutos o usa el modelo n8n."
-                ) from e
-        except Exception as e:
-            # Otros errores no relacionados con cuota
-            raise e
+            if LLM_HEDGE_ENABLED:
+                # Si tarda más que su percentil reciente, otro modelo compite (ver hedging.py)
+                return run_hedged(
+                    current_model,
+                    lambda model_name: call_model(model_name, content, prompt_tokens),
+                    hedge_delay(model_router, current_model),
+                    lambda: choose_hedge_model(prompt_tokens, tried),
+                    tried
+                )
+            return call_model(current_model, content, prompt_tokens)
+        except (ResourceExhausted, RateLimitExceeded) as e:
+            if attempt == max_retries - 1:
+                raise quota_exhausted_error(max_retries) from e
+            log.warning("⚠️ Límite de cuota alcanzado en %s. Cambiando de modelo... (intento %s/%s)",
+                        current_model, attempt + 2, max_retries)
+        except TRANSIENT_ERRORS as e:
+            if attempt == max_retries - 1:
+                raise
+            log.warning("⚠️ Error transitorio en %s (%s). Cambiando de modelo...", current_model, e)
+
+
+async def query_llm_async(question, relevant_documents, context_lesson=None, max_retries=3):
+    """
+    Versión asíncrona de query_llm (generate_content_async de Gemini) para
+    el modo ASGI. Mismo enrutador de modelos y mismo presupuesto compartido.
+    """
+    content = build_request_content(question, relevant_documents, context_lesson)
 
+    prompt_tokens = SYSTEM_INSTRUCTION_TOKENS + estimate_tokens(content)
+    tried = set()
+    for attempt in range(max_retries):
+        current_model = get_next_llm_model(prompt_tokens, exclude=tried)
+        tried.add(current_model)
+        try:
+            if LLM_HEDGE_ENABLED:
+                return await run_hedged_async(
+                    current_model,
+                    lambda model_name: call_model_async(model_name, content, prompt_tokens),
+                    hedge_delay(model_router, current_model),
+                    lambda: choose_hedge_model(prompt_tokens, tried),
+                    tried
+                )
+            return await call_model_async(current_model, content, prompt_tokens)
+        except (ResourceExhausted, RateLimitExceeded) as e:
+            if attempt == max_retries - 1:
+                raise quota_exhausted_error(max_retries) from e
+            log.warning("⚠️ Límite de cuota alcanzado en %s. Cambiando de modelo... (intento %s/%s)",
+                        current_model, attempt + 2, max_retries)
+        except TRANSIENT_ERRORS as e:
+            if attempt == max_retries - 1:
+                raise
+            log.warning("⚠️ Error transitorio en %s (%s). Cambiando de modelo...", current_model, e)
+
+
+def _chunk_text(chunk):
+    """Texto de un fragmento del stream ('' si el fragmento no trae partes)"""
+    try:
+        return chunk.text
+    except ValueError:
+        return ''
+
+
+def stream_llm(question, relevant_documents, context_lesson=None, max_retries=3):
+    """
+    Igual que query_llm pero con generación en streaming de Gemini: produce
+    los fragmentos de texto a medida que llegan.
 
+    El cambio de modelo solo es posible antes del primer fragmento; si el
+    error llega después, se propaga al llamador.
+    Sin coberturas (hedging.py): el primer fragmento llega pronto y la
+    respuesta no puede cambiar de modelo a mitad de camino.
+    """
+    content = build_request_content(question, relevant_documents, context_lesson)
+
+    prompt_tokens = SYSTEM_INSTRUCTION_TOKENS + estimate_tokens(content)
+    tried = set()
+    for attempt in range(max_retries):
+        current_model = get_next_llm_model(prompt_tokens, exclude=tried)
+        tried.add(current_model)
+        try:
+            waited = rate_limiter.acquire(current_model, tokens=prompt_tokens)
+            if waited > 0:
+                log.info("⏳ Esperados %.2fs por presupuesto de %s", waited, current_model)
+            log.info("🤖 Usando modelo (streaming): %s", current_model)
+
+            model = get_model(current_model)
+            started = time.perf_counter()
+            response = model.generate_content(content, stream=True)
+            chunks = iter(response)
+            # El primer fragmento dentro del try: aquí suele llegar el 429
+            first_chunk = next(chunks, None)
+        except (ResourceExhausted, RateLimitExceeded) as e:
+            handle_quota_error(current_model, e)
+            if attempt == max_retries - 1:
+                raise quota_exhausted_error(max_retries) from e
+            log.warning("⚠️ Límite de cuota alcanzado en %s. Cambiando de modelo... (intento %s/%s)",
+                        current_model, attempt + 2, max_retries)
+            continue
+        except TRANSIENT_ERRORS as e:
+            handle_model_error(current_model, e)
+            if attempt == max_retries - 1:
+                raise
+            log.warning("⚠️ Error transitorio en %s (%s). Cambiando de modelo...", current_model, e)
+            continue
+        except BaseException as e:
+            handle_model_error(current_model, e)
+            raise
+
+        try:
+            if first_chunk is not None:
+                text = _chunk_text(first_chunk)
+                if text:
+                    yield text
+            for chunk in chunks:
+                text = _chunk_text(chunk)
+                if text:
+                    yield text
+        except GeneratorExit:
+            # El cliente cerró el stream: no cuenta como fallo del modelo
+            model_router.record_skipped(current_model)
+            raise
+        except BaseException as e:
+            handle_model_error(current_model, e)
+            raise
+        elapsed = time.perf_counter() - started
+        model_router.record_success(current_model, elapsed)
+        observe_stage('generation', elapsed)
+        count(LLM_REQUESTS, model=current_model, result='ok')
+
+        usage = getattr(response, 'usage_metadata', None)
+        rate_limiter.adjust_tokens(
+            current_model, prompt_tokens, getattr(usage, 'total_token_count', None)
+        )
+        return
@@ -0,0 +1,77 @@
+"""
+Backend local de embeddings (CPU) con sentence-transformers.
+
+Alternativa sin red ni cuota a la API de Gemini: la ingesta y las consultas
+de una colección configurada con el backend 'local' nunca llaman a
+embed_content. El modelo se carga la primera vez que se usa y puede
+cuantizarse a int8 (cuantización dinámica de las capas Linear) para
+reducir memoria y acelerar la inferencia en CPU.
+
+Los vectores de un modelo local NO son comparables con los de Gemini: cada
+colección usa un solo backend (EMBEDDING_BACKENDS) para que la dimensión y
+el espacio vectorial coincidan siempre.
+"""
+import os
+import threading
+from structured_logging import get_logger
+
+LOCAL_EMBEDDING_MODEL = os.getenv(
+    'LOCAL_EMBEDDING_MODEL', 'sentence-transformers/paraphrase-multilingual-mpnet-base-v2'
+)
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv('LOCAL_EMBEDDING_BATCH_SIZE', '32'))
+# 'int8' aplica cuantización dinámica; 'none' usa el modelo en float32
+LOCAL_EMBEDDING_QUANTIZE = os.getenv('LOCAL_EMBEDDING_QUANTIZE', 'none').lower()
+LOCAL_EMBEDDING_DEVICE = os.getenv('LOCAL_EMBEDDING_DEVICE', 'cpu')
+
+log = get_logger('local_embeddings')
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_local_model():
+    """Carga (una vez por proceso) el modelo de sentence-transformers"""
+    global _model
+    if _model is not None:
+        return _model
+
+    with _model_lock:
+        if _model is None:
+            try:
+                from sentence_transformers import SentenceTransformer
+            except ImportError as e:
+                raise RuntimeError(
+                    "El backend local de embeddings requiere sentence-transformers "
+                    "(pip install sentence-transformers)"
+                ) from e
+
+            log.info("🧩 Cargando modelo local de embeddings: %s", LOCAL_EMBEDDING_MODEL)
+            model = SentenceTransformer(LOCAL_EMBEDDING_MODEL, device=LOCAL_EMBEDDING_DEVICE)
+            if LOCAL_EMBEDDING_QUANTIZE == 'int8':
+                import torch
+                model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+                log.info("   Cuantización dinámica int8 aplicada")
+            log.info("✅ Modelo local listo (dimensión %s)", model.get_sentence_embedding_dimension())
+            _model = model
+    return _model
+
+
+def local_embed(texts, batch_size=None) -> list:
+    """
+    Embeddings de varios textos con el modelo local, en el mismo orden.
+    Los vectores salen normalizados (la colección usa distancia coseno).
+    """
+    if not texts:
+        return []
+    vectors = get_local_model().encode(
+        list(texts),
+        batch_size=batch_size or LOCAL_EMBEDDING_BATCH_SIZE,
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+        show_progress_bar=False
+    )
+    return vectors.tolist()
+
+
+def local_embedding_dimension() -> int:
+    return get_local_model().get_sentence_embedding_dimension()
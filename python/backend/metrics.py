@@ -0,0 +1,171 @@
+"""
+Métricas del backend en formato de texto de Prometheus (/metrics).
+
+Spans de tiempo por etapa de una consulta (cache, enriquecimiento de la
+pregunta, embedding, búsqueda vectorial, scroll por fecha, re-ranking,
+armado del prompt y generación) que alimentan un histograma, más
+contadores de aciertos de cache, errores 429, modelo usado y scrolls de
+respaldo. Todo vive en memoria del proceso y no depende de
+prometheus_client: la exposición es texto plano.
+"""
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Límites superiores (segundos) de los buckets de latencia
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(label_names, label_values, extra=None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Contador monótono con etiquetas"""
+
+    type_name = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in values]
+
+
+class Histogram:
+    """Histograma de buckets acumulados (le), con _sum y _count"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # etiquetas -> [conteos por bucket, suma, total]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def samples(self) -> list:
+        with self._lock:
+            series = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._series.items())
+        lines = []
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.labels, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = _format_labels(self.labels, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+STAGE_DURATION = Histogram(
+    'chatbot_stage_duration_seconds', 'Duración de cada etapa de una consulta', labels=('stage',)
+)
+STAGE_ERRORS = Counter(
+    'chatbot_stage_errors_total', 'Etapas que terminaron con excepción', labels=('stage',)
+)
+CACHE_LOOKUPS = Counter(
+    'chatbot_cache_lookups_total', 'Consultas al cache de respuestas', labels=('cache', 'result')
+)
+QUOTA_ERRORS = Counter(
+    'chatbot_quota_errors_total', 'Errores 429 / de cuota de Gemini', labels=('api', 'model')
+)
+LLM_REQUESTS = Counter(
+    'chatbot_llm_requests_total', 'Solicitudes de generación por modelo y resultado', labels=('model', 'result')
+)
+SEARCH_REQUESTS = Counter(
+    'chatbot_vector_searches_total', 'Búsquedas vectoriales por origen', labels=('source',)
+)
+FALLBACK_SCROLLS = Counter(
+    'chatbot_fallback_scrolls_total', 'Consultas filtradas por fecha tras la búsqueda vectorial', labels=('source',)
+)
+COALESCED_REQUESTS = Counter(
+    'chatbot_coalesced_requests_total', 'Solicitudes resueltas con el resultado de otra idéntica en curso',
+    labels=('flight',)
+)
+LLM_HEDGES = Counter(
+    'chatbot_llm_hedges_total', 'Coberturas de generación: lanzadas, denegadas y quién ganó', labels=('result',)
+)
+
+_registry = [STAGE_DURATION, STAGE_ERRORS, CACHE_LOOKUPS, QUOTA_ERRORS, LLM_REQUESTS,
+             SEARCH_REQUESTS, FALLBACK_SCROLLS, COALESCED_REQUESTS, LLM_HEDGES]
+
+
+def observe_stage(stage, seconds):
+    if METRICS_ENABLED:
+        STAGE_DURATION.observe(seconds, stage=stage)
+
+
+@contextmanager
+def span(stage):
+    """
+    Mide la duración de una etapa. Sirve como bloque (with span('embedding'))
+    o como decorador de funciones síncronas (@span('prompt_build')).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        if METRICS_ENABLED:
+            STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def count(counter, amount=1, **labels):
+    if METRICS_ENABLED:
+        counter.inc(amount, **labels)
+
+
+def render_metrics() -> str:
+    """Todas las métricas en el formato de exposición de texto de Prometheus"""
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.type_name}")
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,225 @@
+"""
+Enrutador de modelos Gemini según su salud reciente.
+
+Reemplaza la rotación round-robin: cada solicitud va al modelo con menor
+tiempo esperado de respuesta, estimado con
+- la espera que exige su presupuesto en el limitador (RPM/TPM y bloqueos
+  por Retry-After),
+- su latencia p50 reciente, inflada por su tasa de errores,
+- una penalización por cada 429 reciente.
+
+Cada modelo tiene un circuit breaker: un 429 lo abre durante la pista de
+Retry-After (o un enfriamiento que crece con los 429 seguidos) y varios
+errores seguidos lo abren por ROUTER_ERROR_COOLDOWN. Al vencer el
+enfriamiento pasa a semiabierto y deja pasar una sola solicitud de prueba;
+si responde, se cierra. La prueba se identifica con un id guardado en el
+contexto de la solicitud (contextvars, como el request_id de los logs): las
+solicitudes anteriores que terminan mientras tanto no liberan su lugar. Una respuesta correcta de una solicitud enviada
+antes de que el circuito se abriera (llega tarde, con el 429 ya registrado)
+no lo cierra: no dice nada del estado actual del modelo. Con el circuito abierto el modelo no se elige
+mientras haya otro disponible, así que el reintento va de inmediato a otro
+modelo en vez de dormir.
+"""
+import os
+import time
+import threading
+import contextvars
+from collections import deque
+import numpy as np
+from rate_limiter import rate_limiter
+
+# Resultados recientes por modelo para latencias y tasa de errores
+ROUTER_WINDOW = int(os.getenv('ROUTER_WINDOW', '50'))
+# Ventana (segundos) en la que cuentan los 429 para la penalización
+ROUTER_QUOTA_WINDOW = float(os.getenv('ROUTER_QUOTA_WINDOW', '300'))
+# Segundos que se suman al costo de un modelo por cada 429 reciente
+ROUTER_QUOTA_PENALTY = float(os.getenv('ROUTER_QUOTA_PENALTY', '5'))
+# Latencia supuesta de un modelo sin muestras (favorece explorarlo)
+ROUTER_DEFAULT_LATENCY = float(os.getenv('ROUTER_DEFAULT_LATENCY', '2'))
+# Errores seguidos (no de cuota) que abren el circuito
+ROUTER_FAILURE_THRESHOLD = int(os.getenv('ROUTER_FAILURE_THRESHOLD', '3'))
+ROUTER_ERROR_COOLDOWN = float(os.getenv('ROUTER_ERROR_COOLDOWN', '15'))
+ROUTER_QUOTA_COOLDOWN = float(os.getenv('QUOTA_COOLDOWN_SECONDS', '30'))
+ROUTER_MAX_COOLDOWN = float(os.getenv('ROUTER_MAX_COOLDOWN', '300'))
+# Segundos tras los que una prueba sin resultado (solicitud abandonada) deja de bloquear otra
+ROUTER_PROBE_TIMEOUT = float(os.getenv('ROUTER_PROBE_TIMEOUT', '60'))
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+# {modelo: id de prueba} de las pruebas que lanzó la solicitud actual
+_probe_ids = contextvars.ContextVar('router_probe_ids', default={})
+
+
+class _ModelHealth:
+    def __init__(self, window):
+        self.outcomes = deque(maxlen=window)   # True (ok) / False (error)
+        self.latencies = deque(maxlen=window)  # segundos de las respuestas correctas
+        self.quota_errors = deque()            # monotonic de cada 429
+        self.state = CLOSED
+        self.open_until = 0.0
+        self.opened_at = 0.0  # monotonic de la última apertura
+        self.probing = False
+        self.probe_id = 0
+        self.probe_until = 0.0
+        self.consecutive_quota = 0
+        self.consecutive_errors = 0
+        self.in_flight = 0
+        self.stats = {'requests': 0, 'successes': 0, 'quota_errors': 0, 'errors': 0, 'circuit_opens': 0}
+
+    def recent_quota_errors(self, now):
+        while self.quota_errors and now - self.quota_errors[0] > ROUTER_QUOTA_WINDOW:
+            self.quota_errors.popleft()
+        return len(self.quota_errors)
+
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def percentile(self, q):
+        return float(np.percentile(self.latencies, q)) if self.latencies else None
+
+    def available(self, now):
+        if self.state == OPEN and now >= self.open_until:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            return not self.probing or now >= self.probe_until
+        return self.state == CLOSED
+
+    def open(self, now, seconds):
+        self.state = OPEN
+        self.opened_at = now
+        self.open_until = now + min(seconds, ROUTER_MAX_COOLDOWN)
+        self.probing = False
+        self.stats['circuit_opens'] += 1
+
+
+class ModelRouter:
+    """Elige el modelo más prometedor y registra cómo le fue"""
+
+    def __init__(self, models, limiter=None, window=None):
+        self.models = list(models)
+        self.limiter = limiter or rate_limiter
+        window = window or ROUTER_WINDOW
+        self._health = {model: _ModelHealth(window) for model in self.models}
+        self._lock = threading.Lock()
+
+    def _expected_seconds(self, model, health, now, tokens):
+        p50 = health.percentile(50)
+        latency = ROUTER_DEFAULT_LATENCY if p50 is None else p50
+        # Con tasa de error e se esperan 1/(1-e) intentos
+        latency /= max(0.1, 1.0 - health.error_rate())
+        wait = self.limiter.seconds_until_available(model, tokens)
+        return wait + latency + health.recent_quota_errors(now) * ROUTER_QUOTA_PENALTY
+
+    def choose(self, tokens=0, exclude=(), require_available=False):
+        """
+        Modelo para la próxima solicitud (sin repetir los de 'exclude' si
+        queda alguno). Si todos tienen el circuito abierto, el que se
+        recupera antes; con require_available, None si no hay un modelo
+        fuera de 'exclude' con el circuito cerrado (coberturas).
+        """
+        with self._lock:
+            now = time.monotonic()
+            candidates = [m for m in self.models if m not in exclude]
+            if not candidates and not require_available:
+                candidates = list(self.models)
+            available = [m for m in candidates if self._health[m].available(now)]
+            if available:
+                # En empate gana el orden de GEMINI_MODELS (el principal primero)
+                model = min(available, key=lambda m: self._expected_seconds(m, self._health[m], now, tokens))
+            elif require_available:
+                return None
+            else:
+                model = min(candidates, key=lambda m: self._health[m].open_until)
+
+            health = self._health[model]
+            if health.state == HALF_OPEN:
+                health.probing = True
+                health.probe_id += 1
+                health.probe_until = now + ROUTER_PROBE_TIMEOUT
+                _probe_ids.set({**_probe_ids.get(), model: health.probe_id})
+            health.in_flight += 1
+            health.stats['requests'] += 1
+            return model
+
+    def latency_percentile(self, model, q, min_samples=1):
+        """Percentil q de las latencias recientes del modelo (None si hay menos de min_samples)"""
+        with self._lock:
+            health = self._health[model]
+            if len(health.latencies) < max(1, min_samples):
+                return None
+            return health.percentile(q)
+
+    def _finish(self, model, health) -> bool:
+        """Cuenta el fin de una solicitud; True si era la prueba en curso del modelo"""
+        health.in_flight = max(0, health.in_flight - 1)
+        is_probe = health.probing and _probe_ids.get().get(model) == health.probe_id
+        if is_probe:
+            health.probing = False
+        return is_probe
+
+    def record_success(self, model, latency):
+        """
+        Registra una respuesta correcta que tardó 'latency' segundos. Solo
+        cierra el circuito (y reinicia los contadores de fallos seguidos) si
+        la solicitud empezó después de la última apertura.
+        """
+        with self._lock:
+            health = self._health[model]
+            self._finish(model, health)
+            started = time.monotonic() - latency
+            health.outcomes.append(True)
+            health.latencies.append(latency)
+            health.stats['successes'] += 1
+            if started < health.opened_at:
+                return
+            health.consecutive_quota = 0
+            health.consecutive_errors = 0
+            health.state = CLOSED
+
+    def record_failure(self, model, kind, retry_after=None):
+        """
+        kind 'quota' (429) abre el circuito de inmediato; 'error' lo abre
+        tras ROUTER_FAILURE_THRESHOLD errores seguidos (o si era la prueba)
+        """
+        with self._lock:
+            health = self._health[model]
+            was_probe = self._finish(model, health)
+            now = time.monotonic()
+            health.outcomes.append(False)
+            if kind == 'quota':
+                health.stats['quota_errors'] += 1
+                health.quota_errors.append(now)
+                health.consecutive_quota += 1
+                cooldown = retry_after or ROUTER_QUOTA_COOLDOWN * 2 ** (health.consecutive_quota - 1)
+                health.open(now, cooldown)
+            else:
+                health.stats['errors'] += 1
+                health.consecutive_errors += 1
+                if was_probe or health.consecutive_errors >= ROUTER_FAILURE_THRESHOLD:
+                    extra = max(0, health.consecutive_errors - ROUTER_FAILURE_THRESHOLD)
+                    health.open(now, ROUTER_ERROR_COOLDOWN * 2 ** extra)
+
+    def record_skipped(self, model):
+        """La solicitud no llegó al modelo (presupuesto local agotado)"""
+        with self._lock:
+            self._finish(model, self._health[model])
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            stats = {}
+            for model, health in self._health.items():
+                health.available(now)
+                p50, p95 = health.percentile(50), health.percentile(95)
+                stats[model] = {
+                    **health.stats,
+                    'state': health.state,
+                    'open_for': round(max(0.0, health.open_until - now), 3) if health.state == OPEN else 0.0,
+                    'in_flight': health.in_flight,
+                    'recent_quota_errors': health.recent_quota_errors(now),
+                    'error_rate': round(health.error_rate(), 3),
+                    'latency_p50': round(p50, 3) if p50 is not None else None,
+                    'latency_p95': round(p95, 3) if p95 is not None else None,
+                    'expected_seconds': round(self._expected_seconds(model, health, now, 0), 3)
+                }
+            return stats
@@ -0,0 +1,139 @@
+"""
+Extracción de texto de PDFs en paralelo.
+
+page.extract_text() de PyPDF2 es Python puro y usa CPU, así que los hilos no
+ayudan (GIL). Para documentos grandes (trimestrales de ~150 páginas,
+compilaciones anuales) el PDF se parte en rangos de páginas contiguos y cada
+rango se extrae en un proceso aparte; los resultados se vuelven a unir en
+orden. Los archivos pequeños se extraen en serie, donde arrancar procesos
+costaría más que lo que se ahorra.
+
+Los procesos se crean con 'spawn' y no con fork: la ingesta corre en un hilo
+de un proceso con otros hilos vivos (logs, barrido del cache, conexiones
+SQLite) y un fork en ese estado puede dejar al hijo bloqueado en un lock
+copiado a medio tomar. Como arrancar un proceso con spawn es caro, el pool
+se crea una vez y se reutiliza entre ingestas.
+"""
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import PyPDF2
+from structured_logging import get_logger
+
+# Procesos para la extracción (por defecto, uno por CPU)
+PDF_EXTRACT_WORKERS = int(os.getenv('PDF_EXTRACT_WORKERS', str(os.cpu_count() or 1)))
+# Por debajo de este número de páginas se extrae en serie
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', '64'))
+# Rangos por proceso: más de uno reparte mejor páginas de costo desigual
+PDF_RANGES_PER_WORKER = 2
+
+log = get_logger('pdf_extraction')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _extract_range(file_path, start, end):
+    """Extrae el texto de las páginas [start, end) de un PDF (se ejecuta en un proceso hijo)"""
+    with open(file_path, 'rb') as pdf_file:
+        reader = PyPDF2.PdfReader(pdf_file)
+        return [reader.pages[i].extract_text() or '' for i in range(start, end)]
+
+
+def _iter_serial(file_path):
+    """Un solo PdfReader para todo el archivo; entrega cada página al extraerla"""
+    with open(file_path, 'rb') as pdf_file:
+        reader = PyPDF2.PdfReader(pdf_file)
+        for page in reader.pages:
+            yield page.extract_text() or ''
+
+
+def page_ranges(total_pages, parts):
+    """Divide [0, total_pages) en a lo sumo `parts` rangos contiguos de tamaño similar"""
+    parts = max(1, min(parts, total_pages))
+    size, extra = divmod(total_pages, parts)
+    ranges = []
+    start = 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def _get_executor():
+    """Pool de procesos compartido (spawn), creado la primera vez que se necesita"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=PDF_EXTRACT_WORKERS, mp_context=multiprocessing.get_context('spawn')
+            )
+        return _executor
+
+
+def _discard_executor(executor):
+    """Descarta un pool roto (un proceso murió) para que el próximo uso cree otro"""
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def count_pages(file_path) -> int:
+    with open(file_path, 'rb') as pdf_file:
+        return len(PyPDF2.PdfReader(pdf_file).pages)
+
+
+def iter_pages(file_path, workers=None, min_pages=None):
+    """
+    Genera el texto de cada página del PDF, en orden.
+
+    En modo paralelo entrega cada rango en cuanto termina (y los anteriores
+    ya terminaron), así el resto de la ingesta puede empezar sin esperar al
+    último rango.
+
+    Args:
+        workers: Procesos entre los que repartir los rangos (por defecto
+                 PDF_EXTRACT_WORKERS, que es también el tamaño del pool); 1 extrae en serie
+        min_pages: Páginas mínimas para paralelizar (por defecto PDF_PARALLEL_MIN_PAGES)
+    """
+    workers = PDF_EXTRACT_WORKERS if workers is None else workers
+    min_pages = PDF_PARALLEL_MIN_PAGES if min_pages is None else min_pages
+
+    total_pages = count_pages(file_path)
+    if workers <= 1 or total_pages < min_pages:
+        yield from _iter_serial(file_path)
+        return
+
+    ranges = page_ranges(total_pages, workers * PDF_RANGES_PER_WORKER)
+    try:
+        executor = _get_executor()
+    except (OSError, RuntimeError, ValueError) as e:
+        # Entornos sin soporte de multiprocessing: modo serie
+        log.warning("⚠️ Extracción en paralelo no disponible (%s), extrayendo en serie", e)
+        yield from _iter_serial(file_path)
+        return
+
+    log.info("⚡ Extrayendo %s páginas en %s rangos con %s procesos", total_pages, len(ranges), PDF_EXTRACT_WORKERS)
+    futures = []
+    try:
+        # Se envían todos los rangos antes de consumir; se entregan en orden
+        futures = [executor.submit(_extract_range, file_path, start, end) for start, end in ranges]
+        for future in futures:
+            yield from future.result()
+    except BrokenProcessPool:
+        _discard_executor(executor)
+        raise
+    finally:
+        # Ingesta abandonada o fallida: los rangos pendientes no se extraen
+        for future in futures:
+            future.cancel()
+
+
+def extract_pages(file_path, workers=None, min_pages=None) -> list:
+    """Devuelve el texto de cada página del PDF, en orden (ver iter_pages)"""
+    return list(iter_pages(file_path, workers=workers, min_pages=min_pages))
@@ -0,0 +1,182 @@
+"""
+Transporte HTTP único para todo el tráfico REST hacia Qdrant.
+
+Mantiene una requests.Session por proceso con pool de conexiones keep-alive,
+de modo que el handshake TCP/TLS con Qdrant Cloud se paga una vez por
+worker y no en cada búsqueda. Los headers se construyen una sola vez.
+
+Para el modo asíncrono (asgi.py) ofrece async_qdrant_request, con la misma
+semántica de reintentos sobre un httpx.AsyncClient con pool.
+"""
+import os
+import time
+import asyncio
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from structured_logging import get_logger
+
+try:
+    import httpx
+except ImportError:  # Solo necesario para el modo asíncrono (asgi.py)
+    httpx = None
+
+QDRANT_POOL_SIZE = int(os.getenv('QDRANT_POOL_SIZE', '10'))
+QDRANT_CONNECT_TIMEOUT = float(os.getenv('QDRANT_CONNECT_TIMEOUT', '3'))
+QDRANT_READ_TIMEOUT = float(os.getenv('QDRANT_READ_TIMEOUT', '10'))
+QDRANT_MAX_RETRIES = int(os.getenv('QDRANT_MAX_RETRIES', '2'))
+QDRANT_RETRY_BACKOFF = float(os.getenv('QDRANT_RETRY_BACKOFF', '0.3'))
+
+# Métodos HTTP idempotentes por definición; las búsquedas (POST) se marcan explícitamente
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'}
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+log = get_logger('qdrant')
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+# Un cliente asíncrono por event loop (httpx no permite compartirlos entre loops)
+_async_clients = {}
+
+
+def get_qdrant_url() -> str:
+    return os.getenv('QDRANT_URL', 'http://localhost:6333').rstrip('/')
+
+
+def _build_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=QDRANT_POOL_SIZE,
+        pool_maxsize=QDRANT_POOL_SIZE
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    session.headers.update(_default_headers())
+    return session
+
+
+def get_session() -> requests.Session:
+    """Sesión compartida del proceso (se recrea si el proceso hizo fork)"""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                _session = _build_session()
+                _session_pid = os.getpid()
+    return _session
+
+
+def qdrant_request(method, path, json=None, timeout=None, idempotent=None) -> requests.Response:
+    """
+    Ejecuta una llamada REST a Qdrant a través del pool compartido.
+
+    Args:
+        method: Método HTTP ('GET', 'POST', 'PUT', ...)
+        path: Ruta relativa, por ejemplo '/collections/X/points/search'
+        json: Cuerpo JSON
+        timeout: Timeout de lectura en segundos (por defecto QDRANT_READ_TIMEOUT)
+        idempotent: Si la llamada puede reintentarse sin efectos secundarios.
+                    Por defecto se deduce del método HTTP.
+
+    Returns:
+        requests.Response (el llamador revisa status_code como antes)
+
+    Raises:
+        requests.RequestException si falla la conexión tras los reintentos
+    """
+    method = method.upper()
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+    attempts = 1 + (QDRANT_MAX_RETRIES if idempotent else 0)
+    read_timeout = timeout if timeout is not None else QDRANT_READ_TIMEOUT
+    url = f"{get_qdrant_url()}{path}"
+
+    for attempt in range(attempts):
+        try:
+            response = get_session().request(
+                method,
+                url,
+                json=json,
+                timeout=(QDRANT_CONNECT_TIMEOUT, read_timeout)
+            )
+            if response.status_code in RETRY_STATUS_CODES and attempt < attempts - 1:
+                log.warning("⚠️ Qdrant respondió %s en %s. Reintentando...", response.status_code, path)
+                time.sleep(QDRANT_RETRY_BACKOFF * (2 ** attempt))
+                continue
+            return response
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt < attempts - 1:
+                log.warning("⚠️ Error de conexión con Qdrant (%s). Reintentando...", e)
+                time.sleep(QDRANT_RETRY_BACKOFF * (2 ** attempt))
+            else:
+                raise
+
+
+def _default_headers() -> dict:
+    headers = {'Content-Type': 'application/json'}
+    api_key = os.getenv('QDRANT_API_KEY', None)
+    if api_key:
+        headers['api-key'] = api_key
+    return headers
+
+
+def get_async_client():
+    """Cliente httpx asíncrono con pool keep-alive para el event loop actual"""
+    if httpx is None:
+        raise RuntimeError("httpx no está instalado: requerido para el modo asíncrono")
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            headers=_default_headers(),
+            limits=httpx.Limits(
+                max_connections=QDRANT_POOL_SIZE,
+                max_keepalive_connections=QDRANT_POOL_SIZE
+            ),
+            timeout=httpx.Timeout(QDRANT_READ_TIMEOUT, connect=QDRANT_CONNECT_TIMEOUT)
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def close_async_client():
+    """Cierra el cliente del event loop actual (al apagar el servidor)"""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def async_qdrant_request(method, path, json=None, timeout=None, idempotent=None):
+    """
+    Versión asíncrona de qdrant_request. Devuelve un httpx.Response, que
+    expone status_code, text y json() igual que requests.Response.
+    """
+    method = method.upper()
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+    attempts = 1 + (QDRANT_MAX_RETRIES if idempotent else 0)
+    read_timeout = timeout if timeout is not None else QDRANT_READ_TIMEOUT
+    url = f"{get_qdrant_url()}{path}"
+
+    for attempt in range(attempts):
+        try:
+            response = await get_async_client().request(
+                method,
+                url,
+                json=json,
+                timeout=httpx.Timeout(read_timeout, connect=QDRANT_CONNECT_TIMEOUT)
+            )
+            if response.status_code in RETRY_STATUS_CODES and attempt < attempts - 1:
+                log.warning("⚠️ Qdrant respondió %s en %s. Reintentando...", response.status_code, path)
+                await asyncio.sleep(QDRANT_RETRY_BACKOFF * (2 ** attempt))
+                continue
+            return response
+        except httpx.TransportError as e:
+            if attempt < attempts - 1:
+                log.warning("⚠️ Error de conexión con Qdrant (%s). Reintentando...", e)
+                await asyncio.sleep(QDRANT_RETRY_BACKOFF * (2 ** attempt))
+            else:
+                raise
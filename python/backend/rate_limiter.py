@@ -0,0 +1,224 @@
+"""
+Limitador de tasa compartido por todo el proceso para las llamadas a Gemini.
+
+Cada modelo tiene dos token buckets:
+- Solicitudes por minuto (RPM)
+- Tokens por minuto (TPM), opcional
+
+Quien llama espera SOLO el tiempo que exige el presupuesto del modelo, en
+lugar de dormir un tiempo fijo después de cada llamada. Las pistas de
+Retry-After que devuelve la API bloquean el modelo hasta esa fecha.
+"""
+import os
+import re
+import asyncio
+import time
+import threading
+
+# Espera máxima que acepta una llamada antes de rendirse (segundos)
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', '20'))
+
+
+class RateLimitExceeded(Exception):
+    """La espera necesaria supera el máximo permitido para esta llamada"""
+
+    def __init__(self, model, wait_seconds):
+        super().__init__(
+            f"Límite de cuota local para {model}: habría que esperar {wait_seconds:.1f}s"
+        )
+        self.model = model
+        self.wait_seconds = wait_seconds
+
+
+class _TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, cost):
+        # Un costo mayor que la capacidad nunca cabría: se limita a la capacidad
+        cost = min(cost, self.capacity)
+        missing = cost - self.level
+        return 0.0 if missing <= 0 else missing / self.rate
+
+    def consume(self, cost):
+        self.level -= min(cost, self.capacity)
+
+
+class _ModelBudget:
+    def __init__(self, rpm, tpm=None):
+        self.requests = _TokenBucket(rpm)
+        self.tokens = _TokenBucket(tpm) if tpm else None
+        self.blocked_until = 0.0
+        self.stats = {
+            'requests': 0,
+            'throttled_requests': 0,
+            'throttled_seconds': 0.0,
+            'retry_after_hints': 0,
+        }
+
+    def wait_time(self, now, tokens, requests=1):
+        self.requests.refill(now)
+        wait = self.requests.time_until(requests)
+        if self.tokens is not None:
+            self.tokens.refill(now)
+            wait = max(wait, self.tokens.time_until(tokens))
+        return max(wait, self.blocked_until - now)
+
+
+class RateLimiter:
+    def __init__(self):
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def register_model(self, model, rpm, tpm=None):
+        """Registra (o actualiza) el presupuesto RPM/TPM de un modelo"""
+        with self._lock:
+            self._budgets[model] = _ModelBudget(rpm, tpm)
+
+    def _try_reserve(self, model, tokens, requests, waited, max_wait) -> float:
+        """
+        Intenta descontar el presupuesto. Devuelve 0 si lo logró o los
+        segundos que hay que esperar antes de volver a intentarlo.
+        """
+        with self._lock:
+            budget = self._budgets.get(model)
+            if budget is None:
+                # Modelo sin presupuesto registrado: no se limita
+                return 0.0
+
+            now = time.monotonic()
+            wait = budget.wait_time(now, tokens, requests)
+            if wait <= 0:
+                budget.requests.consume(requests)
+                if budget.tokens is not None:
+                    budget.tokens.consume(tokens)
+                budget.stats['requests'] += 1
+                if waited > 0:
+                    budget.stats['throttled_requests'] += 1
+                    budget.stats['throttled_seconds'] += waited
+                return 0.0
+
+            if waited + wait > max_wait:
+                raise RateLimitExceeded(model, waited + wait)
+            return wait
+
+    def acquire(self, model, tokens=0, requests=1, max_wait=None) -> float:
+        """
+        Bloquea hasta que el modelo tenga presupuesto para 'requests'
+        solicitudes con 'tokens' tokens en total y lo descuenta.
+
+        Returns:
+            Segundos esperados por el limitador
+
+        Raises:
+            RateLimitExceeded: si la espera supera max_wait
+        """
+        max_wait = RATE_LIMIT_MAX_WAIT if max_wait is None else max_wait
+        waited = 0.0
+
+        while True:
+            wait = self._try_reserve(model, tokens, requests, waited, max_wait)
+            if wait <= 0:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    async def acquire_async(self, model, tokens=0, requests=1, max_wait=None) -> float:
+        """Igual que acquire pero cede el event loop mientras espera"""
+        max_wait = RATE_LIMIT_MAX_WAIT if max_wait is None else max_wait
+        waited = 0.0
+
+        while True:
+            wait = self._try_reserve(model, tokens, requests, waited, max_wait)
+            if wait <= 0:
+                return waited
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def adjust_tokens(self, model, estimated, actual):
+        """Corrige el bucket de tokens con el consumo real reportado por la API"""
+        with self._lock:
+            budget = self._budgets.get(model)
+            if budget is None or budget.tokens is None or actual is None:
+                return
+            budget.tokens.consume(actual - estimated)
+
+    def penalize(self, model, retry_after):
+        """Bloquea el modelo durante 'retry_after' segundos (pista de la API)"""
+        if not retry_after or retry_after <= 0:
+            return
+        with self._lock:
+            budget = self._budgets.get(model)
+            if budget is None:
+                return
+            budget.blocked_until = max(budget.blocked_until, time.monotonic() + retry_after)
+            budget.stats['retry_after_hints'] += 1
+
+    def seconds_until_available(self, model, tokens=0) -> float:
+        with self._lock:
+            budget = self._budgets.get(model)
+            if budget is None:
+                return 0.0
+            return max(0.0, budget.wait_time(time.monotonic(), tokens))
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                model: {
+                    **budget.stats,
+                    'throttled_seconds': round(budget.stats['throttled_seconds'], 3),
+                    'blocked_for': round(max(0.0, budget.blocked_until - now), 3),
+                }
+                for model, budget in self._budgets.items()
+            }
+
+
+def estimate_tokens(text) -> int:
+    """Estimación rápida de tokens (~4 caracteres por token)"""
+    if isinstance(text, (list, tuple)):
+        return sum(estimate_tokens(t) for t in text)
+    return max(1, len(text or '') // 4)
+
+
+_RETRY_PATTERNS = [
+    re.compile(r'retry_delay\s*\{\s*seconds:\s*(\d+(?:\.\d+)?)', re.IGNORECASE),
+    re.compile(r'retry in\s*(\d+(?:\.\d+)?)\s*s', re.IGNORECASE),
+    re.compile(r'retry-after[:=\s]+(\d+(?:\.\d+)?)', re.IGNORECASE),
+]
+
+
+def parse_retry_after(error):
+    """
+    Extrae la pista de Retry-After (en segundos) de un error de la API,
+    o None si no trae ninguna.
+    """
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after:
+        return float(retry_after)
+
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    if 'Retry-After' in headers:
+        try:
+            return float(headers['Retry-After'])
+        except (TypeError, ValueError):
+            pass
+
+    message = str(error)
+    for pattern in _RETRY_PATTERNS:
+        match = pattern.search(message)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+# Instancia compartida por todo el proceso
+rate_limiter = RateLimiter()
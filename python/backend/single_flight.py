@@ -0,0 +1,148 @@
+"""
+Coalescencia de solicitudes idénticas en curso (single-flight).
+
+Cuando empieza un día de lección, muchos usuarios preguntan lo mismo en
+pocos segundos; todos fallan el cache antes de que la primera respuesta se
+guarde y cada uno paga su embedding, su búsqueda y su generación. Con
+single-flight la primera solicitud de una clave (la misma clave del cache
+de respuestas) hace el trabajo y las demás esperan su resultado: un pico de
+tráfico cuesta una llamada al LLM en vez de cincuenta.
+
+Hay una variante para hilos (Flask) y otra para asyncio (Quart). Si quien
+lidera falla, la excepción se comparte con quienes esperaban (un 429 lo
+sería también para ellos); si tarda más de SINGLE_FLIGHT_TIMEOUT, o su tarea
+se cancela, cada solicitud en espera hace su propio trabajo.
+"""
+import os
+import asyncio
+import threading
+from metrics import count, COALESCED_REQUESTS
+
+SINGLE_FLIGHT_ENABLED = os.getenv('SINGLE_FLIGHT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Segundos máximos de espera por el resultado de otra solicitud
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv('SINGLE_FLIGHT_TIMEOUT', '120'))
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Agrupa llamadas concurrentes con la misma clave en una sola ejecución"""
+
+    def __init__(self, name, timeout=None):
+        self.name = name
+        self.timeout = SINGLE_FLIGHT_TIMEOUT if timeout is None else timeout
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+        self.stats = {'leaders': 0, 'coalesced': 0, 'timeouts': 0, 'shared_errors': 0}
+
+    def do(self, key, fn):
+        """
+        Ejecuta fn() una sola vez para todas las llamadas concurrentes con
+        la misma clave.
+
+        Returns:
+            (resultado, compartido): compartido es True si el resultado vino
+            de la ejecución de otra solicitud
+        """
+        if not SINGLE_FLIGHT_ENABLED:
+            return fn(), False
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.stats['leaders'] += 1
+
+        if leader:
+            try:
+                call.result = fn()
+                return call.result, False
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if not call.done.wait(self.timeout):
+            with self._lock:
+                self.stats['timeouts'] += 1
+            return fn(), False
+        return self._shared(call.result, call.error), True
+
+    async def do_async(self, key, coro_fn):
+        """Variante asyncio de do(): coro_fn() devuelve la corrutina a ejecutar"""
+        if not SINGLE_FLIGHT_ENABLED:
+            return await coro_fn(), False
+
+        future = self._async_calls.get(key)
+        if future is None:
+            future = self._async_calls[key] = asyncio.get_running_loop().create_future()
+            self.stats['leaders'] += 1
+            try:
+                result = await coro_fn()
+                future.set_result(result)
+                return result, False
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except BaseException as e:
+                future.set_exception(e)
+                # Marca la excepción como consultada aunque nadie esté esperando
+                future.exception()
+                raise
+            finally:
+                del self._async_calls[key]
+
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            return await coro_fn(), False
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+            # La solicitud líder se canceló (cliente desconectado): trabajo propio
+            return await coro_fn(), False
+        except Exception:
+            # Error de la solicitud líder: se comparte abajo
+            pass
+        error = future.exception()
+        return self._shared(None if error else future.result(), error), True
+
+    def _shared(self, result, error):
+        with self._lock:
+            self.stats['coalesced'] += 1
+            if error is not None:
+                self.stats['shared_errors'] += 1
+        count(COALESCED_REQUESTS, flight=self.name)
+        if error is not None:
+            raise error
+        return result
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats['in_flight'] = len(self._calls) + len(self._async_calls)
+        return stats
+
+
+# Generación de respuestas de /chat y de /ask (+ /ask_chatbot/<id>)
+chat_flight = SingleFlight('chat')
+ask_flight = SingleFlight('ask')
+
+
+def get_single_flight_stats() -> dict:
+    return {
+        'enabled': SINGLE_FLIGHT_ENABLED,
+        'chat': chat_flight.get_stats(),
+        'ask': ask_flight.get_stats()
+    }
@@ -0,0 +1,160 @@
+"""
+Logging estructurado y asíncrono para el camino de las solicitudes.
+
+Los print() del flujo de /chat escriben en stdout de forma síncrona; en un
+contenedor stdout es un pipe y esa E/S se suma a la latencia. Aquí cada
+registro solo se encola (QueueHandler): un hilo aparte (QueueListener) lo
+formatea y lo escribe. El formateo del mensaje también se difiere al hilo,
+así que las llamadas deben pasar argumentos al estilo de logging
+(log.info("x: %s", valor)) y no f-strings.
+
+- Niveles con LOG_LEVEL (DEBUG, INFO, WARNING...).
+- LOG_FORMAT=json emite una línea JSON por registro; 'text' es legible.
+- Cada registro lleva el request_id de la solicitud en curso (contextvars:
+  sirve tanto en hilos de Flask como en tareas de Quart).
+- Las líneas detalladas (una por documento candidato) se marcan con
+  extra=VERBOSE y solo se registran en una fracción de las solicitudes
+  (LOG_SAMPLE_RATE), decidida una vez por solicitud.
+- Si la cola se llena se descartan registros en vez de bloquear.
+"""
+import os
+import sys
+import json
+import uuid
+import queue
+import atexit
+import random
+import logging
+import threading
+import contextvars
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+# Fracción de solicitudes que registran las líneas detalladas por documento
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.1'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+ROOT_LOGGER = 'chatbot'
+REQUEST_ID_HEADER = 'X-Request-ID'
+# extra= de las líneas detalladas sujetas a muestreo
+VERBOSE = {'verbose': True}
+
+_request_id = contextvars.ContextVar('request_id', default=None)
+_sampled = contextvars.ContextVar('log_sampled', default=True)
+
+_stats = {'enqueued': 0, 'dropped': 0, 'sampled_out': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def start_request(request_id=None) -> str:
+    """
+    Asocia un request_id al contexto actual (el recibido en X-Request-ID o
+    uno nuevo) y decide si esta solicitud registra las líneas detalladas.
+    """
+    request_id = (request_id or uuid.uuid4().hex[:16])[:64]
+    _request_id.set(request_id)
+    _sampled.set(random.random() < LOG_SAMPLE_RATE)
+    return request_id
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+class _RequestContextFilter(logging.Filter):
+    """Corre en el hilo que registra: copia el request_id y aplica el muestreo"""
+
+    def filter(self, record):
+        if getattr(record, 'verbose', False) and not _sampled.get():
+            _count('sampled_out')
+            return False
+        record.request_id = _request_id.get()
+        return True
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """Encola el registro tal cual (sin formatear) y descarta si la cola está llena"""
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            _count('enqueued')
+        except queue.Full:
+            _count('dropped')
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', None),
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s [%(request_id)s] %(message)s')
+
+    def format(self, record):
+        if getattr(record, 'request_id', None) is None:
+            record.request_id = '-'
+        return super().format(record)
+
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+def _setup():
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else TextFormatter())
+
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        handler = _NonBlockingQueueHandler(log_queue)
+        handler.addFilter(_RequestContextFilter())
+
+        root = logging.getLogger(ROOT_LOGGER)
+        root.setLevel(LOG_LEVEL)
+        root.addHandler(handler)
+        root.propagate = False
+
+        _listener = QueueListener(log_queue, output, respect_handler_level=True)
+        _listener.start()
+        # Vacía la cola al terminar el proceso
+        atexit.register(_listener.stop)
+
+
+def get_logger(name) -> logging.Logger:
+    """Logger del backend (chatbot.<name>) con salida por la cola"""
+    _setup()
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def get_logging_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['level'] = LOG_LEVEL
+    stats['format'] = LOG_FORMAT
+    stats['sample_rate'] = LOG_SAMPLE_RATE
+    stats['queue_size'] = LOG_QUEUE_SIZE
+    return stats
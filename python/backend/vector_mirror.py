@@ -0,0 +1,406 @@
+"""
+Espejo local de una colección de Qdrant con vectores en memoria mapeada.
+
+Para una colección de unos cientos de vectores de 768 dimensiones, cada
+búsqueda en Qdrant Cloud cuesta más en red que en cómputo. El espejo guarda
+en disco una matriz float32 (o float16) con los vectores normalizados y un
+JSON con los IDs y payloads; todos los workers abren la misma matriz con
+np.load(mmap_mode='r'), así el sistema operativo la comparte entre procesos.
+
+La búsqueda top-k es un producto punto vectorizado con NumPy, con filtros
+opcionales por campos del payload ('metadata.lesson_date'). Si el espejo no
+existe o tiene más de VECTOR_MIRROR_MAX_AGE segundos desde la última
+sincronización completa, las funciones devuelven None (el llamador usa
+Qdrant) y se programa una resincronización en segundo plano.
+
+Se llena de dos formas: sincronizando desde Qdrant (scroll con vectores;
+también `python vector_mirror.py [colección]`) o directamente desde
+add_pdf_to_collection a medida que sube lotes.
+
+Una sincronización tarda lo que el scroll, y mientras tanto otros hilos o
+procesos pueden subir o borrar puntos. Cada escritura queda anotada con su
+hora en el JSON ('changes'); al reemplazar el espejo con el resultado del
+scroll se conservan las escrituras posteriores a su inicio, que el scroll
+pudo no ver.
+"""
+import os
+import re
+import json
+import time
+import threading
+import numpy as np
+from qdrant_transport import qdrant_request
+from structured_logging import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+VECTOR_MIRROR_ENABLED = os.getenv('VECTOR_MIRROR_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+VECTOR_MIRROR_DIR = os.getenv('VECTOR_MIRROR_DIR', os.path.join('cache', 'vectors'))
+# 'float32' o 'float16' (mitad de memoria; el producto punto se hace en float32)
+VECTOR_MIRROR_DTYPE = os.getenv('VECTOR_MIRROR_DTYPE', 'float32')
+# Segundos tras una sincronización completa en los que el espejo se considera
+# vigente; 0 = nunca caduca (útil sin servidor Qdrant)
+VECTOR_MIRROR_MAX_AGE = float(os.getenv('VECTOR_MIRROR_MAX_AGE', '900'))
+
+log = get_logger('vector_mirror')
+
+
+def _payload_value(payload, dotted_key):
+    value = payload
+    for part in dotted_key.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+class _FileLock:
+    """Bloqueo exclusivo entre procesos (flock) mientras se reescribe el espejo"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+class VectorMirror:
+    def __init__(self, collection_name, directory=None, dtype=None):
+        self.collection_name = collection_name
+        self.directory = directory or VECTOR_MIRROR_DIR
+        self.dtype = np.dtype(dtype or VECTOR_MIRROR_DTYPE)
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, re.sub(r'[^\w.-]', '_', collection_name))
+        self.meta_path = f"{base}.json"
+        self.lock_path = f"{base}.lock"
+        self._base = base
+        self._meta = None
+        self._vectors = None
+        self._loaded_mtime = None
+        self._lock = threading.Lock()
+        self._syncing = False
+        self.stats = {'searches': 0, 'fallbacks': 0, 'syncs': 0}
+
+    # --- Lectura ---
+
+    def _reload_if_changed(self):
+        """Vuelve a abrir los archivos si otro proceso (o este) los reescribió"""
+        try:
+            mtime = os.stat(self.meta_path).st_mtime_ns
+        except FileNotFoundError:
+            self._meta, self._vectors, self._loaded_mtime = None, None, None
+            return
+        if mtime == self._loaded_mtime:
+            return
+        with open(self.meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        vectors_path = os.path.join(self.directory, meta['vectors_file'])
+        self._vectors = np.load(vectors_path, mmap_mode='r') if meta['ids'] else None
+        self._meta = meta
+        self._loaded_mtime = mtime
+
+    def _is_fresh_locked(self):
+        # synced_at None: solo escrituras sueltas, sin copia completa todavía
+        if self._meta is None or self._meta['synced_at'] is None:
+            return False
+        if VECTOR_MIRROR_MAX_AGE <= 0:
+            return True
+        return time.time() - self._meta['synced_at'] < VECTOR_MIRROR_MAX_AGE
+
+    def _filter_mask(self, payload_filter):
+        payloads = self._meta['payloads']
+        mask = np.ones(len(payloads), dtype=bool)
+        for key, expected in payload_filter.items():
+            mask &= np.fromiter(
+                (_payload_value(payload, key) == expected for payload in payloads),
+                dtype=bool, count=len(payloads)
+            )
+        return mask
+
+    def _usable(self):
+        """Recarga si hace falta; False (y resincroniza) si el espejo no sirve"""
+        self._reload_if_changed()
+        if self._is_fresh_locked():
+            return True
+        self.stats['fallbacks'] += 1
+        self.schedule_sync()
+        return False
+
+    def search(self, vector, limit=8, payload_filter=None):
+        """
+        Top-k por similitud coseno, en el mismo formato que /points/search
+        ({'id', 'score', 'payload'}). None si hay que ir a Qdrant.
+        """
+        with self._lock:
+            if not self._usable():
+                return None
+            if self._vectors is None:
+                return []
+            query = np.asarray(vector, dtype=np.float32)
+            if query.shape[0] != self._vectors.shape[1]:
+                return None
+            norm = np.linalg.norm(query)
+            if norm:
+                query = query / norm
+
+            scores = np.asarray(self._vectors, dtype=np.float32) @ query
+            if payload_filter:
+                scores = np.where(self._filter_mask(payload_filter), scores, -np.inf)
+            k = min(limit, scores.shape[0])
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            self.stats['searches'] += 1
+            return [
+                {
+                    'id': self._meta['ids'][i],
+                    'score': float(scores[i]),
+                    'payload': self._meta['payloads'][i]
+                }
+                for i in top if np.isfinite(scores[i])
+            ]
+
+    def find(self, payload_filter, limit=1):
+        """Equivalente a /points/scroll con filtro: puntos que cumplen el filtro o None"""
+        with self._lock:
+            if not self._usable():
+                return None
+            if self._vectors is None:
+                return []
+            positions = np.flatnonzero(self._filter_mask(payload_filter))[:limit]
+            return [
+                {'id': self._meta['ids'][i], 'payload': self._meta['payloads'][i]}
+                for i in positions
+            ]
+
+    # --- Escritura ---
+
+    def _write(self, ids, payloads, vectors, synced_at, changes):
+        """
+        Reescribe el espejo: primero la matriz nueva, luego el JSON que apunta a ella.
+
+        Args:
+            changes: {id: [hora, borrado]} de las escrituras sueltas (upsert/delete)
+        """
+        version = time.time_ns()
+        vectors_file = f"{os.path.basename(self._base)}.{version}.npy"
+        if ids:
+            matrix = _normalize_rows(np.asarray(vectors, dtype=np.float32)).astype(self.dtype)
+            np.save(os.path.join(self.directory, vectors_file), matrix)
+
+        previous = self._meta['vectors_file'] if self._meta else None
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'collection': self.collection_name,
+                'ids': ids,
+                'payloads': payloads,
+                'vectors_file': vectors_file,
+                'dtype': self.dtype.name,
+                'synced_at': synced_at,
+                'changes': changes,
+                'updated_at': time.time()
+            }, f, ensure_ascii=False)
+        os.replace(tmp_path, self.meta_path)
+
+        # Los procesos que aún tienen mapeada la matriz anterior la siguen leyendo
+        if previous and previous != vectors_file:
+            try:
+                os.remove(os.path.join(self.directory, previous))
+            except OSError:
+                pass
+
+    def _current_rows(self):
+        if self._meta is None or self._vectors is None:
+            return [], [], []
+        return (list(self._meta['ids']), list(self._meta['payloads']),
+                list(np.asarray(self._vectors, dtype=np.float32)))
+
+    def _current_changes(self):
+        return dict(self._meta.get('changes', {})) if self._meta else {}
+
+    def sync(self, page_size=256):
+        """Copia completa de la colección desde Qdrant (scroll con vectores)"""
+        started = time.time()
+        ids, payloads, vectors = [], [], []
+        offset = None
+        while True:
+            body = {'limit': page_size, 'with_payload': True, 'with_vector': True}
+            if offset is not None:
+                body['offset'] = offset
+            response = qdrant_request(
+                'POST', f"/collections/{self.collection_name}/points/scroll", json=body,
+                timeout=60, idempotent=True
+            )
+            if response.status_code != 200:
+                raise ValueError(f"Error recorriendo '{self.collection_name}': {response.status_code}")
+
+            result = response.json().get('result', {})
+            for point in result.get('points', []):
+                if point.get('vector') is None:
+                    continue
+                ids.append(str(point['id']))
+                payloads.append(point.get('payload', {}))
+                vectors.append(point['vector'])
+            offset = result.get('next_page_offset')
+            if offset is None:
+                break
+
+        with _FileLock(self.lock_path), self._lock:
+            self._reload_if_changed()
+            # Escrituras hechas desde que empezó el scroll: ganan sobre lo recorrido
+            changes = {point_id: change for point_id, change in self._current_changes().items()
+                       if change[0] >= started}
+            if changes:
+                current = {row[0]: row for row in zip(*self._current_rows())}
+                rows = [row for row in zip(ids, payloads, vectors) if row[0] not in changes]
+                rows.extend(current[point_id] for point_id, (_, deleted) in changes.items()
+                            if not deleted and point_id in current)
+                ids, payloads, vectors = (list(column) for column in zip(*rows)) if rows else ([], [], [])
+            self._write(ids, payloads, vectors, synced_at=started, changes=changes)
+            self._reload_if_changed()
+        self.stats['syncs'] += 1
+        log.info("🪞 Espejo local de '%s' sincronizado: %s vectores (%.2fs)",
+                 self.collection_name, len(ids), time.time() - started)
+
+    def schedule_sync(self):
+        """Resincroniza en segundo plano (una sola a la vez por proceso)"""
+        if self._syncing:
+            return
+        self._syncing = True
+
+        def run():
+            try:
+                with self._lock:
+                    self._reload_if_changed()
+                    fresh = self._is_fresh_locked()
+                if not fresh:  # Otro worker pudo sincronizar mientras tanto
+                    self.sync()
+            except Exception as e:
+                log.warning("⚠️ No se pudo sincronizar el espejo de '%s': %s", self.collection_name, e)
+            finally:
+                self._syncing = False
+
+        threading.Thread(target=run, name=f'mirror-{self.collection_name}', daemon=True).start()
+
+    def upsert(self, points):
+        """Agrega o reemplaza puntos ({'id', 'vector', 'payload'}) tras subirlos a Qdrant"""
+        now = time.time()
+        with _FileLock(self.lock_path), self._lock:
+            self._reload_if_changed()
+            # Sin copia inicial se guardan igual (no vigente): una sincronización
+            # en curso los conserva al terminar
+            ids, payloads, vectors = self._current_rows()
+            changes = self._current_changes()
+            positions = {point_id: i for i, point_id in enumerate(ids)}
+            for point in points:
+                point_id = str(point['id'])
+                changes[point_id] = [now, False]
+                if point_id in positions:
+                    i = positions[point_id]
+                    payloads[i], vectors[i] = point.get('payload', {}), point['vector']
+                else:
+                    positions[point_id] = len(ids)
+                    ids.append(point_id)
+                    payloads.append(point.get('payload', {}))
+                    vectors.append(point['vector'])
+            synced_at = self._meta['synced_at'] if self._meta else None
+            self._write(ids, payloads, vectors, synced_at=synced_at, changes=changes)
+            self._reload_if_changed()
+
+    def delete(self, point_ids):
+        removed = {str(point_id) for point_id in point_ids}
+        now = time.time()
+        with _FileLock(self.lock_path), self._lock:
+            self._reload_if_changed()
+            rows = [row for row in zip(*self._current_rows()) if row[0] not in removed]
+            ids, payloads, vectors = (list(column) for column in zip(*rows)) if rows else ([], [], [])
+            changes = self._current_changes()
+            changes.update((point_id, [now, True]) for point_id in removed)
+            synced_at = self._meta['synced_at'] if self._meta else None
+            self._write(ids, payloads, vectors, synced_at=synced_at, changes=changes)
+            self._reload_if_changed()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            meta = self._meta
+            return {
+                **self.stats,
+                'vectors': len(meta['ids']) if meta else 0,
+                'dtype': self.dtype.name,
+                'fresh': self._is_fresh_locked(),
+                'synced_at': meta['synced_at'] if meta else None
+            }
+
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def get_vector_mirror(collection_name) -> VectorMirror:
+    """Espejo de la colección; si no hay copia vigente la sincroniza en segundo plano"""
+    with _mirrors_lock:
+        mirror = _mirrors.get(collection_name)
+        if mirror is not None:
+            return mirror
+        mirror = _mirrors[collection_name] = VectorMirror(collection_name)
+    with mirror._lock:
+        mirror._reload_if_changed()
+        if not mirror._is_fresh_locked():
+            mirror.schedule_sync()
+    return mirror
+
+
+def mirror_search(collection_name, vector, limit=8, payload_filter=None):
+    """Búsqueda en el espejo local; None si está desactivado o no vigente"""
+    if not VECTOR_MIRROR_ENABLED:
+        return None
+    return get_vector_mirror(collection_name).search(vector, limit, payload_filter)
+
+
+def mirror_find(collection_name, payload_filter, limit=1):
+    if not VECTOR_MIRROR_ENABLED:
+        return None
+    return get_vector_mirror(collection_name).find(payload_filter, limit)
+
+
+def mirror_upsert(collection_name, points):
+    if VECTOR_MIRROR_ENABLED:
+        get_vector_mirror(collection_name).upsert(points)
+
+
+def mirror_delete(collection_name, point_ids):
+    if VECTOR_MIRROR_ENABLED:
+        get_vector_mirror(collection_name).delete(point_ids)
+
+
+def get_vector_mirror_stats() -> dict:
+    with _mirrors_lock:
+        mirrors = dict(_mirrors)
+    return {name: mirror.get_stats() for name, mirror in mirrors.items()}
+
+
+if __name__ == '__main__':
+    import sys
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    target_collection = sys.argv[1] if len(sys.argv) > 1 else os.getenv('QDRANT_COLLECTION', 'ESCUELA-SABATICA')
+    VectorMirror(target_collection).sync()